@@ -1,7 +1,14 @@
-from flask import Flask, request, make_response
+import os
+import json
+import itertools
+from flask import Flask, request, make_response, Response
 from downloader import url
 from flask_httpauth import HTTPBasicAuth
 from . import user
+from . import storage
+
+
+OUTPUT_DIRECTORY = os.environ.get('DOWNLOADER_OUTPUT_DIRECTORY')
 
 
 app = Flask(__name__)
@@ -26,6 +33,19 @@ def url_add():
         return {'ok': False, 'error': str(e)}, 500
 
 
+@app.route('/url/import', methods=['POST'])
+@auth.login_required
+def url_import():
+    try:
+        return {'ok': True, 'results': list(url.import_urls(
+            lines=request.get_data(as_text=True).splitlines(),
+            verify_username=auth.username(),
+            **dict(request.args)
+        ))}
+    except Exception as e:
+        return {'ok': False, 'error': str(e)}, 500
+
+
 @app.route('/url/edit')
 @auth.login_required
 def url_edit():
@@ -42,10 +62,49 @@ def url_edit():
 @app.route('/url/list')
 @auth.login_required
 def url_list():
+    # streams a page of search results, as a json object (default) or with format=ndjson as a url object per line
     try:
-        return {'ok': True, 'urls': list(url.list_urls(
-            verify_username=auth.username(),
-            **dict(request.args)
-        ))}
+        args = dict(request.args)
+        output_format = args.pop('format', 'json')
+        if output_format not in ('json', 'ndjson'):
+            raise Exception('invalid format: {}'.format(output_format))
+        limit = int(args.get('limit', url.SEARCH_URL_DEFAULT_LIMIT))
+        urls = url.get_urls(verify_username=auth.username(), **args)
+        # the first url is fetched before the response starts, so that invalid arguments return an error response
+        first_url = next(urls, None)
+    except Exception as e:
+        return {'ok': False, 'error': str(e)}, 500
+    urls = itertools.chain([first_url], urls) if first_url is not None else iter(())
+    if output_format == 'ndjson':
+        return Response((json.dumps(url_object) + '\n' for url_object in urls), mimetype='application/x-ndjson')
+    else:
+        return Response(_iterate_url_list_json(urls, limit), mimetype='application/json')
+
+
+def _iterate_url_list_json(urls, limit):
+    # next_after_id is the id of the last url, or null if this is the last page
+    yield '{"ok": true, "urls": ['
+    num_urls, last_id = 0, None
+    for url_object in urls:
+        yield (',' if num_urls > 0 else '') + json.dumps(url_object)
+        num_urls, last_id = num_urls + 1, url_object['id']
+    yield '], "next_after_id": %s}' % json.dumps(last_id if num_urls >= limit else None)
+
+
+@app.route('/url/download')
+@auth.login_required
+def url_download():
+    # content of the last successful download, compressed files are decoded unless the client accepts their encoding
+    try:
+        if not OUTPUT_DIRECTORY:
+            raise Exception('DOWNLOADER_OUTPUT_DIRECTORY is not set')
+        download_path, content_encoding = url.get_download(request.args['id'], verify_username=auth.username())
+        filename = os.path.join(OUTPUT_DIRECTORY, download_path)
+        if content_encoding and content_encoding in request.accept_encodings:
+            response = Response(storage.iterate_chunks(open(filename, 'rb')), mimetype='application/octet-stream')
+            response.headers['Content-Encoding'] = content_encoding
+            return response
+        else:
+            return Response(storage.iterate_chunks(storage.open_reader(filename, content_encoding)), mimetype='application/octet-stream')
     except Exception as e:
         return {'ok': False, 'error': str(e)}, 500
@@ -0,0 +1,209 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import resource
+import tempfile
+import platform
+import subprocess
+import multiprocessing
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import db
+from . import app
+from . import url as url_lib
+from . import queue
+from . import metrics
+
+
+# benchmark of queue fetch and download against a local HTTP server, on a dedicated empty DB
+# the urls are seeded with the behaviour of the HTTP server in their query string (latency, size, status, redirects, slow drip),
+# chosen randomly using the seed, so runs with the same options are comparable across commits
+# each domain is a different loopback address (127.x.y.z), so that the domain throttling is the same as with real domains
+
+APP_NAME = 'benchmark'
+DEFAULT_PORT = 18080
+DEFAULT_NUM_URLS = 10000
+DEFAULT_URLS_PER_DOMAIN = 10
+DEFAULT_NUM_COLLECTIONS = 10
+DEFAULT_LATENCY_MS = 50
+DEFAULT_SIZE_BYTES = 10*1024
+DEFAULT_ERROR_RATE = 0.05
+DEFAULT_REDIRECT_RATE = 0.05
+DEFAULT_SLOW_DRIP_RATE = 0.01
+DEFAULT_MAX_DOWNLOADS = 10000
+DEFAULT_CONCURRENT_CONNECTIONS = 50
+DEFAULT_SEED = 1
+
+SLOW_DRIP_CHUNK_BYTES = 1024
+SLOW_DRIP_CHUNK_INTERVAL_MS = 500
+MAX_REDIRECTS = 3
+ERROR_STATUSES = [404, 500, 503]
+
+BENCHMARK_TABLES = ['app', 'domain', 'url', 'hash', 'queue', 'tag']
+
+
+class _BenchmarkHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        params = {k: int(v[0]) for k, v in parse_qs(parts.query).items()}
+        time.sleep(params.get('latency', 0) / 1000)
+        if params.get('redirects', 0) > 0:
+            params['redirects'] -= 1
+            self.send_response(302)
+            self.send_header('Location', parts.path + '?' + '&'.join('%s=%s' % (k, v) for k, v in params.items()))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        # unique content for each url path
+        body = hashlib.sha256(parts.path.encode()).hexdigest().encode() * (params.get('size', 0) // 64 + 1)
+        body = body[:params.get('size', 0)]
+        self.send_response(params.get('status', 200))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if params.get('drip'):
+            for i in range(0, len(body), SLOW_DRIP_CHUNK_BYTES):
+                self.wfile.write(body[i:i + SLOW_DRIP_CHUNK_BYTES])
+                self.wfile.flush()
+                time.sleep(SLOW_DRIP_CHUNK_INTERVAL_MS / 1000)
+        else:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=DEFAULT_PORT):
+    server = ThreadingHTTPServer(('0.0.0.0', int(port)), _BenchmarkHandler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def start_server_process(port=DEFAULT_PORT):
+    # the server runs in a separate process so that it doesn't affect the measured cpu and memory of the downloader
+    process = multiprocessing.Process(target=serve, args=(port,), daemon=True)
+    process.start()
+    return process
+
+
+def get_domain(domain_num, port):
+    # loopback address of the domain, 127.0.0.1 is skipped
+    domain_num += 2
+    return '127.%s.%s.%s:%s' % (domain_num >> 16 & 255, domain_num >> 8 & 255, domain_num & 255, port)
+
+
+def generate_urls(num_urls, port, urls_per_domain=DEFAULT_URLS_PER_DOMAIN, num_collections=DEFAULT_NUM_COLLECTIONS,
+                  latency_ms=DEFAULT_LATENCY_MS, size_bytes=DEFAULT_SIZE_BYTES, error_rate=DEFAULT_ERROR_RATE,
+                  redirect_rate=DEFAULT_REDIRECT_RATE, slow_drip_rate=DEFAULT_SLOW_DRIP_RATE, seed=DEFAULT_SEED):
+    # yields import lines (see url.import_urls), latency and size are exponentially distributed around their averages
+    rand = random.Random(seed)
+    num_domains = max(1, num_urls // urls_per_domain)
+    for i in range(num_urls):
+        params = {'latency': int(rand.expovariate(1 / latency_ms)) if latency_ms else 0,
+                  'size': int(rand.expovariate(1 / size_bytes)) if size_bytes else 0}
+        if rand.random() < error_rate:
+            params['status'] = rand.choice(ERROR_STATUSES)
+        if rand.random() < redirect_rate:
+            params['redirects'] = rand.randint(1, MAX_REDIRECTS)
+        if rand.random() < slow_drip_rate:
+            params['drip'] = 1
+        yield json.dumps({
+            'url': 'http://%s/%s?%s' % (get_domain(i % num_domains, port), i, '&'.join('%s=%s' % (k, v) for k, v in params.items())),
+            'collection': 'collection%s' % (i % num_collections),
+        })
+
+
+def reset():
+    # deletes all the data, only if the DB contains only the benchmark app
+    if any(row['name'] != APP_NAME for row in db.rows_iterator('select name from app')):
+        raise Exception('refusing to reset a DB which contains apps other then the benchmark app')
+    db.execute('truncate {} restart identity cascade'.format(', '.join(BENCHMARK_TABLES)))
+
+
+def seed_db(num_urls, port, **kwargs):
+    if db.only_one('select count(1) cnt from app')['cnt'] > 0:
+        raise Exception('benchmark must run on an empty DB (use reset to delete a previous benchmark)')
+    app.create(APP_NAME)
+    num_errors = 0
+    for result in url_lib.import_urls(APP_NAME, generate_urls(num_urls, port, **kwargs)):
+        if 'error' in result:
+            num_errors += 1
+    if num_errors > 0:
+        raise Exception('failed to import %s benchmark urls' % num_errors)
+
+
+def _get_peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def _get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _get_completion_latencies(started_at):
+    return db.only_one("""
+        select
+            percentile_cont(0.5) within group (order by total_seconds) p50,
+            percentile_cont(0.99) within group (order by total_seconds) p99
+        from url_update_history where updated_at >= to_timestamp(%s)
+    """, (started_at,))
+
+
+def run(num_urls=DEFAULT_NUM_URLS, port=DEFAULT_PORT, max_downloads=DEFAULT_MAX_DOWNLOADS,
+        concurrent_connections=DEFAULT_CONCURRENT_CONNECTIONS, queue_type='regular', with_reset=False, **kwargs):
+    # returns the benchmark results, the DB should be empty or contain only a previous benchmark (with_reset=True)
+    db.migrate()
+    if with_reset:
+        reset()
+    server_process = start_server_process(port)
+    work_directory = tempfile.mkdtemp()
+    queue_directory = os.path.join(work_directory, 'queue')
+    output_directory = os.path.join(work_directory, 'output')
+    try:
+        results = {
+            'commit': _get_git_commit(),
+            'python': platform.python_version(),
+            'env': {k: v for k, v in os.environ.items() if k.startswith('DOWNLOADER_') and k != 'DOWNLOADER_DB_DSN'},
+            'options': dict(kwargs, num_urls=num_urls, max_downloads=max_downloads, concurrent_connections=concurrent_connections,
+                            queue_type=queue_type),
+        }
+        start_time = time.time()
+        seed_db(num_urls, port, **kwargs)
+        results['seed_seconds'] = round(time.time() - start_time, 3)
+        start_time = time.time()
+        _, num_queue_urls = queue.fetch(queue_type, queue_directory)
+        results['queue_build_seconds'] = round(time.time() - start_time, 3)
+        results['queue_urls'] = num_queue_urls
+        results['fetch_peak_rss_bytes'] = _get_peak_rss_bytes()
+        start_totals = metrics.get_totals()
+        start_time = time.time()
+        download_stats = queue.download(queue_type, queue_directory, output_directory, concurrent_connections, max_downloads)
+        download_seconds = time.time() - start_time
+        totals = metrics.get_totals()
+        num_processed = download_stats[1]
+        num_bytes = totals.get('downloader_downloaded_bytes_total', 0) - start_totals.get('downloader_downloaded_bytes_total', 0)
+        latencies = _get_completion_latencies(start_time)
+        results.update({
+            'download_seconds': round(download_seconds, 3),
+            'downloaded_urls': num_processed,
+            'error_urls': download_stats[7],
+            'timeout_urls': download_stats[8],
+            'urls_per_second': round(num_processed / download_seconds, 3),
+            'bytes_per_second': round(num_bytes / download_seconds, 3),
+            'completion_latency_p50_seconds': latencies['p50'],
+            'completion_latency_p99_seconds': latencies['p99'],
+            'peak_rss_bytes': _get_peak_rss_bytes(),
+        })
+        return results
+    finally:
+        server_process.terminate()
+        shutil.rmtree(work_directory)
@@ -3,6 +3,7 @@ from ruamel.yaml.representer import RoundTripRepresenter
 import ruamel.yaml
 from collections import OrderedDict
 import sys
+import json
 
 
 class MyRepresenter(RoundTripRepresenter):
@@ -46,6 +47,24 @@ def db_migrate():
     print('Successfully migrated the DB')
 
 
+from . import storage
+
+
+@main.group("storage")
+def storage_group():
+    pass
+
+
+@storage_group.command("migrate")
+@click.argument('OUTPUT_DIRECTORY')
+@click.option('--batch-size', default=storage.MIGRATE_BATCH_SIZE)
+def storage_migrate(output_directory, batch_size):
+    stats = storage.migrate(output_directory, batch_size)
+    print('migrated files: ' + str(stats['num_migrated']))
+    print('already migrated files: ' + str(stats['num_already_migrated']))
+    print('missing files: ' + str(stats['num_missing_files']))
+
+
 from . import app
 
 
@@ -90,6 +109,21 @@ def url_add(app_name, url, extra_json):
     print("ID=%s" % id)
 
 
+@url_group.command("import")
+@click.argument('APP_NAME')
+@click.argument('FILE', type=click.File('r'))
+def url_import(app_name, file):
+    num_imported, num_errors = 0, 0
+    for result in url_lib.import_urls(app_name, file):
+        if 'error' in result:
+            num_errors += 1
+            print("row %s: %s" % (result['row'], result['error']))
+        else:
+            num_imported += 1
+    print("Successfully imported %s URLs to app %s" % (num_imported, app_name))
+    print("Number of rows with errors: %s" % num_errors)
+
+
 @url_group.command("edit")
 @click.argument('APP_NAME')
 @click.argument('COLLECTION_NAME')
@@ -117,11 +151,15 @@ def url_get(id, with_history, with_tags):
 @click.option('--tag')
 @click.option("--with-history", is_flag=True)
 @click.option("--with-tags", is_flag=True)
-def url_search(app_name, collection_name, title, title_startswith, title_contains, tag, with_history, with_tags):
-    _yaml_dump_iterator(url_lib.get_urls(app_name=app_name, collection_name=collection_name, title=title, title_startswith=title_startswith, title_contains=title_contains, tag=tag, with_history=with_history, with_tags=with_tags))
+@click.option('--after-id', type=int)
+@click.option('--limit', type=int, default=url_lib.SEARCH_URL_DEFAULT_LIMIT)
+def url_search(app_name, collection_name, title, title_startswith, title_contains, tag, with_history, with_tags, after_id, limit):
+    _yaml_dump_iterator(url_lib.get_urls(app_name=app_name, collection_name=collection_name, title=title, title_startswith=title_startswith, title_contains=title_contains, tag=tag, with_history=with_history, with_tags=with_tags,
+                                         after_id=after_id, limit=limit))
 
 
 from . import queue
+from . import profiling
 
 
 @main.group('queue')
@@ -129,12 +167,20 @@ def queue_group():
     pass
 
 
+def _profile_options(func):
+    func = click.option('--profile-directory', help='write a trace file of each cycle to the directory')(func)
+    func = click.option('--cprofile', is_flag=True, help='also write a cProfile capture of each cycle (requires --profile-directory)')(func)
+    return func
+
+
 @queue_group.command('daemon')
 @click.argument('QUEUE_TYPE')
 @click.argument('QUEUE_DIRECTORY')
 @click.argument('OUTPUT_DIRECTORY')
 @click.argument('CONCURRENT_CONNECTIONS')
-def queue_daemon(queue_type, queue_directory, output_directory, concurrent_connections):
+@_profile_options
+def queue_daemon(queue_type, queue_directory, output_directory, concurrent_connections, profile_directory, cprofile):
+    profiling.configure(profile_directory, cprofile or None)
     print('starting daemon')
     print('queue_type=' + queue_type)
     print('queue_directory=' + queue_directory)
@@ -143,11 +189,30 @@ def queue_daemon(queue_type, queue_directory, output_directory, concurrent_conne
     queue.daemon(queue_type, queue_directory, output_directory, concurrent_connections)
 
 
+@queue_group.command('worker')
+@click.argument('QUEUE_TYPE')
+@click.argument('QUEUE_DIRECTORY')
+@click.argument('OUTPUT_DIRECTORY')
+@click.argument('CONCURRENT_CONNECTIONS')
+@click.option('--batch-size', default=queue.WORKER_DEFAULT_BATCH_SIZE)
+@click.option('--worker-id')
+def queue_worker(queue_type, queue_directory, output_directory, concurrent_connections, batch_size, worker_id):
+    print('starting worker')
+    print('queue_type=' + queue_type)
+    print('queue_directory=' + queue_directory)
+    print('output_directory=' + output_directory)
+    print('concurrent_connections=' + concurrent_connections)
+    queue.worker(queue_type, queue_directory, output_directory, concurrent_connections, batch_size, worker_id)
+
+
 @queue_group.command("fetch")
 @click.argument('QUEUE_TYPE')
 @click.argument('QUEUE_DIRECTORY')
-def queue_fetch(queue_type, queue_directory):
-    app_stats, len_all_url_ids = queue.fetch(queue_type, queue_directory)
+@_profile_options
+def queue_fetch(queue_type, queue_directory, profile_directory, cprofile):
+    profiling.configure(profile_directory, cprofile or None)
+    with profiling.trace_cycle('fetch-' + queue_type):
+        app_stats, len_all_url_ids = queue.fetch(queue_type, queue_directory)
     print('queue type = ' + queue_type)
     print('number of urls per app / collection\n')
     for app_name, collection_stats in app_stats.items():
@@ -162,10 +227,13 @@ def queue_fetch(queue_type, queue_directory):
 @click.argument('QUEUE_DIRECTORY')
 @click.argument('OUTPUT_DIRECTORY')
 @click.argument('CONCURRENT_CONNECTIONS')
-def queue_download(queue_type, queue_directory, output_directory, concurrent_connections):
+@_profile_options
+def queue_download(queue_type, queue_directory, output_directory, concurrent_connections, profile_directory, cprofile):
+    profiling.configure(profile_directory, cprofile or None)
     # (num_already_downloaded, num_processed, reached_max_downloads, total_read_lines, skipped_due_to_domain_start_time,
     #  num_existing_hash_id, num_new_hash_id, num_error_urls, num_timeout_urls) = \
-    queue.download(queue_type, queue_directory, output_directory, concurrent_connections)
+    with profiling.trace_cycle('download-' + queue_type):
+        queue.download(queue_type, queue_directory, output_directory, concurrent_connections)
     # print('number of already downloaded urls: ' + str(num_already_downloaded))
     # print('number of processed urls: ' + str(num_processed))
     # print('reached max downloads? ' + ('yes' if reached_max_downloads else 'no'))
@@ -227,3 +295,47 @@ def user_allow_app(username, app_name, remove):
         print("Successfully disallowed username %s to access app %s" % (username, app_name))
     else:
         print("Successfully allowed username %s to access app %s" % (username, app_name))
+
+
+from . import benchmark
+
+
+@main.group('benchmark')
+def benchmark_group():
+    pass
+
+
+@benchmark_group.command('run')
+@click.option('--num-urls', default=benchmark.DEFAULT_NUM_URLS)
+@click.option('--max-downloads', default=benchmark.DEFAULT_MAX_DOWNLOADS)
+@click.option('--concurrent-connections', default=benchmark.DEFAULT_CONCURRENT_CONNECTIONS)
+@click.option('--queue-type', default='regular')
+@click.option('--port', default=benchmark.DEFAULT_PORT)
+@click.option('--urls-per-domain', default=benchmark.DEFAULT_URLS_PER_DOMAIN)
+@click.option('--num-collections', default=benchmark.DEFAULT_NUM_COLLECTIONS)
+@click.option('--latency-ms', default=benchmark.DEFAULT_LATENCY_MS)
+@click.option('--size-bytes', default=benchmark.DEFAULT_SIZE_BYTES)
+@click.option('--error-rate', default=benchmark.DEFAULT_ERROR_RATE)
+@click.option('--redirect-rate', default=benchmark.DEFAULT_REDIRECT_RATE)
+@click.option('--slow-drip-rate', default=benchmark.DEFAULT_SLOW_DRIP_RATE)
+@click.option('--seed', default=benchmark.DEFAULT_SEED)
+@click.option('--reset', is_flag=True)
+@click.option('--output', type=click.File('a'))
+def benchmark_run(num_urls, max_downloads, concurrent_connections, queue_type, port, reset, output, **kwargs):
+    results = benchmark.run(num_urls, port, max_downloads, concurrent_connections, queue_type, reset, **kwargs)
+    print(json.dumps(results, indent=2))
+    if output:
+        output.write(json.dumps(results) + '\n')
+
+
+@benchmark_group.command('reset')
+def benchmark_reset():
+    benchmark.reset()
+    print('Successfully deleted the benchmark data')
+
+
+@benchmark_group.command('server')
+@click.option('--port', default=benchmark.DEFAULT_PORT)
+def benchmark_server(port):
+    print('serving benchmark urls on port %s' % port)
+    benchmark.serve(port)
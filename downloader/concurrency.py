@@ -0,0 +1,116 @@
+import os
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# additive-increase / multiplicative-decrease (AIMD) of the number of concurrent transfers, globally and per domain
+# global - every CONTROL_INTERVAL_SECONDS the limit is halved if too many transfers timed out or were throttled by the servers,
+#          or if the process is short on resources (open files, results writer backlog),
+#          otherwise it's increased if transfers were waiting for the limit
+# domain - halved on a timeout or 429 / 503 response from the domain, increased by 1 / limit on each other response,
+#          the start interval of a domain is the domain throttle interval divided by its limit
+
+CONTROL_INTERVAL_SECONDS = 5
+DECREASE_FACTOR = 0.5
+INCREASE_RATIO = 0.05  # of the max connections, added to the global limit
+INITIAL_RATIO = 0.25  # of the max connections
+MIN_CONNECTIONS = 2
+MIN_WINDOW_RESULTS = 10
+MAX_CONGESTION_RATE = 0.25
+MAX_OPEN_FILES_RATIO = 0.8
+
+DOMAIN_MAX_CONNECTIONS = 4
+
+CONGESTION_RESPONSE_CODES = [429, 503]
+
+
+def create_controller(max_connections, domain_interval_seconds, is_backlogged=None):
+    # is_backlogged - optional callback, returns True if the downloaded results are not saved fast enough
+    max_connections = int(max_connections)
+    return {
+        'max': max_connections,
+        'min': min(MIN_CONNECTIONS, max_connections),
+        'step': max(1, max_connections * INCREASE_RATIO),
+        'limit': max(min(MIN_CONNECTIONS, max_connections), max_connections * INITIAL_RATIO),
+        'domain_interval': domain_interval_seconds,
+        'is_backlogged': is_backlogged,
+        'domains': {},
+        'window_started_at': time.time(),
+        'window': {'num_results': 0, 'num_congested': 0, 'saturated': False},
+        'stats': {'num_increases': 0, 'num_decreases': 0, 'num_domain_decreases': 0},
+    }
+
+
+def _open_files_ratio():
+    try:
+        return len(os.listdir('/proc/self/fd')) / resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    except (OSError, AttributeError):
+        return 0
+
+
+def _get_domain(controller, domain):
+    domain_state = controller['domains'].get(domain)
+    if domain_state is None:
+        domain_state = controller['domains'][domain] = {'limit': 1, 'in_flight': 0, 'decreased_at': 0}
+    return domain_state
+
+
+def can_start(controller, num_running):
+    if num_running < int(controller['limit']):
+        return True
+    else:
+        controller['window']['saturated'] = True
+        return False
+
+
+def domain_ready(controller, domain):
+    domain_state = _get_domain(controller, domain)
+    return domain_state['in_flight'] < int(domain_state['limit'])
+
+
+def domain_interval(controller, domain):
+    return controller['domain_interval'] / _get_domain(controller, domain)['limit']
+
+
+def started(controller, domain):
+    _get_domain(controller, domain)['in_flight'] += 1
+
+
+def completed(controller, domain, response_code=None, is_timeout=False):
+    domain_state = _get_domain(controller, domain)
+    domain_state['in_flight'] -= 1
+    controller['window']['num_results'] += 1
+    if is_timeout or response_code in CONGESTION_RESPONSE_CODES:
+        controller['window']['num_congested'] += 1
+        # decreased at most once per interval, so a burst of failures of the same transfers doesn't collapse the limit
+        if domain_state['decreased_at'] + CONTROL_INTERVAL_SECONDS < time.time():
+            domain_state['limit'] = max(1, domain_state['limit'] * DECREASE_FACTOR)
+            domain_state['decreased_at'] = time.time()
+            controller['stats']['num_domain_decreases'] += 1
+    else:
+        domain_state['limit'] = min(DOMAIN_MAX_CONNECTIONS, domain_state['limit'] + 1 / domain_state['limit'])
+
+
+def update(controller):
+    # called from the download loop, adjusts the global limit once per CONTROL_INTERVAL_SECONDS
+    now = time.time()
+    if controller['window_started_at'] + CONTROL_INTERVAL_SECONDS > now:
+        return
+    window = controller['window']
+    is_congested = window['num_results'] >= MIN_WINDOW_RESULTS and window['num_congested'] / window['num_results'] > MAX_CONGESTION_RATE
+    is_backlogged = controller['is_backlogged'] is not None and controller['is_backlogged']()
+    if is_congested or is_backlogged or _open_files_ratio() > MAX_OPEN_FILES_RATIO:
+        controller['limit'] = max(controller['min'], controller['limit'] * DECREASE_FACTOR)
+        controller['stats']['num_decreases'] += 1
+    elif window['saturated'] and controller['limit'] < controller['max']:
+        controller['limit'] = min(controller['max'], controller['limit'] + controller['step'])
+        controller['stats']['num_increases'] += 1
+    controller['window_started_at'] = now
+    controller['window'] = {'num_results': 0, 'num_congested': 0, 'saturated': False}
+    # idle domains at the initial limit are removed so that the state doesn't grow with the number of domains
+    for domain in [domain for domain, domain_state in controller['domains'].items()
+                   if domain_state['in_flight'] == 0 and domain_state['limit'] <= 1]:
+        del controller['domains'][domain]
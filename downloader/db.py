@@ -1,27 +1,136 @@
 import psycopg2
 import os
+import threading
+from contextlib import contextmanager
 import psycopg2.extras
+import psycopg2.pool
 from psycopg2.errors import UniqueViolation
 
 
-DSN = os.environ['DOWNLOADER_DB_DSN']
+DSN = os.environ.get('DOWNLOADER_DB_DSN')
+POOL_MIN_CONNECTIONS = int(os.environ.get('DOWNLOADER_DB_POOL_MIN_CONNECTIONS', '1'))
+POOL_MAX_CONNECTIONS = int(os.environ.get('DOWNLOADER_DB_POOL_MAX_CONNECTIONS', '10'))
+
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+MIGRATE_TIMESTAMP_COLUMNS = [
+    ('hash', 'downloaded_at'),
+    ('url_update_history', 'updated_at'),
+    ('url_last_update', 'next_retry_at'),
+    ('url_schedule', 'next_due_at'),
+    ('queue', 'added_at'),
+]
+
+MIGRATE_INDEXES = [
+    ('url_update_history_url_id_updated_at', 'url_update_history', 'url_id, updated_at'),
+    ('url_tag_tag_id_value', 'url_tag', 'tag_id, value'),
+    ('url_domain_id', 'url', 'domain_id'),
+    ('collection_url_url_id', 'collection_url', 'url_id'),
+]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# psycopg2's ThreadedConnectionPool raises PoolError when exhausted, the semaphore makes callers wait instead
+_pool_semaphore = threading.BoundedSemaphore(POOL_MAX_CONNECTIONS)
+_local = threading.local()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                if not DSN:
+                    raise Exception('DOWNLOADER_DB_DSN environment variable is not set')
+                _pool = psycopg2.pool.ThreadedConnectionPool(POOL_MIN_CONNECTIONS, POOL_MAX_CONNECTIONS, DSN)
+    return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+@contextmanager
+def connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        # inside a transaction - statements run on the transaction connection and are committed by it
+        yield conn
+    else:
+        pool = get_pool()
+        with _pool_semaphore:
+            conn = pool.getconn()
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                pool.putconn(conn, close=bool(conn.closed))
+
+
+@contextmanager
+def transaction():
+    if getattr(_local, 'conn', None) is not None:
+        # nested transactions are merged into the outer transaction
+        yield _local.conn
+    else:
+        with connection() as conn:
+            _local.conn = conn
+            try:
+                yield conn
+            finally:
+                _local.conn = None
 
 
 def execute(*args):
-    with psycopg2.connect(DSN) as conn:
+    with connection() as conn:
         with conn.cursor() as cur:
             cur.execute(*args)
-            conn.commit()
 
 
 def rows_iterator(*args):
-    with psycopg2.connect(DSN) as conn:
+    with connection() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+            cur.execute(*args)
+            # rows are fetched before yielding so that the connection is returned to the pool
+            # and nested queries while iterating don't need to hold more then one connection
+            rows = cur.fetchall()
+    for row in rows:
+        yield row
+
+
+def rows_stream(*args, itersize=10000):
+    # server-side cursor for large results, rows are fetched in batches of itersize
+    # unlike rows_iterator the connection is held until iteration finishes, so don't run nested queries while iterating
+    with connection() as conn:
+        with conn.cursor('rows_stream') as cur:
+            cur.itersize = itersize
             cur.execute(*args)
             for row in cur:
                 yield row
 
 
+def execute_values(sql, argslist, template=None, page_size=1000, fetch=False):
+    # multi-row statement, sql should contain a single %s placeholder for the VALUES list
+    with connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+            return psycopg2.extras.execute_values(cur, sql, argslist, template=template, page_size=page_size, fetch=fetch)
+
+
+def copy_expert(sql, file):
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.copy_expert(sql, file)
+
+
 def only_one(*args):
     row = None
     for rownum, row in enumerate(rows_iterator(*args)):
@@ -30,6 +139,53 @@ def only_one(*args):
     return row
 
 
+def execute_autocommit(*args):
+    # for statements which can't run inside a transaction block (e.g. create index concurrently)
+    with connection() as conn:
+        if conn is getattr(_local, 'conn', None):
+            raise Exception("can't execute autocommit statement inside a transaction")
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute(*args)
+        finally:
+            conn.autocommit = False
+
+
+def _migrate_timestamp_columns():
+    # timestamps used to be stored as text in DATETIME_FORMAT, without a time zone
+    # they are converted using the time zone of the DB session (can be set using PGTZ environment variable)
+    for table, column in MIGRATE_TIMESTAMP_COLUMNS:
+        row = only_one("""
+            select data_type from information_schema.columns
+            where table_schema = current_schema() and table_name = %s and column_name = %s
+        """, (table, column))
+        if row and row['data_type'] == 'text':
+            execute('alter table {table} alter column {column} type timestamptz using {column}::timestamp::timestamptz'.format(
+                table=table, column=column
+            ))
+
+
+def _migrate_indexes():
+    # indexes are created concurrently to allow running the migration on a populated DB without blocking writes
+    for name, table, columns in MIGRATE_INDEXES:
+        row = only_one("""
+            select pg_index.indisvalid from pg_class join pg_index on pg_index.indexrelid = pg_class.oid
+            where pg_class.relname = %s
+        """, (name,))
+        if row and not row['indisvalid']:
+            # leftover of a failed concurrent index creation
+            execute_autocommit('drop index concurrently {}'.format(name))
+        if not row or not row['indisvalid']:
+            execute_autocommit('create index concurrently {name} on {table} ({columns})'.format(
+                name=name, table=table, columns=columns
+            ))
+
+
 def migrate():
+    from . import schedule
     with open(os.path.join(os.path.dirname(__file__), 'schema.sql')) as f:
         execute(f.read())
+    _migrate_timestamp_columns()
+    _migrate_indexes()
+    schedule.refresh_unscheduled()
@@ -2,6 +2,15 @@ import signal
 from signal import SIGPIPE, SIG_IGN
 import pycurl
 import time
+import hashlib
+import os
+import selectors
+import json
+from functools import partial
+from . import storage
+from . import concurrency
+from . import profiling
+from . import metrics
 
 
 DEFAULT_MAX_REDIRECTS = 5
@@ -9,6 +18,349 @@ DEFAULT_CONNECT_TIMEOUT_SECONDS = 30
 DEFAULT_TIMEOUT_SECONDS = 15
 SLEEP_TIME_SECONDS_IF_NONE_RUNNING = 1
 
+# select - poll the multi handle using perform / select
+# socket_action - event loop on the sockets and timers requested by libcurl (using epoll on Linux)
+ENGINE = os.environ.get('DOWNLOADER_DOWNLOAD_ENGINE', 'select')
+SOCKET_ACTION_MAX_WAIT_SECONDS = 1
+SOCKET_ACTION_ITERATOR_IDLE_SECONDS = 0.1  # wait before getting the next url when the iterator had no url ready
+
+DNS_CACHE_TIMEOUT_SECONDS = 300
+# max number of connections to the same host, additional transfers to the host wait for a free connection (0 = no limit)
+MAX_HOST_CONNECTIONS = int(os.environ.get('DOWNLOADER_DOWNLOAD_MAX_HOST_CONNECTIONS', '0'))
+# use HTTP/2 when supported and multiplex transfers to the same host on a single connection
+HTTP2_MULTIPLEX = os.environ.get('DOWNLOADER_DOWNLOAD_HTTP2_MULTIPLEX') == 'yes'
+
+VALIDATOR_HEADERS = {'etag': 'etag', 'last-modified': 'last_modified'}
+
+RESUME_READ_CHUNK_SIZE = 1024*1024
+
+
+def _is_resume_continued(curl):
+    return curl.response_code == 206 and curl.content_range_start == curl.resume_offset
+
+
+def _write_output(curl, buf):
+    if curl.resume_offset > 0 and not curl.resume_checked:
+        # first body write of a resumed transfer, the response must continue exactly from the resume offset
+        # if the content changed, the server sends the full content which libcurl usually fails with a range error before writing
+        curl.resume_checked = True
+        if not _is_resume_continued(curl):
+            curl.resume_invalid = True
+            return 0  # aborts the transfer
+    curl.fp.write(buf)
+    curl.hasher.update(buf)
+    curl.size_bytes += len(buf)
+
+
+def _write_header(curl, buf):
+    if curl.hfp is not None:
+        curl.hfp.write(buf)
+    line = buf.decode('iso-8859-1').strip()
+    if line.startswith('HTTP/'):
+        # new response (e.g. after a redirect), validators of previous responses are not relevant
+        curl.validators = {}
+        curl.content_range_start = None
+        status = line.split(' ')
+        curl.response_code = int(status[1]) if len(status) > 1 and status[1].isdigit() else None
+    elif ':' in line:
+        name, value = line.split(':', 1)
+        name = name.strip().lower()
+        if name in VALIDATOR_HEADERS:
+            curl.validators[VALIDATOR_HEADERS[name]] = value.strip()
+        elif name == 'content-range':
+            # bytes START-END/TOTAL
+            start = value.strip().split(' ')[-1].split('-')[0]
+            curl.content_range_start = int(start) if start.isdigit() else None
+
+
+def _get_resume_state(output_filename, url):
+    # returns the If-Range validator of a partial download of the url, or None if it can't be resumed
+    if os.path.exists(output_filename) and os.path.getsize(output_filename) > 0 and os.path.exists(output_filename + '.json'):
+        with open(output_filename + '.json') as f:
+            state = json.load(f)
+        if state['url'] == url:
+            return _get_if_range(state)
+    return None
+
+
+def _get_if_range(validators):
+    # weak etags can't be used to validate a range request
+    if validators.get('etag') and not validators['etag'].startswith('W/'):
+        return validators['etag']
+    else:
+        return validators.get('last_modified')
+
+
+def open_output(curl, output_filename, header_filename=None, content_encoding=None, resume_url=None):
+    # the output is hashed while it's written so that the hash and size are available when the transfer completes
+    # the hash is of the decoded content, content_encoding is only used to compress the output file (see storage.py)
+    # if resume_url is set, output_filename is a partial download which is continued using a range request (see save_partial)
+    curl.hasher = hashlib.sha256()
+    curl.size_bytes = 0
+    curl.resume_offset = 0
+    curl.resume_checked = False
+    curl.resume_invalid = False
+    curl.if_range = _get_resume_state(output_filename, resume_url) if resume_url else None
+    if curl.if_range:
+        curl.fp = open(output_filename, 'r+b')
+        while True:
+            buf = curl.fp.read(RESUME_READ_CHUNK_SIZE)
+            if not buf:
+                break
+            curl.hasher.update(buf)
+            curl.size_bytes += len(buf)
+        curl.resume_offset = curl.size_bytes
+    else:
+        curl.fp = storage.open_writer(output_filename, content_encoding)
+    curl.output_filename = output_filename
+    curl.hfp = open(header_filename, "wb") if header_filename is not None else None
+    curl.validators = {}
+    curl.response_code = None
+    curl.content_range_start = None
+    curl.setopt(pycurl.RESUME_FROM_LARGE, curl.resume_offset)
+    curl.setopt(pycurl.WRITEFUNCTION, partial(_write_output, curl))
+    curl.setopt(pycurl.HEADERFUNCTION, partial(_write_header, curl))
+
+
+def save_partial(curl, url, errno=None):
+    # keeps the partial content of a failed transfer so that the next attempt can resume it
+    # returns False if the transfer can't be resumed and the partial content was deleted
+    state_filename = curl.output_filename + '.json'
+    is_valid = curl.size_bytes > 0 and not curl.resume_invalid and errno != pycurl.E_RANGE_ERROR
+    if is_valid and curl.resume_offset > 0:
+        if curl.response_code is None:
+            # failed before a response was received, the stored validators are still valid
+            return True
+        # validators of a response which didn't continue the partial content (e.g. a 200 with a new etag) are not of the partial content
+        is_valid = _is_resume_continued(curl)
+        if is_valid and not _get_if_range(curl.validators):
+            # the partial response had no validators, the stored validators are still valid
+            return True
+    if is_valid and _get_if_range(curl.validators):
+        with open(state_filename, 'w') as f:
+            json.dump(dict(curl.validators, url=url), f)
+        return True
+    else:
+        for filename in [curl.output_filename, state_filename]:
+            if os.path.exists(filename):
+                os.unlink(filename)
+        return False
+
+
+def remove_partial_state(curl):
+    if os.path.exists(curl.output_filename + '.json'):
+        os.unlink(curl.output_filename + '.json')
+
+
+def set_conditional_request(curl, etag=None, last_modified=None, if_range=None):
+    # validators of the previous response, the server responds with 304 if the content was not modified
+    # if_range - validator of a partial download, the server responds with the full content if it was modified
+    headers = []
+    if if_range:
+        headers.append('If-Range: ' + if_range)
+    else:
+        if etag:
+            headers.append('If-None-Match: ' + etag)
+        if last_modified:
+            headers.append('If-Modified-Since: ' + last_modified)
+    curl.setopt(pycurl.HTTPHEADER, headers)
+
+
+def close_output(curl):
+    if getattr(curl, 'fp', None) is not None:
+        curl.fp.close()
+        curl.fp = None
+    if getattr(curl, 'hfp', None) is not None:
+        curl.hfp.close()
+        curl.hfp = None
+    hasher, curl.hasher = getattr(curl, 'hasher', None), None
+    return (hasher.hexdigest() if hasher is not None else None), getattr(curl, 'size_bytes', 0)
+
+
+def _start_transfers(curl_multi, freelist, iterator, connect_timeout_seconds, timeout_seconds, controller=None):
+    # adds url objects from the iterator to free handles
+    # returns a tuple of (is the iterator exhausted, seconds until the iterator has a url ready or None if unknown)
+    # iterator yields url objects, or if no url is ready to start yet - the seconds until a url will be ready or None if unknown
+    # url objects may override the timeouts (connect_timeout_seconds, timeout_seconds, stall_timeout_seconds)
+    while len(freelist) > 0:
+        if controller is not None and not concurrency.can_start(controller, len(curl_multi.handles) - len(freelist)):
+            break
+        try:
+            urlobj = next(iterator)
+        except StopIteration:
+            return True, None
+        if not isinstance(urlobj, dict):
+            return False, urlobj
+        else:
+            curl = freelist.pop()
+            curl.setopt(pycurl.URL, urlobj['url'])
+            curl.setopt(pycurl.TIMEOUT_MS, int((urlobj.get('timeout_seconds') or timeout_seconds) * 1000))
+            curl.setopt(pycurl.CONNECTTIMEOUT_MS, int((urlobj.get('connect_timeout_seconds') or connect_timeout_seconds) * 1000))
+            # aborts the transfer if no data was received for stall_timeout_seconds
+            curl.setopt(pycurl.LOW_SPEED_LIMIT, 1 if urlobj.get('stall_timeout_seconds') else 0)
+            curl.setopt(pycurl.LOW_SPEED_TIME, int(urlobj.get('stall_timeout_seconds') or 0))
+            curl.setopt(pycurl.RESOLVE, urlobj.get('resolve') or [])
+            # request compressed transfer using all the encodings supported by libcurl, the content is decoded by libcurl
+            # resumable transfers request the content without compression, so that range offsets match the stored content
+            curl.setopt(pycurl.ENCODING, 'identity' if urlobj.get('resumable') else '')
+            open_output(curl, urlobj['output_filename'], urlobj.get('header_filename'), urlobj.get('content_encoding'),
+                        resume_url=urlobj['url'] if urlobj.get('resumable') else None)
+            set_conditional_request(curl, urlobj.get('etag'), urlobj.get('last_modified'), curl.if_range)
+            curl_multi.add_handle(curl)
+            curl.urlobj = urlobj
+            metrics.inc('downloader_started_total')
+            metrics.add_gauge('downloader_in_flight_transfers', 1)
+            if controller is not None:
+                concurrency.started(controller, urlobj.get('domain'))
+    return False, None
+
+
+def _get_timings(curl):
+    # timing info of the transfer, used to learn the timeouts (see timing.py)
+    return {
+        'connect_seconds': curl.getinfo(pycurl.CONNECT_TIME),
+        'first_byte_seconds': curl.getinfo(pycurl.STARTTRANSFER_TIME),
+        'total_seconds': curl.getinfo(pycurl.TOTAL_TIME),
+        'downloaded_bytes': curl.size_bytes - curl.resume_offset,
+    }
+
+
+def _complete_transfers(curl_multi, freelist, save_result, controller=None):
+    while True:
+        num_handles_in_queue, ok_list, err_list = curl_multi.info_read()
+        for curl in ok_list:
+            curl.urlobj['timings'] = _get_timings(curl)
+            curl.urlobj['resume_offset'] = curl.resume_offset
+            curl.urlobj['hash'], curl.urlobj['size_bytes'] = close_output(curl)
+            curl.urlobj['validators'] = curl.validators
+            if curl.urlobj.get('resumable'):
+                remove_partial_state(curl)
+            curl_multi.remove_handle(curl)
+            response_code = curl.getinfo(pycurl.RESPONSE_CODE)
+            if controller is not None:
+                concurrency.completed(controller, curl.urlobj.get('domain'), response_code=response_code)
+            save_result(curl.urlobj, response_code=response_code)
+            curl.urlobj = None
+            metrics.add_gauge('downloader_in_flight_transfers', -1)
+            freelist.append(curl)
+        for curl, errno, errmsg in err_list:
+            curl.urlobj['timings'] = _get_timings(curl)
+            close_output(curl)
+            if curl.urlobj.get('resumable'):
+                curl.urlobj['partial_saved'] = save_partial(curl, curl.urlobj['url'], errno)
+            curl_multi.remove_handle(curl)
+            if controller is not None:
+                concurrency.completed(controller, curl.urlobj.get('domain'), is_timeout=errno == pycurl.E_OPERATION_TIMEDOUT)
+            save_result(curl.urlobj, errno=errno, errmsg=errmsg)
+            curl.urlobj = None
+            metrics.add_gauge('downloader_in_flight_transfers', -1)
+            freelist.append(curl)
+        if num_handles_in_queue == 0:
+            break
+    if controller is not None:
+        concurrency.update(controller)
+
+
+def _download_select(curl_multi, concurrent_connections, iterator, save_result, connect_timeout_seconds, timeout_seconds, controller):
+    freelist = curl_multi.handles[:]
+    exhausted, iterator_wait_seconds = False, None
+    while True:
+        if not exhausted:
+            with profiling.span('download.start_transfers', profiling.HOT_SPAN_MIN_SECONDS):
+                exhausted, iterator_wait_seconds = _start_transfers(curl_multi, freelist, iterator, connect_timeout_seconds, timeout_seconds, controller)
+        if len(freelist) == concurrent_connections:
+            if exhausted:
+                break
+            # waits until the iterator has a url ready, if it's known
+            time.sleep(SLEEP_TIME_SECONDS_IF_NONE_RUNNING if iterator_wait_seconds is None
+                       else min(iterator_wait_seconds, SLEEP_TIME_SECONDS_IF_NONE_RUNNING))
+        else:
+            # transfer callbacks (writing and hashing the output) run inside perform
+            with profiling.span('download.perform', profiling.HOT_SPAN_MIN_SECONDS):
+                while True:
+                    ret, num_running_handles = curl_multi.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+            with profiling.span('download.complete_transfers', profiling.HOT_SPAN_MIN_SECONDS):
+                _complete_transfers(curl_multi, freelist, save_result, controller)
+            if num_running_handles > 0:
+                select_seconds = 1.0
+                if len(freelist) > 0 and iterator_wait_seconds is not None:
+                    # wakes up to start the next url when the iterator has one ready
+                    select_seconds = min(select_seconds, iterator_wait_seconds)
+                with profiling.span('download.select', profiling.HOT_SPAN_MIN_SECONDS):
+                    curl_multi.select(select_seconds)
+
+
+def _download_socket_action(curl_multi, concurrent_connections, iterator, save_result, connect_timeout_seconds, timeout_seconds, controller):
+    # libcurl tells which sockets to watch using the socket callback and when to call it back using the timer callback
+    # so completed transfers and new urls are handled as soon as the sockets are ready instead of on a fixed poll interval
+    selector = selectors.DefaultSelector()
+    timer = {'deadline': None}
+
+    def _socket_callback(event, fd, multi, data):
+        if event == pycurl.POLL_REMOVE:
+            if fd in selector.get_map():
+                selector.unregister(fd)
+        else:
+            mask = 0
+            if event in (pycurl.POLL_IN, pycurl.POLL_INOUT):
+                mask |= selectors.EVENT_READ
+            if event in (pycurl.POLL_OUT, pycurl.POLL_INOUT):
+                mask |= selectors.EVENT_WRITE
+            if fd in selector.get_map():
+                selector.modify(fd, mask)
+            else:
+                selector.register(fd, mask)
+
+    def _timer_callback(timeout_ms):
+        timer['deadline'] = None if timeout_ms < 0 else time.monotonic() + timeout_ms / 1000
+
+    curl_multi.setopt(pycurl.M_SOCKETFUNCTION, _socket_callback)
+    curl_multi.setopt(pycurl.M_TIMERFUNCTION, _timer_callback)
+    freelist = curl_multi.handles[:]
+    exhausted, iterator_wait_seconds = False, None
+    try:
+        while True:
+            if not exhausted and len(freelist) > 0:
+                with profiling.span('download.start_transfers', profiling.HOT_SPAN_MIN_SECONDS):
+                    exhausted, iterator_wait_seconds = _start_transfers(curl_multi, freelist, iterator, connect_timeout_seconds, timeout_seconds, controller)
+            if exhausted and len(freelist) == concurrent_connections:
+                break
+            wait_seconds = SOCKET_ACTION_MAX_WAIT_SECONDS
+            if timer['deadline'] is not None:
+                wait_seconds = min(wait_seconds, max(0, timer['deadline'] - time.monotonic()))
+            if len(freelist) > 0 and not exhausted:
+                # the iterator had no url ready to start
+                wait_seconds = min(wait_seconds, SOCKET_ACTION_ITERATOR_IDLE_SECONDS if iterator_wait_seconds is None else iterator_wait_seconds)
+            with profiling.span('download.select', profiling.HOT_SPAN_MIN_SECONDS):
+                if len(selector.get_map()) > 0:
+                    events = selector.select(wait_seconds)
+                else:
+                    events = []
+                    time.sleep(wait_seconds)
+            # transfer callbacks (writing and hashing the output) run inside socket_action
+            with profiling.span('download.socket_action', profiling.HOT_SPAN_MIN_SECONDS):
+                for key, mask in events:
+                    action = 0
+                    if mask & selectors.EVENT_READ:
+                        action |= pycurl.CSELECT_IN
+                    if mask & selectors.EVENT_WRITE:
+                        action |= pycurl.CSELECT_OUT
+                    curl_multi.socket_action(key.fd, action)
+                if timer['deadline'] is not None and time.monotonic() >= timer['deadline']:
+                    timer['deadline'] = None
+                    curl_multi.socket_action(pycurl.SOCKET_TIMEOUT, 0)
+            with profiling.span('download.complete_transfers', profiling.HOT_SPAN_MIN_SECONDS):
+                _complete_transfers(curl_multi, freelist, save_result, controller)
+    finally:
+        # running transfers are removed while the socket callback can still unregister their sockets
+        for curl in curl_multi.handles:
+            if curl not in freelist:
+                curl_multi.remove_handle(curl)
+                freelist.append(curl)
+        selector.close()
+
 
 def download(concurrent_connections,
              iterator,
@@ -16,78 +368,59 @@ def download(concurrent_connections,
              max_redirects=DEFAULT_MAX_REDIRECTS,
              connect_timeout_seconds=DEFAULT_CONNECT_TIMEOUT_SECONDS,
              timeout_seconds=DEFAULT_TIMEOUT_SECONDS,
+             engine=None,
+             max_host_connections=MAX_HOST_CONNECTIONS,
+             http2_multiplex=HTTP2_MULTIPLEX,
+             controller=None,
              ):
+    # downloading ends when the iterator is exhausted and all started transfers completed
+    # url objects may contain resolve - curl RESOLVE option entries of pre-resolved addresses (see resolve.py)
+    # controller - optional concurrency controller which limits the running transfers (see concurrency.py),
+    #              url objects should contain the domain for its per domain limits
+    engine = engine or ENGINE
+    if engine not in ['select', 'socket_action']:
+        raise Exception('invalid download engine: ' + engine)
     # We should ignore SIGPIPE when using pycurl.NOSIGNAL - see
     # the libcurl tutorial for more info.
     signal.signal(SIGPIPE, SIG_IGN)
+    # DNS cache, TLS sessions and connections are shared between all the handles
+    curl_share = pycurl.CurlShare()
+    curl_share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+    curl_share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+    if hasattr(pycurl, 'LOCK_DATA_CONNECT'):
+        curl_share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_CONNECT)
     curl_multi = pycurl.CurlMulti()
+    if max_host_connections:
+        curl_multi.setopt(pycurl.M_MAX_HOST_CONNECTIONS, int(max_host_connections))
+    if http2_multiplex:
+        curl_multi.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX)
     curl_multi.handles = []
     for i in range(concurrent_connections):
         curl = pycurl.Curl()
         curl.fp = None
+        curl.setopt(pycurl.SHARE, curl_share)
+        curl.setopt(pycurl.DNS_CACHE_TIMEOUT, DNS_CACHE_TIMEOUT_SECONDS)
         curl.setopt(pycurl.FOLLOWLOCATION, 1)
         curl.setopt(pycurl.MAXREDIRS, max_redirects)
         curl.setopt(pycurl.CONNECTTIMEOUT, connect_timeout_seconds)
         curl.setopt(pycurl.TIMEOUT, int(timeout_seconds))
         curl.setopt(pycurl.NOSIGNAL, 1)
+        if http2_multiplex:
+            curl.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+            curl.setopt(pycurl.PIPEWAIT, 1)
         curl_multi.handles.append(curl)
     try:
-        freelist = curl_multi.handles[:]
-        while True:
-            while len(freelist) > 0:
-                urlobj = next(iterator)
-                if urlobj is None:
-                    break
-                else:
-                    curl = freelist.pop()
-                    curl.setopt(pycurl.URL, urlobj['url'])
-                    curl.fp = open(urlobj['output_filename'], "wb")
-                    curl.hfp = open(urlobj['header_filename'], "wb") if urlobj.get('header_filename') is not None else None
-                    curl.setopt(pycurl.WRITEDATA, curl.fp)
-                    if curl.hfp is not None:
-                        curl.setopt(pycurl.WRITEHEADER, curl.hfp)
-                    curl_multi.add_handle(curl)
-                    curl.urlobj = urlobj
-            if len(freelist) == concurrent_connections:
-                time.sleep(SLEEP_TIME_SECONDS_IF_NONE_RUNNING)
-            else:
-                while True:
-                    ret, num_running_handles = curl_multi.perform()
-                    if ret != pycurl.E_CALL_MULTI_PERFORM:
-                        break
-                while True:
-                    num_handles_in_queue, ok_list, err_list = curl_multi.info_read()
-                    for curl in ok_list:
-                        curl.fp.close()
-                        curl.fp = None
-                        if curl.hfp is not None:
-                            curl.hfp.close()
-                            curl.hfp = None
-                        curl_multi.remove_handle(curl)
-                        save_result(curl.urlobj, response_code=curl.getinfo(pycurl.RESPONSE_CODE))
-                        curl.urlobj = None
-                        freelist.append(curl)
-                    for curl, errno, errmsg in err_list:
-                        curl.fp.close()
-                        curl.fp = None
-                        if curl.hfp is not None:
-                            curl.hfp.close()
-                            curl.hfp = None
-                        curl_multi.remove_handle(curl)
-                        save_result(curl.urlobj, errno=errno, errmsg=errmsg)
-                        curl.urlobj = None
-                        freelist.append(curl)
-                    if num_handles_in_queue == 0:
-                        break
-                curl_multi.select(1.0)
+        if engine == 'socket_action':
+            _download_socket_action(curl_multi, concurrent_connections, iterator, save_result, connect_timeout_seconds, timeout_seconds, controller)
+        else:
+            _download_select(curl_multi, concurrent_connections, iterator, save_result, connect_timeout_seconds, timeout_seconds, controller)
     finally:
         for curl in curl_multi.handles:
-            if getattr(curl, 'fp', None) is not None:
-                curl.fp.close()
-                curl.fp = None
-            if getattr(curl, 'hfp', None) is not None:
-                curl.hfp.close()
-                curl.hfp = None
+            if getattr(curl, 'urlobj', None) is not None:
+                # transfers which didn't complete (e.g. the download was interrupted)
+                metrics.add_gauge('downloader_in_flight_transfers', -1)
+            close_output(curl)
             curl.urlobj = None
             curl.close()
         curl_multi.close()
+        curl_share.close()
@@ -0,0 +1,92 @@
+import os
+import socket
+from . import db
+
+
+# due urls are claimed by workers as leases in the queue table, so that multiple workers can run against the same DB
+# a lease expires timeout_seconds + LEASE_EXTRA_SECONDS after it was claimed, expired leases can be claimed by other workers
+
+LEASE_EXTRA_SECONDS = 600
+
+LEASE_ACTIVE_CONDITION = "queue.status = 'leased' and queue.added_at + make_interval(secs => queue.timeout_seconds + {}) > now()".format(
+    LEASE_EXTRA_SECONDS
+)
+
+
+def get_worker_id():
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+
+def claim(worker_id, limit, timeout_seconds, min_timeout_seconds=None, max_timeout_seconds=None):
+    # returns the claimed urls with the size and total time of their last successful download (see timing.py)
+    # min/max_timeout_seconds filter by the timeout of the last update (same as queue.filter_collection_urls)
+    # locked schedule rows are skipped so concurrent claims don't wait for each other,
+    # the conflict condition ensures an active lease of another worker is never taken over
+    # urls which don't belong to any collection are not claimed even if they are still scheduled (see schedule._refresh)
+    conditions = [
+        'url_schedule.next_due_at <= now()',
+        'exists (select 1 from collection_url where collection_url.url_id = url_schedule.url_id)',
+    ]
+    if min_timeout_seconds is not None:
+        conditions.append('coalesce(url_update_history.timedout_seconds, 0) >= %(min_timeout_seconds)s')
+    if max_timeout_seconds is not None:
+        conditions.append('coalesce(url_update_history.timedout_seconds, 0) <= %(max_timeout_seconds)s')
+    return list(db.rows_iterator("""
+        with due as (
+            select url_schedule.url_id, url_update_history.hash_id is not null is_update
+            from
+                url_schedule
+                left join url_last_update on url_last_update.url_id = url_schedule.url_id
+                left join url_update_history on url_update_history.id = url_last_update.url_update_history_id
+            where
+                {conditions}
+                and not exists (select 1 from queue where queue.url_id = url_schedule.url_id and {lease_active})
+            order by url_schedule.next_due_at
+            limit %(limit)s
+            for update of url_schedule skip locked
+        ), claimed as (
+            insert into queue (url_id, timeout_seconds, added_at, status, worker)
+            select url_id, %(timeout_seconds)s, now(), 'leased', %(worker_id)s from due
+            on conflict (url_id) do update set
+                timeout_seconds = excluded.timeout_seconds,
+                added_at = excluded.added_at,
+                status = excluded.status,
+                worker = excluded.worker
+            where not ({lease_active})
+            returning url_id, timeout_seconds
+        )
+        select
+            claimed.url_id, url.url, claimed.timeout_seconds,
+            case when due.is_update then url_last_successful_update.etag end etag,
+            case when due.is_update then url_last_successful_update.last_modified end last_modified,
+            last_successful_hash.size_bytes expected_size_bytes,
+            url_successful_history.total_seconds expected_total_seconds
+        from
+            claimed
+            join due on due.url_id = claimed.url_id
+            join url on url.id = claimed.url_id
+            left join url_last_successful_update on url_last_successful_update.url_id = claimed.url_id
+            left join url_update_history url_successful_history on url_successful_history.id = url_last_successful_update.url_update_history_id
+            left join hash last_successful_hash on last_successful_hash.id = url_successful_history.hash_id
+    """.format(conditions=' and '.join(conditions), lease_active=LEASE_ACTIVE_CONDITION), {
+        'limit': limit, 'timeout_seconds': timeout_seconds, 'worker_id': worker_id,
+        'min_timeout_seconds': min_timeout_seconds, 'max_timeout_seconds': max_timeout_seconds,
+    }))
+
+
+def complete(url_ids, worker_id):
+    # only leases which are still held by the worker, if a lease expired and was claimed by another worker it's not affected
+    url_ids = list(url_ids)
+    if len(url_ids) > 0:
+        db.execute("update queue set status = 'done' where url_id = any(%s) and worker = %s and status = 'leased'", (url_ids, worker_id))
+
+
+def release_urls(url_ids, worker_id):
+    url_ids = list(url_ids)
+    if len(url_ids) > 0:
+        db.execute("update queue set status = 'released' where url_id = any(%s) and worker = %s and status = 'leased'", (url_ids, worker_id))
+
+
+def release(worker_id):
+    # releases the unfinished leases of a worker so other workers can claim them without waiting for expiry
+    db.execute("update queue set status = 'released' where worker = %s and status = 'leased'", (worker_id,))
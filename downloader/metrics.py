@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# in-process counters, gauges and histograms, served in the Prometheus text format and logged periodically as json lines
+
+# serve the metrics on http://0.0.0.0:PORT/metrics
+METRICS_PORT = int(os.environ.get('DOWNLOADER_METRICS_PORT', '0'))
+# interval of the stats log (0 = disabled)
+STATS_LOG_INTERVAL_SECONDS = int(os.environ.get('DOWNLOADER_STATS_LOG_INTERVAL_SECONDS', '60'))
+
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+# per domain metrics are kept for the first MAX_DOMAIN_LABELS domains, other domains are labeled as 'other'
+MAX_DOMAIN_LABELS = 100
+
+_lock = threading.Lock()
+_metrics = {}
+_gauge_functions = {}
+_domain_labels = set()
+
+
+def _get_metric(name, metric_type, buckets=None):
+    metric = _metrics.get(name)
+    if metric is None:
+        metric = _metrics[name] = {'type': metric_type, 'values': {}, 'buckets': buckets or DEFAULT_BUCKETS}
+    return metric
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with _lock:
+        values = _get_metric(name, 'counter')['values']
+        key = _labels_key(labels)
+        values[key] = values.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _get_metric(name, 'gauge')['values'][_labels_key(labels)] = value
+
+
+def add_gauge(name, value, **labels):
+    with _lock:
+        values = _get_metric(name, 'gauge')['values']
+        key = _labels_key(labels)
+        values[key] = values.get(key, 0) + value
+
+
+def set_gauge_function(name, function):
+    # gauge which is evaluated when the metrics are collected, function returns the value or None if not available
+    with _lock:
+        _gauge_functions[name] = function
+
+
+def observe(name, value, buckets=None, **labels):
+    with _lock:
+        metric = _get_metric(name, 'histogram', buckets)
+        key = _labels_key(labels)
+        histogram = metric['values'].get(key)
+        if histogram is None:
+            histogram = metric['values'][key] = {'counts': [0] * len(metric['buckets']), 'sum': 0, 'count': 0}
+        for i, bucket in enumerate(metric['buckets']):
+            if value <= bucket:
+                histogram['counts'][i] += 1
+                break
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start_time, **labels)
+
+
+def get_domain_label(domain):
+    with _lock:
+        if domain in _domain_labels:
+            return domain
+        elif len(_domain_labels) < MAX_DOMAIN_LABELS:
+            _domain_labels.add(domain)
+            return domain
+        else:
+            return 'other'
+
+
+def _format_labels(key, extra_labels=()):
+    labels = list(key) + list(extra_labels)
+    if len(labels) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+
+def _get_gauge_function_values():
+    values = {}
+    for name, function in _gauge_functions.items():
+        value = function()
+        if value is not None:
+            values[name] = value
+    return values
+
+
+def collect():
+    # returns the metrics in the Prometheus text format
+    lines = []
+    gauge_function_values = _get_gauge_function_values()
+    with _lock:
+        for name, metric in sorted(_metrics.items()):
+            lines.append('# TYPE %s %s' % (name, metric['type']))
+            for key, value in metric['values'].items():
+                if metric['type'] == 'histogram':
+                    cumulative_count = 0
+                    for bucket, count in zip(metric['buckets'], value['counts']):
+                        cumulative_count += count
+                        lines.append('%s_bucket%s %s' % (name, _format_labels(key, [('le', bucket)]), cumulative_count))
+                    lines.append('%s_bucket%s %s' % (name, _format_labels(key, [('le', '+Inf')]), value['count']))
+                    lines.append('%s_sum%s %s' % (name, _format_labels(key), value['sum']))
+                    lines.append('%s_count%s %s' % (name, _format_labels(key), value['count']))
+                else:
+                    lines.append('%s%s %s' % (name, _format_labels(key), value))
+    for name, value in sorted(gauge_function_values.items()):
+        lines.append('# TYPE %s gauge' % name)
+        lines.append('%s %s' % (name, value))
+    return '\n'.join(lines) + '\n'
+
+
+def get_totals():
+    # returns the total of each counter and gauge over all labels, and the sum / count of each histogram
+    totals = _get_gauge_function_values()
+    with _lock:
+        for name, metric in _metrics.items():
+            if metric['type'] == 'histogram':
+                totals[name + '_sum'] = sum(value['sum'] for value in metric['values'].values())
+                totals[name + '_count'] = sum(value['count'] for value in metric['values'].values())
+            else:
+                totals[name] = sum(metric['values'].values())
+    return totals
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics':
+            body = collect().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port):
+    server = ThreadingHTTPServer(('0.0.0.0', int(port)), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _stats_log_thread(interval_seconds, rates):
+    last_totals, last_time = get_totals(), time.time()
+    while True:
+        time.sleep(interval_seconds)
+        totals, now = get_totals(), time.time()
+        stats = {'time': int(now)}
+        # rate per second since the last log of the counters in rates, the other values are logged as is
+        for name, value in sorted(totals.items()):
+            if name in rates:
+                stats[rates[name]] = round((value - last_totals.get(name, 0)) / (now - last_time), 3)
+            stats[name] = value
+        print(json.dumps(stats), flush=True)
+        last_totals, last_time = totals, now
+
+
+def start_stats_log(interval_seconds, rates=None):
+    # rates - {counter_name: rate_name}
+    threading.Thread(target=_stats_log_thread, args=(interval_seconds, rates or {}), daemon=True).start()
+
+
+def start(rates=None, port=METRICS_PORT, stats_log_interval_seconds=STATS_LOG_INTERVAL_SECONDS):
+    if port:
+        start_server(port)
+    if stats_log_interval_seconds:
+        start_stats_log(stats_log_interval_seconds, rates)
@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import cProfile
+import datetime
+import threading
+from contextlib import contextmanager, nullcontext
+
+
+# opt-in timing spans around the phases of a daemon cycle, written as a Chrome trace json file per cycle
+# (open in chrome://tracing or https://ui.perfetto.dev), optionally with a cProfile capture of the cycle (main thread only)
+# when disabled, span() returns a shared no-op context manager
+
+PROFILE_DIRECTORY = os.environ.get('DOWNLOADER_PROFILE_DIRECTORY') or None
+PROFILE_CPROFILE = os.environ.get('DOWNLOADER_PROFILE_CPROFILE') == 'yes'
+
+# spans in the download loop run many times per second, shorter spans are only added to the totals of the trace
+HOT_SPAN_MIN_SECONDS = 0.001
+
+_config = {'directory': PROFILE_DIRECTORY, 'cprofile': PROFILE_CPROFILE}
+_trace = None
+_noop = nullcontext()
+
+
+def configure(directory=None, cprofile=None):
+    if directory is not None:
+        _config['directory'] = directory
+    if cprofile is not None:
+        _config['cprofile'] = cprofile
+
+
+def span(name, min_seconds=0, **args):
+    if _trace is None:
+        return _noop
+    else:
+        return _span(_trace, name, min_seconds, args)
+
+
+@contextmanager
+def _span(trace, name, min_seconds, args):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start_time
+        thread = threading.current_thread()
+        with trace['lock']:
+            trace['totals'][name] = trace['totals'].get(name, 0) + duration
+            trace['threads'][thread.ident] = thread.name
+            if duration >= min_seconds:
+                trace['events'].append({
+                    'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': thread.ident,
+                    'ts': int((start_time - trace['start_time']) * 1000000), 'dur': int(duration * 1000000),
+                    'args': args,
+                })
+
+
+def _write_trace(trace, filename):
+    events = [
+        {'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+        for tid, name in trace['threads'].items()
+    ] + trace['events']
+    with open(filename, 'w') as f:
+        json.dump({
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'totals_seconds': {name: round(seconds, 6) for name, seconds in sorted(trace['totals'].items())}},
+        }, f)
+
+
+@contextmanager
+def trace_cycle(name):
+    # writes DIRECTORY/<time>-<name>.trace.json (and .prof with cProfile) if profiling is enabled
+    global _trace
+    if not _config['directory']:
+        yield
+        return
+    os.makedirs(_config['directory'], exist_ok=True)
+    filename = os.path.join(_config['directory'], '%s-%s' % (datetime.datetime.now().strftime('%Y%m%d-%H%M%S'), name))
+    trace = {'start_time': time.perf_counter(), 'events': [], 'totals': {}, 'threads': {}, 'lock': threading.Lock()}
+    profiler = cProfile.Profile() if _config['cprofile'] else None
+    _trace = trace
+    if profiler is not None:
+        profiler.enable()
+    try:
+        with span(name):
+            yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(filename + '.prof')
+        _trace = None
+        _write_trace(trace, filename + '.trace.json')
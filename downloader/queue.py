@@ -1,37 +1,88 @@
 from dataflows import Flow, update_resource, dump_to_path, load
 import os
-from collections import defaultdict
-import tempfile
+import math
+from collections import defaultdict, deque
 import datetime
 import time
 from . import db
+from . import results
+from . import throttle
+from . import snapshot
+from . import queuefile
+from . import lease
+from . import resolve
+from . import storage
+from . import timing
+from . import concurrency
+from . import metrics
+from . import profiling
+from . import download as engine
 import pycurl
-import signal
-from signal import SIGPIPE, SIG_IGN
-import hashlib
 import shutil
+import json
+from functools import partial
+from contextlib import contextmanager
 
 
-HASH_BLOCKSIZE = 65536
 MAX_DOWNLOAD_RUNTIME_SECONDS = 60*30
 DOWNLOAD_ITERATIONS_SLEEP_SECONDS = 2
 DOWNLOAD_DOMAIN_THROTTLE_SECONDS = 5
+DOWNLOAD_MAX_PENDING_URLS = 100000  # max number of urls read ahead from the queue file and waiting for their domain
+# urls of a domain which already has this number of pending urls are deferred, so that reading continues to other domains
+DOWNLOAD_MAX_PENDING_URLS_PER_DOMAIN = 100
+DOWNLOAD_DEFERRED_CHECK_SECONDS = 1  # interval of adding deferred urls of domains which are below the per domain limit
+DOWNLOAD_MAX_DEFERRED_URLS = 100000  # reading ahead stops when this number of urls are deferred, until deferred urls are added
 DOWNLOAD_CONNECT_TIMEOUT = 30
 DOWNLOAD_MAX_REDIRECTS = 5
 
 MIN_TIMEOUT_SECONDS = 15
 MAX_TIMEOUT_SECONDS = 300
 MAX_SAMEDOMAINS = 50
-RETRY_FAILED_MIN_SECONDS = 600
 
-DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+DATETIME_FORMAT = db.DATETIME_FORMAT
 
 DAEMON_SLEEP_TIME_SECONDS = 60
 
-DOWNLOAD_ITERATOR_DEFAULT_MIN_SAME_DOMAIN_BUCKET = 100  # domain bucket will be created for urls have more then 100 per domain
-DOWNLOAD_ITERATOR_DEFAULT_MIN_LAST_UPDATE_SECONDS = 600  # it includes new urls and urls which last update was more then 10 minutes ago
-DOWNLOAD_ITERATOR_DEFAULT_MIN_TIMEOUT_SECONDS = None
-DOWNLOAD_ITERATOR_DEFAULT_MAX_TIMEOUT_SECONDS = 15  # will not fetch urls which previously timed out at more then 15 seconds
+WORKER_QUEUE_TYPES = ['timedout', 'regular']
+WORKER_DEFAULT_BATCH_SIZE = 500
+
+BUCKET_TYPES = snapshot.BUCKET_TYPES
+
+# fetch the queue using an in-memory columnar snapshot instead of the dataflows csv files (requires numpy)
+FETCH_COLUMNAR_SNAPSHOT = os.environ.get('DOWNLOADER_FETCH_COLUMNAR_SNAPSHOT') == 'yes'
+
+# resolve domains in background before their urls are downloaded
+DOWNLOAD_PRE_RESOLVE = os.environ.get('DOWNLOADER_DOWNLOAD_PRE_RESOLVE') == 'yes'
+
+# derive the timeouts of each transfer from the timing estimates of its domain (see timing.py)
+DOWNLOAD_ADAPTIVE_TIMEOUTS = os.environ.get('DOWNLOADER_DOWNLOAD_ADAPTIVE_TIMEOUTS') == 'yes'
+
+# adjust the number of concurrent connections (up to CONCURRENT_CONNECTIONS) and per domain limits (see concurrency.py)
+DOWNLOAD_ADAPTIVE_CONCURRENCY = os.environ.get('DOWNLOADER_DOWNLOAD_ADAPTIVE_CONCURRENCY') == 'yes'
+
+DOWNLOAD_ITERATOR_CLAIM_IDLE_SECONDS = 10  # wait before claiming again when there were no more due urls to claim
+
+
+@contextmanager
+def fetch_phase(phase):
+    with metrics.timer('downloader_fetch_phase_seconds', phase=phase), profiling.span('fetch.' + phase):
+        yield
+
+
+@contextmanager
+def cycle_phase(phase):
+    with metrics.timer('downloader_cycle_phase_seconds', phase=phase), profiling.span(phase):
+        yield
+
+
+def iterate_query_span(name, rows):
+    # db.rows_iterator runs the query before yielding the first row, so the span is the query duration
+    rows = iter(rows)
+    with profiling.span(name):
+        first_row = next(rows, None)
+    if first_row is not None:
+        yield first_row
+        yield from rows
 
 
 def fetch_all_collection_urls(queue_directory):
@@ -72,6 +123,9 @@ def fetch_all_collection_urls(queue_directory):
             'last_update_hash_error',
             'last_update_error_code',
             'last_update_timedout_seconds',
+            'last_update_seconds',
+            'last_update_consecutive_failures',
+            'last_update_next_retry_at',
 
             'last_successful_updated_at',
             'last_successful_hash_id',
@@ -79,7 +133,9 @@ def fetch_all_collection_urls(queue_directory):
             'last_successful_hash_size_bytes',
             'last_successful_hash_downloaded_at',
             'last_successful_hash_download_path',
-        ]}) for app in db.rows_iterator("""
+            'last_successful_etag',
+            'last_successful_last_modified',
+        ]}) for app in iterate_query_span('fetch.fetch_all.query', db.rows_iterator("""
                 select
                     app.id             app_id,
                     app.name           app_name,
@@ -103,15 +159,21 @@ def fetch_all_collection_urls(queue_directory):
                     url_update_history.error                  last_update_hash_error,
                     url_update_history.error_code             last_update_error_code,
                     url_update_history.timedout_seconds       last_update_timedout_seconds,
+                    extract(epoch from now() - url_update_history.updated_at)::integer last_update_seconds,
+                    url_last_update.consecutive_failures      last_update_consecutive_failures,
+                    url_last_update.next_retry_at             last_update_next_retry_at,
 
                     url_successful_history.updated_at         last_successful_updated_at,
                     url_successful_history.hash_id            last_successful_hash_id, 
                     last_successful_update_hash.hash          last_successful_hash, 
                     last_successful_update_hash.size_bytes    last_successful_hash_size_bytes, 
                     last_successful_update_hash.downloaded_at last_successful_hash_downloaded_at,
-                    last_successful_update_hash.download_path last_successful_hash_download_path
+                    last_successful_update_hash.download_path last_successful_hash_download_path,
+                    url_last_successful_update.etag           last_successful_etag,
+                    url_last_successful_update.last_modified  last_successful_last_modified
                 from
-                    collection_url
+                    url_schedule
+                    join collection_url on collection_url.url_id = url_schedule.url_id
                     join collection on collection.id = collection_url.collection_id
                     join app on app.id = collection.app_id
                     join url on url.id = collection_url.url_id
@@ -124,7 +186,9 @@ def fetch_all_collection_urls(queue_directory):
                     left join url_last_successful_update on url_last_successful_update.url_id = url.id
                     left join url_update_history url_successful_history on url_successful_history.id = url_last_successful_update.url_update_history_id
                     left join hash last_successful_update_hash on last_successful_update_hash.id = url_successful_history.hash_id
-            """)),
+                where
+                    url_schedule.next_due_at <= now()
+            """))),
         _domain_stats,
         update_resource('res_1', name='all_collection_urls', path='all_collection_urls.csv'),
         dump_to_path(os.path.join(queue_directory, 'all_collection_urls')),
@@ -140,7 +204,7 @@ def filter_collection_urls(queue_directory, domain_stats,
         for row in rows:
             num_same_domain = domain_stats[row['domain_id']]
             timeout_seconds = row['last_update_timedout_seconds'] if row['last_update_timedout_seconds'] else 0
-            last_update_seconds = (datetime.datetime.now() - datetime.datetime.strptime(row['updated_at'], DATETIME_FORMAT)).total_seconds() if row['updated_at'] else None
+            last_update_seconds = row['last_update_seconds']
             if (
                     (min_timeout_seconds is None or timeout_seconds >= min_timeout_seconds)
                     and (max_timeout_seconds is None or timeout_seconds <= max_timeout_seconds)
@@ -158,188 +222,132 @@ def filter_collection_urls(queue_directory, domain_stats,
     ).process()
 
 
-def create_bucket(queue_directory, bucket_name, filter_row):
-    filename = os.path.join(queue_directory, 'buckets', bucket_name + '.txt')
+def get_row_bucket_type(row):
+    # only due urls are fetched (see url_schedule), so the bucket type depends only on the last update
+    if not row['url_id']:
+        return None
+    elif row['updated_at'] is None:
+        return 'new'
+    elif row['last_update_hash_id'] is None:
+        return 'failed'
+    else:
+        return 'update'
 
-    def _filter_rows(rows):
-        for row in rows:
-            if filter_row(row):
-                yield row
 
-    def _dump_to_path(rows):
-        with open(filename, 'w') as f:
-            for row in rows:
-                 f.write("%s\n" % row['url_id'])
+def partition_buckets(queue_directory):
+    # single pass over the filtered urls which routes each row to its (bucket_type, collection_id) bucket file
+    # validators of update urls are written to validators.txt for conditional requests
+    bucket_filenames = {}
+    bucket_files = {}
+    validators_file = open(os.path.join(queue_directory, 'validators.txt'), 'w')
+
+    def _partition_row(row):
+        bucket_type = get_row_bucket_type(row)
+        if bucket_type is not None:
+            key = (bucket_type, row['collection_id'])
+            f = bucket_files.get(key)
+            if f is None:
+                bucket_filenames[key] = os.path.join(queue_directory, 'buckets', bucket_type, str(row['collection_id']) + '.txt')
+                f = bucket_files[key] = open(bucket_filenames[key], 'w')
+            f.write('%s %s\n' % (row['url_id'], row['url']))
+            if bucket_type == 'update' and (row['last_successful_etag'] or row['last_successful_last_modified']):
+                validators_file.write(json.dumps([row['url_id'], row['last_successful_etag'], row['last_successful_last_modified']]) + '\n')
+
+    for bucket_type in BUCKET_TYPES:
+        os.makedirs(os.path.join(queue_directory, 'buckets', bucket_type), exist_ok=True)
+    try:
+        Flow(
+            load(os.path.join(queue_directory, 'filtered_collection_urls', 'datapackage.json')),
+            _partition_row
+        ).process()
+    finally:
+        for f in bucket_files.values():
+            f.close()
+        validators_file.close()
+    return bucket_filenames
 
-    Flow(
-        load(os.path.join(queue_directory, 'filtered_collection_urls', 'datapackage.json')),
-        _filter_rows,
-        _dump_to_path
-    ).process()
-    return {'file': open(filename)}
 
+def load_validators(queue_directory):
+    validators = {}
+    if os.path.exists(os.path.join(queue_directory, 'validators.txt')):
+        with open(os.path.join(queue_directory, 'validators.txt')) as f:
+            for line in f:
+                url_id, etag, last_modified = json.loads(line)
+                validators[int(url_id)] = (etag, last_modified)
+    return validators
 
-def bucket_get_next(bucket):
-    if bucket['file'] is not None:
-        line = bucket['file'].readline()
-        if line == '':
-            close_bucket(bucket)
-            bucket['file'] = None
-            return None
-        else:
-            return int(line.strip())
-    else:
-        return None
 
+def get_claim_filters(queue_type):
+    # the timeout filters of the queue type, leases are claimed regardless of the number of urls of their domain
+    # (urls of the same domain are throttled by the worker)
+    return {k: v for k, v in get_queue_type_filters(queue_type).items() if k in ['min_timeout_seconds', 'max_timeout_seconds']}
 
-def close_bucket(bucket):
-    if bucket['file'] is not None:
-        bucket['file'].close()
-
-
-def filter_bucket_type(bucket_type, row):
-    if row['updated_at']:
-        # url is not new
-        if bucket_type == 'new':
-            return False
-        elif row['last_update_hash_id']:
-            # last update was successful
-            if bucket_type == 'update':
-                return (
-                        row['last_successful_updated_at']
-                        and row['update_freq_minutes']
-                        and (datetime.datetime.now() - datetime.datetime.strptime(row['last_successful_updated_at'], DATETIME_FORMAT)).total_seconds() / 60 > row['update_freq_minutes']
-                )
-            else:
-                return False
-        else:
-            # last update was not successful
-            return bucket_type == 'failed'
+
+def get_queue_type_filters(queue_type):
+    if queue_type == 'timedout':
+        return dict(min_timeout_seconds=MIN_TIMEOUT_SECONDS, max_timeout_seconds=MAX_TIMEOUT_SECONDS)
+    elif queue_type == 'samedomain':
+        return dict(min_same_domains=MAX_SAMEDOMAINS)
     else:
-        # url is new
-        return bucket_type == 'new'
+        return dict(max_timeout_seconds=MIN_TIMEOUT_SECONDS, max_same_domains=MAX_SAMEDOMAINS)
 
 
-def get_download_iterator(min_same_domain_bucket=DOWNLOAD_ITERATOR_DEFAULT_MIN_SAME_DOMAIN_BUCKET,
-                          min_timeout_seconds=DOWNLOAD_ITERATOR_DEFAULT_MIN_TIMEOUT_SECONDS,
-                          max_timeout_seconds=DOWNLOAD_ITERATOR_DEFAULT_MAX_TIMEOUT_SECONDS,
-                          min_last_update_seconds=DOWNLOAD_ITERATOR_DEFAULT_MIN_LAST_UPDATE_SECONDS):
+def set_queue_depth_metrics(queue_type, bucket_depths):
+    for bucket_type in BUCKET_TYPES:
+        metrics.set_gauge('downloader_queue_urls', bucket_depths.get(bucket_type, 0), queue_type=queue_type, bucket_type=bucket_type)
 
-    def _get_urlobj(bucket, bucket_type):
-        url_id = bucket_get_next(bucket)
-        now = datetime.datetime.now()
-        try:
-            db.execute('insert into queue (url_id, timeout_seconds, added_at, status) values (%s, %s, %s, %s)',
-                       (url_id, max_timeout_seconds, now.strftime(DATETIME_FORMAT), 'added'))
-        except db.UniqueViolation:
-            pass
-        row = db.only_one('select id, timeout_seconds, added_at, status from queue where url_id=%s', (url_id,))
-        if row['status'] == 'done' or ((now - datetime.datetime.strptime(row['added_at'], DATETIME_FORMAT)).total_seconds() > row['timeout_seconds'] + 600 and row['status'] != 'added'):
-            db.execute('update queue set status=%s where url_id=%s', ('added', url_id))
-
-
-
-    def _iterator():
-        while True:
-            with tempfile.TemporaryDirectory() as queue_directory:
-                app_stats, all_collection_ids, domain_stats = fetch_all_collection_urls(queue_directory)
-                filter_collection_urls(queue_directory, domain_stats, min_timeout_seconds=min_timeout_seconds, max_timeout_seconds=max_timeout_seconds,
-                                       min_last_update_seconds=min_last_update_seconds)
-                buckets_same_domain_ids = set()
-                for domain_id, num_urls in domain_stats.items():
-                    if num_urls >= min_same_domain_bucket:
-                        buckets_same_domain_ids.add(domain_id)
-                buckets = {}
-                try:
-                    for bucket_type in ['new', 'update', 'failed']:
-                        for domain_id in buckets_same_domain_ids:
-                            bucket_name = os.path.join(bucket_type, 'domain_%s') % domain_id
-                            buckets[bucket_name] = create_bucket(queue_directory, bucket_name, lambda row: row['domain_id'] == domain_id and filter_bucket_type(bucket_type, row))
-                        for collection_id in all_collection_ids:
-                            bucket_name = os.path.join(bucket_type, 'collection_%s') % collection_id
-                            buckets[bucket_name] = create_bucket(queue_directory, bucket_name, lambda row: row['collection_id'] == collection_id and row['domain_id'] not in buckets_same_domain_ids and filter_bucket_type(bucket_type, row))
-                    for bucket_type in ['new', 'update', 'failed']:
-                        for domain_id in buckets_same_domain_ids:
-                            bucket_name = os.path.join(bucket_type, 'domain_%s') % domain_id
-                            urlobj = _get_urlobj(buckets[bucket_name], bucket_type)
-                            if urlobj:
-                                yield urlobj
-                        for collection_id in all_collection_ids:
-                            bucket_name = os.path.join(bucket_type, 'collection_%s') % collection_id
-                            urlobj = _get_urlobj(buckets[bucket_name], bucket_type)
-                            if urlobj:
-                                yield urlobj
-                finally:
-                    for bucket in buckets.values():
-                        close_bucket(bucket)
 
-    return _iterator
+def fetch_snapshot(queue_type, queue_directory):
+    with fetch_phase('snapshot'):
+        collection_urls = snapshot.create_snapshot()
+    with fetch_phase('filter'):
+        queue_rows = snapshot.get_queue_order(collection_urls, snapshot.filter_snapshot(collection_urls, **get_queue_type_filters(queue_type)))
+    url_ids = collection_urls['url_id']
+    validators = collection_urls['validators']
+    queue_writer = queuefile.open_queue_writer(queue_directory)
+    try:
+        with fetch_phase('write_queue'), \
+                open(os.path.join(queue_directory, 'validators.txt'), 'w') as validators_file:
+            for i in queue_rows.tolist():
+                url_id = int(url_ids[i])
+                queuefile.queue_writer_append(queue_writer, url_id, snapshot.snapshot_url(collection_urls, i))
+                if url_id in validators:
+                    validators_file.write(json.dumps([url_id, *validators[url_id]]) + '\n')
+    finally:
+        queuefile.close_queue_writer(queue_writer)
+    set_queue_depth_metrics(queue_type, {
+        bucket_type: int(num_urls)
+        for bucket_type, num_urls in zip(BUCKET_TYPES, snapshot.np.bincount(collection_urls['bucket_type'][queue_rows], minlength=len(BUCKET_TYPES)))
+    })
+    return snapshot.get_app_stats(collection_urls), len(queue_rows)
 
 
 def fetch(queue_type, queue_directory):
     if os.path.exists(queue_directory):
         raise Exception("queue directory already exists, delete it to continue (%s)" % queue_directory)
+    if FETCH_COLUMNAR_SNAPSHOT:
+        snapshot.check_numpy()
     os.mkdir(queue_directory)
-    app_stats, all_collection_ids, domain_stats = fetch_all_collection_urls(queue_directory)
-    if queue_type == 'timedout':
-        filter_collection_urls(queue_directory, domain_stats, min_timeout_seconds=MIN_TIMEOUT_SECONDS, max_timeout_seconds=MAX_TIMEOUT_SECONDS)
-    elif queue_type == 'samedomain':
-        filter_collection_urls(queue_directory, domain_stats, min_same_domains=MAX_SAMEDOMAINS)
-    else:
-        filter_collection_urls(queue_directory, domain_stats, max_timeout_seconds=MIN_TIMEOUT_SECONDS, max_same_domains=MAX_SAMEDOMAINS)
-
-    for bucket_type in ['new', 'update', 'failed']:
-        os.makedirs(os.path.join(queue_directory, 'buckets', bucket_type), exist_ok=True)
-        for collection_id in all_collection_ids:
-            with open(os.path.join(queue_directory, 'buckets', bucket_type, str(collection_id) + '.txt'), 'w') as f:
-
-                def fill_bucket(row):
-                    ok_to_write = False
-                    if row['collection_id'] == collection_id and row['url_id']:
-                        if bucket_type == 'new':
-                            if row['updated_at'] is None:
-                                ok_to_write = True
-                        else:
-                            last_failed = False
-                            last_failed_more_then_10_minutes = False
-                            num_consecutive_failures = 0
-                            if row['last_update_hash_id'] is None:
-                                last_failed = True
-                                if (datetime.datetime.now() - datetime.datetime.strptime(row['updated_at'], DATETIME_FORMAT)).total_seconds() > RETRY_FAILED_MIN_SECONDS:
-                                    last_failed_more_then_10_minutes = True
-                                    for tmprow in db.rows_iterator(
-                                        "select hash_id from url_update_history where url_id=%s order by updated_at desc limit 5",
-                                        (row['url_id'],)
-                                    ):
-                                        if tmprow['hash_id'] is None:
-                                            num_consecutive_failures += 1
-                                        else:
-                                            break
-                            is_failed_bucket = last_failed and last_failed_more_then_10_minutes and num_consecutive_failures
-                            if bucket_type == 'failed':
-                                if is_failed_bucket:
-                                    ok_to_write = True
-                            elif not is_failed_bucket:
-                                if (
-                                        row['last_successful_updated_at']
-                                        and row['update_freq_minutes']
-                                        and (datetime.datetime.now() - datetime.datetime.strptime(row['last_successful_updated_at'], DATETIME_FORMAT)).total_seconds() / 60 > row['update_freq_minutes']
-                                ):
-                                    ok_to_write = True
-                    if ok_to_write:
-                        f.write('%s %s\n' % (row['url_id'], row['url']))
-
-                Flow(
-                    load(os.path.join(queue_directory, 'filtered_collection_urls', 'datapackage.json')),
-                    fill_bucket
-                ).process()
+    if FETCH_COLUMNAR_SNAPSHOT:
+        return fetch_snapshot(queue_type, queue_directory)
+    with fetch_phase('fetch_all'):
+        app_stats, all_collection_ids, domain_stats = fetch_all_collection_urls(queue_directory)
+    with fetch_phase('filter'):
+        filter_collection_urls(queue_directory, domain_stats, **get_queue_type_filters(queue_type))
+
+    with fetch_phase('partition'):
+        bucket_filenames = partition_buckets(queue_directory)
     bucket_files = {}
-    all_url_ids = set()
+    bucket_depths = defaultdict(int)
+    # bitmap indexed by url_id of the urls which were added to the queue
+    all_url_ids = bytearray()
+    queue_writer = queuefile.open_queue_writer(queue_directory)
     try:
-        for bucket_type in ['new', 'update', 'failed']:
-            for collection_id in all_collection_ids:
-                bucket_files[bucket_type + str(collection_id)] = open(os.path.join(queue_directory, 'buckets', bucket_type, str(collection_id) + '.txt'))
-        with open(os.path.join(queue_directory, 'queue.txt'), 'w') as f:
+        with fetch_phase('write_queue'):
+            for bucket_type in BUCKET_TYPES:
+                for collection_id in all_collection_ids:
+                    if (bucket_type, collection_id) in bucket_filenames:
+                        bucket_files[(bucket_type, collection_id)] = open(bucket_filenames[(bucket_type, collection_id)])
             while len(bucket_files) > 0:
                 for key in list(bucket_files.keys()):
                     line = bucket_files[key].readline()
@@ -347,14 +355,284 @@ def fetch(queue_type, queue_directory):
                         bucket_files[key].close()
                         del bucket_files[key]
                     else:
-                        url_id = int(line.split(' ')[0])
-                        if url_id not in all_url_ids:
-                            all_url_ids.add(url_id)
-                            f.write(line)
+                        url_id, url = line.rstrip('\n').split(' ', 1)
+                        if queuefile.bitmap_set(all_url_ids, int(url_id)):
+                            queuefile.queue_writer_append(queue_writer, url_id, url)
+                            bucket_depths[key[0]] += 1
     finally:
         for file in bucket_files.values():
             file.close()
-    return app_stats, len(all_url_ids)
+        queuefile.close_queue_writer(queue_writer)
+    set_queue_depth_metrics(queue_type, bucket_depths)
+    return app_stats, queue_writer['len']
+
+
+def get_url_domain(url):
+    return url.split('://')[1].split('/')[0]
+
+
+def get_urlobj(tmpdir, url_id, url, timeout_seconds, etag=None, last_modified=None, partial_directory=None, **kwargs):
+    # url object for download.download
+    # if partial_directory is set, the download is kept there if it fails and resumed on the next attempt (stored uncompressed)
+    return dict(
+        url_id=int(url_id),
+        url=url,
+        output_filename=os.path.join(partial_directory or tmpdir, str(url_id) + ".output"),
+        content_encoding=None if partial_directory else storage.OUTPUT_COMPRESSION,
+        resumable=bool(partial_directory),
+        timeout_seconds=timeout_seconds,
+        etag=etag,
+        last_modified=last_modified,
+        **kwargs
+    )
+
+
+def create_timings():
+    if DOWNLOAD_ADAPTIVE_TIMEOUTS:
+        return timing.create_timings()
+    else:
+        return None
+
+
+def set_adaptive_timeouts(timings, urlobj, expected_size_bytes=None, expected_total_seconds=None):
+    if timings is not None:
+        urlobj['connect_timeout_seconds'], urlobj['stall_timeout_seconds'], urlobj['timeout_seconds'] = timing.get_timeouts(
+            timings, get_url_domain(urlobj['url']), DOWNLOAD_CONNECT_TIMEOUT, urlobj['timeout_seconds'], MAX_TIMEOUT_SECONDS,
+            expected_size_bytes, expected_total_seconds
+        )
+    return urlobj
+
+
+def create_controller(concurrent_connections, result_writer):
+    if DOWNLOAD_ADAPTIVE_CONCURRENCY:
+        controller = concurrency.create_controller(
+            concurrent_connections, DOWNLOAD_DOMAIN_THROTTLE_SECONDS,
+            lambda: results.writer_backlog(result_writer) > results.MAX_BACKLOG_RESULTS / 2
+        )
+        metrics.set_gauge_function('downloader_concurrency_limit', lambda: int(controller['limit']))
+        return controller
+    else:
+        return None
+
+
+def push_throttled(domain_throttle, urlobj, resolver=None):
+    domain = urlobj['domain'] = get_url_domain(urlobj['url'])
+    throttle.throttle_push(domain_throttle, domain, urlobj)
+    if resolver is not None:
+        resolve.resolver_prefetch(resolver, [domain])
+
+
+def iterate_throttled(domain_throttle, refill, stats, resolver=None, controller=None):
+    # yields url objects from the throttle, or if no domain is ready to start a download -
+    # the seconds until the next domain is ready (None if the throttle is empty and refill may add more urls)
+    # refill is called before each item to add url objects to the throttle, it returns False when there are no more urls
+    # with a concurrency controller, the domain limits and intervals of the controller are used
+    if controller is not None:
+        domain_ready, domain_interval = partial(concurrency.domain_ready, controller), partial(concurrency.domain_interval, controller)
+    else:
+        domain_ready, domain_interval = None, None
+    metrics.set_gauge_function('downloader_pending_urls', lambda: throttle.throttle_len(domain_throttle))
+    has_more = True
+    while True:
+        if has_more:
+            with profiling.span('download.refill', profiling.HOT_SPAN_MIN_SECONDS):
+                has_more = refill()
+        urlobj = throttle.throttle_pop(domain_throttle, time.time(), domain_ready, domain_interval)
+        if urlobj is not None:
+            if resolver is not None:
+                urlobj['resolve'] = resolve.get_resolve_entries(resolver, urlobj['url'])
+            yield urlobj
+        elif throttle.throttle_len(domain_throttle) > 0:
+            # number of times there were free connections but no domain was ready to start a download
+            stats['skipped_due_to_domain_start_time'] += 1
+            yield throttle.throttle_wait_seconds(domain_throttle, time.time())
+        elif has_more:
+            yield None
+        else:
+            break
+
+
+def get_queue_iterator(queue_directory, queue_file, progress, tmpdir, timeout_seconds, stats, max_downloads=None, resolver=None,
+                       partial_directory=None, timings=None, controller=None):
+    # lazily reads the queue file, urls which were already downloaded according to the progress bitmap are skipped
+    validators = load_validators(queue_directory)
+    domain_throttle = throttle.create_throttle(DOWNLOAD_DOMAIN_THROTTLE_SECONDS)
+    read_position = 0
+    # queue positions of urls which were deferred because their domain had the max pending urls, by domain
+    deferred = {}
+    num_deferred = 0
+    next_deferred_check_time = 0
+
+    def _push(position, url_id, url):
+        push_throttled(domain_throttle, set_adaptive_timeouts(timings, get_urlobj(
+            tmpdir, url_id, url, timeout_seconds, *validators.get(url_id, (None, None)),
+            partial_directory=partial_directory, queue_position=position
+        )), resolver)
+
+    def _push_deferred():
+        nonlocal num_deferred
+        for domain in list(deferred.keys()):
+            positions = deferred[domain]
+            while len(positions) > 0 and throttle.throttle_domain_len(domain_throttle, domain) < DOWNLOAD_MAX_PENDING_URLS_PER_DOMAIN:
+                position = positions.popleft()
+                num_deferred -= 1
+                _push(position, *queuefile.queue_get(queue_file, position))
+            if len(positions) == 0:
+                del deferred[domain]
+
+    def _refill():
+        nonlocal read_position, num_deferred, next_deferred_check_time
+        if timings is not None:
+            timing.refresh_timings(timings)
+        if len(deferred) > 0 and time.time() >= next_deferred_check_time:
+            _push_deferred()
+            next_deferred_check_time = time.time() + DOWNLOAD_DEFERRED_CHECK_SECONDS
+        while throttle.throttle_len(domain_throttle) < DOWNLOAD_MAX_PENDING_URLS and num_deferred < DOWNLOAD_MAX_DEFERRED_URLS:
+            if read_position >= queuefile.queue_len(queue_file):
+                return len(deferred) > 0
+            stats['total_read_lines'] += 1
+            if not queuefile.bitmap_get(progress, read_position):
+                url_id, url = queuefile.queue_get(queue_file, read_position)
+                domain = get_url_domain(url)
+                if domain in deferred or throttle.throttle_domain_len(domain_throttle, domain) >= DOWNLOAD_MAX_PENDING_URLS_PER_DOMAIN:
+                    deferred.setdefault(domain, deque()).append(read_position)
+                    num_deferred += 1
+                else:
+                    _push(read_position, url_id, url)
+            read_position += 1
+        return True
+
+    num_started = 0
+    for urlobj in iterate_throttled(domain_throttle, _refill, stats, resolver, controller):
+        if max_downloads and num_started >= int(max_downloads):
+            break
+        if isinstance(urlobj, dict):
+            num_started += 1
+        yield urlobj
+
+
+def get_download_iterator(queue_type, tmpdir, worker_id, stats, batch_size=WORKER_DEFAULT_BATCH_SIZE, resolver=None,
+                          partial_directory=None, timings=None, controller=None):
+    # endless iterator of due urls, claimed as leases in batches whenever the pending urls drop below batch_size
+    timeout_seconds = MAX_TIMEOUT_SECONDS if queue_type == 'timedout' else MIN_TIMEOUT_SECONDS
+    domain_throttle = throttle.create_throttle(DOWNLOAD_DOMAIN_THROTTLE_SECONDS)
+    next_claim_time = 0
+    # leases of urls which were not started because their lease might expire, released on the next refill
+    expired_url_ids = []
+
+    def _refill():
+        nonlocal next_claim_time
+        if len(expired_url_ids) > 0:
+            lease.release_urls(expired_url_ids, worker_id)
+            del expired_url_ids[:]
+        if throttle.throttle_len(domain_throttle) < batch_size and time.time() >= next_claim_time:
+            if timings is not None:
+                timing.refresh_timings(timings)
+            rows = lease.claim(worker_id, batch_size, timeout_seconds, **get_claim_filters(queue_type))
+            claimed_at = time.time()
+            for row in rows:
+                push_throttled(domain_throttle, set_adaptive_timeouts(timings, get_urlobj(
+                    tmpdir, row['url_id'], row['url'], row['timeout_seconds'], row['etag'], row['last_modified'],
+                    partial_directory=partial_directory, worker_id=worker_id,
+                    lease_expires_at=claimed_at + row['timeout_seconds'] + lease.LEASE_EXTRA_SECONDS
+                ), row['expected_size_bytes'], row['expected_total_seconds']), resolver)
+            stats['num_claimed_urls'] += len(rows)
+            if len(rows) < batch_size:
+                next_claim_time = claimed_at + DOWNLOAD_ITERATOR_CLAIM_IDLE_SECONDS
+        return True
+
+    for urlobj in iterate_throttled(domain_throttle, _refill, stats, resolver, controller):
+        if isinstance(urlobj, dict) and time.time() + urlobj['timeout_seconds'] > urlobj['lease_expires_at']:
+            # waited too long for its domain, the lease might expire before the download completes
+            # it's released so that it can be claimed again immediately (possibly by another worker)
+            stats['num_expired_lease_urls'] += 1
+            expired_url_ids.append(urlobj['url_id'])
+        else:
+            yield urlobj
+
+
+def get_partial_directory(queue_type, output_directory):
+    # urls in the timedout queue are resumed from their partial download on the next attempt
+    if queue_type == 'timedout':
+        return storage.get_partial_directory(output_directory)
+    else:
+        return None
+
+
+def create_pre_resolver():
+    if DOWNLOAD_PRE_RESOLVE:
+        resolver = resolve.create_resolver()
+        resolve.resolver_prefetch_due_domains(resolver)
+        return resolver
+    else:
+        return None
+
+
+def save_result_metrics(urlobj, result):
+    metrics.inc('downloader_completed_total', result=result)
+    timings = urlobj.get('timings')
+    if timings is not None:
+        metrics.inc('downloader_downloaded_bytes_total', timings['downloaded_bytes'])
+        metrics.observe('downloader_transfer_seconds', timings['total_seconds'])
+        if timings['first_byte_seconds'] > 0:
+            metrics.observe('downloader_domain_first_byte_seconds', timings['first_byte_seconds'],
+                            domain=metrics.get_domain_label(get_url_domain(urlobj['url'])))
+
+
+def get_timedout_seconds(urlobj):
+    # the elapsed time of transfers which were aborted before the total timeout by the connect or stall timeout,
+    # so that urls which failed fast don't move to the timedout queue due to a raised adaptive total timeout
+    timings = urlobj.get('timings')
+    if timings is None:
+        return urlobj['timeout_seconds']
+    return min(urlobj['timeout_seconds'], int(math.ceil(timings['total_seconds'])))
+
+
+def get_save_result(result_writer, stats):
+    # save_result callback for download.download which passes the results to the results writer
+
+    def _save_result(urlobj, response_code=None, errno=None, errmsg=None):
+        is_timeout = errno == pycurl.E_OPERATION_TIMEDOUT
+        now = datetime.datetime.now().astimezone()
+        hash = urlobj.get('hash')
+        size_bytes = urlobj.get('size_bytes', 0)
+        response_validators = urlobj.get('validators') or {}
+        not_modified = errno is None and response_code == 304
+        # 206 - a resumed partial download, the hash and size are of the full content
+        if errno is None and (response_code == 200 or (response_code == 206 and urlobj.get('resume_offset'))):
+            if size_bytes == 0:
+                hash = None
+        elif not_modified:
+            hash = None
+            stats['num_not_modified_urls'] += 1
+        else:
+            hash = None
+            if is_timeout:
+                stats['num_timeout_urls'] += 1
+            else:
+                stats['num_error_urls'] += 1
+        stats['num_processed'] += 1
+        save_result_metrics(urlobj, 'ok' if hash else 'not_modified' if not_modified else 'timeout' if is_timeout else 'error')
+        results.writer_put(result_writer, {
+            'url_id': urlobj['url_id'],
+            'queue_position': urlobj.get('queue_position'),
+            'worker_id': urlobj.get('worker_id'),
+            'updated_at': now,
+            'hash': hash,
+            'size_bytes': size_bytes,
+            'output_filename': None if urlobj.get('partial_saved') else urlobj['output_filename'],
+            'download_path': storage.get_download_path(hash, size_bytes, urlobj.get('content_encoding')) if hash else None,
+            'content_encoding': urlobj.get('content_encoding'),
+            'error': errmsg,
+            'error_code': errno or response_code,
+            'timedout_seconds': get_timedout_seconds(urlobj) if is_timeout else None,
+            'not_modified': not_modified,
+            'etag': response_validators.get('etag'),
+            'last_modified': response_validators.get('last_modified'),
+            'timings': urlobj.get('timings'),
+        })
+
+    return _save_result
 
 
 def download(queue_type, queue_directory, output_directory, concurrent_connections, max_downloads=None):
@@ -362,201 +640,126 @@ def download(queue_type, queue_directory, output_directory, concurrent_connectio
         timeout_seconds = MAX_TIMEOUT_SECONDS
     else:
         timeout_seconds = MIN_TIMEOUT_SECONDS
-    # We should ignore SIGPIPE when using pycurl.NOSIGNAL - see
-    # the libcurl tutorial for more info.
-    signal.signal(SIGPIPE, SIG_IGN)
-    m = pycurl.CurlMulti()
-    m.handles = []
-    for i in range(int(concurrent_connections)):
-        c = pycurl.Curl()
-        c.fp = None
-        c.setopt(pycurl.FOLLOWLOCATION, 1)
-        c.setopt(pycurl.MAXREDIRS, DOWNLOAD_MAX_REDIRECTS)
-        c.setopt(pycurl.CONNECTTIMEOUT, DOWNLOAD_CONNECT_TIMEOUT)
-        c.setopt(pycurl.TIMEOUT, int(timeout_seconds))
-        c.setopt(pycurl.NOSIGNAL, 1)
-        m.handles.append(c)
     start_time = datetime.datetime.now()
-    try:
-        while True:
-            num_processed = 0
-            reached_max_downloads = False
-            total_read_lines = 0
-            domains_last_start_times = {}
-            skipped_due_to_domain_start_time = 0
-            total_stats = {
-                'num_existing_hash_id': 0,
-                'num_new_hash_id': 0,
-                'num_error_urls': 0,
-                'num_timeout_urls': 0
-            }
-            freelist = m.handles[:]
-            eof = False
-            downloaded_url_ids = set()
-            if os.path.exists(os.path.join(queue_directory, 'output.txt')):
-                with open(os.path.join(queue_directory, 'output.txt')) as f:
-                    for line in f:
-                        downloaded_url_ids.add(int(line.strip()))
-            with open(os.path.join(queue_directory, 'output.txt'), 'a') as output_file:
-                with tempfile.TemporaryDirectory() as tmpdir:
-
-                    def save_result(url, url_id, errno=None, errmsg=None, response_code=None):
-                        is_timeout = errno == pycurl.E_OPERATION_TIMEDOUT
-                        now = datetime.datetime.now()
-                        url_relative_output_dir = os.path.join(
-                            str(now.year), str(now.month), str(now.day), str(now.hour), str(now.minute), str(url_id)
-                        )
-                        url_output_dir = os.path.join(output_directory, url_relative_output_dir)
-                        url_relative_output_filename = os.path.join(url_relative_output_dir, "output")
-                        output_filename = os.path.join(tmpdir, str(url_id), "output")
-                        header_filename = os.path.join(tmpdir, str(url_id), "header")
-                        hash_id = None
-                        if errno is None and response_code == 200:
-                            filesize = os.path.getsize(output_filename)
-                            if filesize > 0:
-                                hasher = hashlib.sha256()
-                                with open(output_filename, 'rb') as f:
-                                    buf = f.read(HASH_BLOCKSIZE)
-                                    while len(buf) > 0:
-                                        hasher.update(buf)
-                                        buf = f.read(HASH_BLOCKSIZE)
-                                hash = hasher.hexdigest()
-                                try:
-                                    db.execute(
-                                        "insert into hash (hash, size_bytes, download_path, downloaded_at) values (%s, %s, %s, %s)",
-                                        (hash, filesize, url_relative_output_filename, datetime.datetime.now().strftime(DATETIME_FORMAT))
-                                    )
-                                    total_stats['num_new_hash_id'] += 1
-                                    os.makedirs(url_output_dir)
-                                    os.rename(output_filename, os.path.join(output_directory, url_relative_output_filename))
-                                except db.UniqueViolation:
-                                    total_stats['num_existing_hash_id'] += 1
-                                    os.unlink(output_filename)
-                                hash_id = db.only_one("select id from hash where hash=%s and size_bytes=%s", (hash, filesize))['id']
-                        else:
-                            if is_timeout:
-                                total_stats['num_timeout_urls'] += 1
-                            else:
-                                total_stats['num_error_urls'] += 1
-                            os.unlink(output_filename)
-                        os.unlink(header_filename)
-                        os.rmdir(os.path.join(tmpdir, str(url_id)))
-                        url_update_history_id = db.only_one(
-                            "insert into url_update_history (url_id, updated_at, hash_id, error, error_code, timedout_seconds) values (%s, %s, %s, %s, %s, %s) RETURNING id",
-                            (url_id, datetime.datetime.now().strftime(DATETIME_FORMAT), hash_id, errmsg, errno or response_code, timeout_seconds if is_timeout else None)
-                        )['id']
-                        try:
-                            db.execute("insert into url_last_update (url_id, url_update_history_id) values (%s, %s)", (url_id, url_update_history_id))
-                        except db.UniqueViolation:
-                            db.execute("update url_last_update set url_update_history_id=%s where url_id=%s", (url_update_history_id, url_id))
-                        if hash_id:
-                            try:
-                                db.execute("insert into url_last_successful_update (url_id, url_update_history_id) values (%s, %s)", (url_id, url_update_history_id))
-                            except db.UniqueViolation:
-                                db.execute("update url_last_successful_update set url_update_history_id=%s where url_id=%s", (url_update_history_id, url_id))
-                        output_file.write(str(url_id) + "\n")
-
-                    with open(os.path.join(queue_directory, 'queue.txt')) as queue_file:
-                        while True:
-                            while freelist and not eof:
-                                line = queue_file.readline()
-                                if line == '':
-                                    eof = True
-                                else:
-                                    total_read_lines += 1
-                                    tmp = line.strip().split(" ")
-                                    url_id, url = tmp[0], ' '.join(tmp[1:])
-                                    if int(url_id) not in downloaded_url_ids:
-                                        domain = url.split('://')[1].split('/')[0]
-                                        domain_last_start_time = domains_last_start_times.get(domain, None)
-                                        now = datetime.datetime.now()
-                                        if not domain_last_start_time or (now - domain_last_start_time).total_seconds() >= DOWNLOAD_DOMAIN_THROTTLE_SECONDS:
-                                            domains_last_start_times[domain] = now
-                                            c = freelist.pop()
-                                            os.mkdir(os.path.join(tmpdir, str(url_id)))
-                                            c.fp = open(os.path.join(tmpdir, str(url_id), "output"), "wb")
-                                            c.hfp = open(os.path.join(tmpdir, str(url_id), "header"), "wb")
-                                            c.setopt(pycurl.URL, url)
-                                            c.setopt(pycurl.WRITEDATA, c.fp)
-                                            c.setopt(pycurl.WRITEHEADER, c.hfp)
-                                            m.add_handle(c)
-                                            c.url_id = url_id
-                                            c.url = url
-                                        else:
-                                            skipped_due_to_domain_start_time += 1
-                            while True:
-                                ret, num_handles = m.perform()
-                                if ret != pycurl.E_CALL_MULTI_PERFORM:
-                                    break
-                            while True:
-                                num_q, ok_list, err_list = m.info_read()
-                                for c in ok_list:
-                                    c.fp.close()
-                                    c.fp = None
-                                    c.hfp.close()
-                                    c.hfp = None
-                                    m.remove_handle(c)
-                                    save_result(c.url, c.url_id, response_code=c.getinfo(pycurl.RESPONSE_CODE))
-                                    freelist.append(c)
-                                for c, errno, errmsg in err_list:
-                                    c.fp.close()
-                                    c.fp = None
-                                    c.hfp.close()
-                                    c.hfp = None
-                                    m.remove_handle(c)
-                                    save_result(c.url, c.url_id, errno=errno, errmsg=errmsg)
-                                    freelist.append(c)
-                                num_processed = num_processed + len(ok_list) + len(err_list)
-                                if max_downloads and num_processed >= int(max_downloads):
-                                    reached_max_downloads = True
-                                    break
-                                if num_q == 0:
-                                    break
-                            if num_q == 0 and num_handles == 0 and eof:
-                                break
-                            if max_downloads and num_processed >= int(max_downloads):
-                                reached_max_downloads = True
-                                break
-                            m.select(1.0)
-            if len(downloaded_url_ids) == total_read_lines:
-                break
-            elif (start_time - datetime.datetime.now()).total_seconds() > MAX_DOWNLOAD_RUNTIME_SECONDS:
-                break
-            else:
-                time.sleep(DOWNLOAD_ITERATIONS_SLEEP_SECONDS)
-    finally:
-        for c in m.handles:
-            if getattr(c, 'fp', None) is not None:
-                c.fp.close()
-                c.fp = None
-            if getattr(c, 'hfp', None) is not None:
-                c.hfp.close()
-                c.hfp = None
-            c.close()
-        m.close()
+    while True:
+        total_stats = defaultdict(int)
+        queue_file = queuefile.open_queue(queue_directory)
+        progress = queuefile.open_progress(queue_directory, queuefile.queue_len(queue_file))
+        num_already_downloaded = queuefile.bitmap_count(progress)
+        resolver = create_pre_resolver()
+        timings = create_timings()
+        try:
+            with storage.create_tmp_directory(output_directory) as tmpdir:
+
+                def on_saved(saved_results):
+                    for result in saved_results:
+                        queuefile.bitmap_set(progress, result['queue_position'])
+                    progress.flush()
+
+                result_writer = results.start_writer(output_directory, on_saved=on_saved)
+                controller = create_controller(concurrent_connections, result_writer)
+                try:
+                    engine.download(
+                        int(concurrent_connections),
+                        get_queue_iterator(queue_directory, queue_file, progress, tmpdir, timeout_seconds, total_stats, max_downloads, resolver,
+                                           get_partial_directory(queue_type, output_directory), timings, controller),
+                        get_save_result(result_writer, total_stats),
+                        max_redirects=DOWNLOAD_MAX_REDIRECTS,
+                        connect_timeout_seconds=DOWNLOAD_CONNECT_TIMEOUT,
+                        timeout_seconds=timeout_seconds,
+                        controller=controller
+                    )
+                finally:
+                    results.stop_writer(result_writer)
+                    for k, v in result_writer['stats'].items():
+                        total_stats[k] += v
+        finally:
+            queuefile.close_progress(progress)
+            queuefile.close_queue(queue_file)
+            if resolver is not None:
+                resolve.close_resolver(resolver)
+        reached_max_downloads = bool(max_downloads and total_stats['num_processed'] >= int(max_downloads))
+        if num_already_downloaded == total_stats['total_read_lines'] or reached_max_downloads:
+            break
+        elif (start_time - datetime.datetime.now()).total_seconds() > MAX_DOWNLOAD_RUNTIME_SECONDS:
+            break
+        else:
+            time.sleep(DOWNLOAD_ITERATIONS_SLEEP_SECONDS)
     return (
-        len(downloaded_url_ids), num_processed, reached_max_downloads, total_read_lines, skipped_due_to_domain_start_time,
-        total_stats['num_existing_hash_id'], total_stats['num_new_hash_id'], total_stats['num_error_urls'], total_stats['num_timeout_urls']
+        num_already_downloaded, total_stats['num_processed'], reached_max_downloads, total_stats['total_read_lines'],
+        total_stats['skipped_due_to_domain_start_time'], total_stats['num_existing_hash_id'], total_stats['num_new_hash_id'],
+        total_stats['num_error_urls'], total_stats['num_timeout_urls']
     )
 
 
+def start_metrics():
+    metrics.start(rates={
+        'downloader_completed_total': 'completed_per_second',
+        'downloader_downloaded_bytes_total': 'bytes_per_second',
+    })
+
+
 def daemon(queue_type, queue_directory, output_directory, concurrent_connections):
     if queue_type not in ['samedomain', 'timedout', 'regular']:
         raise Exception('invalid queue_type: ' + queue_type)
     elif os.path.exists(queue_directory):
         raise Exception('queue_directory already exists: ' + queue_directory)
     else:
+        if FETCH_COLUMNAR_SNAPSHOT:
+            snapshot.check_numpy()
+        start_metrics()
         try:
             while True:
-                app_stats, len_all_url_ids = fetch(queue_type, queue_directory)
-                print('fetched ' + str(len_all_url_ids) + ' urls')
-                (
-                    num_already_downloaded, num_processed, reached_max_downloads, total_read_lines, skipped_due_to_domain_start_time,
-                    num_existing_hash_id, num_new_hash_id, num_error_urls, num_timeout_urls
-                ) = download(queue_type, queue_directory, output_directory, concurrent_connections)
+                with profiling.trace_cycle('daemon-' + queue_type):
+                    with cycle_phase('fetch'):
+                        app_stats, len_all_url_ids = fetch(queue_type, queue_directory)
+                    print('fetched ' + str(len_all_url_ids) + ' urls')
+                    with cycle_phase('download'):
+                        (
+                            num_already_downloaded, num_processed, reached_max_downloads, total_read_lines, skipped_due_to_domain_start_time,
+                            num_existing_hash_id, num_new_hash_id, num_error_urls, num_timeout_urls
+                        ) = download(queue_type, queue_directory, output_directory, concurrent_connections)
+                metrics.inc('downloader_skipped_due_to_domain_start_time_total', skipped_due_to_domain_start_time)
                 print('downloaded ' + str(total_read_lines) + ' urls')
                 shutil.rmtree(queue_directory)
                 time.sleep(DAEMON_SLEEP_TIME_SECONDS)
         finally:
             if os.path.exists(queue_directory):
                 shutil.rmtree(queue_directory)
+
+
+def worker(queue_type, queue_directory, output_directory, concurrent_connections,
+           batch_size=WORKER_DEFAULT_BATCH_SIZE, worker_id=None):
+    # like daemon, but continuously claims leases on due urls so that multiple workers can run on different machines
+    if queue_type not in WORKER_QUEUE_TYPES:
+        raise Exception('invalid queue_type: ' + queue_type)
+    elif os.path.exists(queue_directory):
+        raise Exception('queue_directory already exists: ' + queue_directory)
+    else:
+        if not worker_id:
+            worker_id = lease.get_worker_id()
+        os.mkdir(queue_directory)
+        start_metrics()
+        resolver = create_pre_resolver()
+        try:
+            stats = defaultdict(int)
+            with storage.create_tmp_directory(output_directory) as tmpdir:
+                result_writer = results.start_writer(output_directory)
+                controller = create_controller(concurrent_connections, result_writer)
+                try:
+                    engine.download(
+                        int(concurrent_connections),
+                        get_download_iterator(queue_type, tmpdir, worker_id, stats, int(batch_size), resolver,
+                                              get_partial_directory(queue_type, output_directory), create_timings(), controller),
+                        get_save_result(result_writer, stats),
+                        max_redirects=DOWNLOAD_MAX_REDIRECTS,
+                        connect_timeout_seconds=DOWNLOAD_CONNECT_TIMEOUT,
+                        controller=controller
+                    )
+                finally:
+                    results.stop_writer(result_writer)
+        finally:
+            lease.release(worker_id)
+            shutil.rmtree(queue_directory)
+            if resolver is not None:
+                resolve.close_resolver(resolver)
@@ -0,0 +1,111 @@
+import os
+import mmap
+import struct
+
+
+# binary queue directory files:
+# queue.idx - fixed width records of (url_id, url offset, url length), the record number is the queue position
+# queue.urls - utf-8 encoded urls referenced by the index records
+# progress.bin - bitmap indexed by queue position, a set bit marks a url which download result was saved
+# queue.idx and queue.urls are memory-mapped so resuming a queue doesn't depend on the queue size
+
+QUEUE_INDEX_FILENAME = 'queue.idx'
+QUEUE_URLS_FILENAME = 'queue.urls'
+PROGRESS_FILENAME = 'progress.bin'
+
+INDEX_RECORD = struct.Struct('<qqi')
+
+BITMAP_POPCOUNT = bytes(bin(i).count('1') for i in range(256))
+
+
+def open_queue_writer(queue_directory):
+    return {
+        'index': open(os.path.join(queue_directory, QUEUE_INDEX_FILENAME), 'wb'),
+        'urls': open(os.path.join(queue_directory, QUEUE_URLS_FILENAME), 'wb'),
+        'offset': 0,
+        'len': 0,
+    }
+
+
+def queue_writer_append(writer, url_id, url):
+    data = url.encode()
+    writer['index'].write(INDEX_RECORD.pack(int(url_id), writer['offset'], len(data)))
+    writer['urls'].write(data)
+    writer['offset'] += len(data)
+    writer['len'] += 1
+
+
+def close_queue_writer(writer):
+    writer['index'].close()
+    writer['urls'].close()
+
+
+def _mmap_file(filename, write=False):
+    with open(filename, 'r+b' if write else 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # empty files can't be memory-mapped
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if write else mmap.ACCESS_READ)
+
+
+def open_queue(queue_directory):
+    index = _mmap_file(os.path.join(queue_directory, QUEUE_INDEX_FILENAME))
+    return {
+        'index': index,
+        'urls': _mmap_file(os.path.join(queue_directory, QUEUE_URLS_FILENAME)) if index is not None else None,
+        'len': len(index) // INDEX_RECORD.size if index is not None else 0,
+    }
+
+
+def queue_len(queue):
+    return queue['len']
+
+
+def queue_get(queue, position):
+    url_id, offset, length = INDEX_RECORD.unpack_from(queue['index'], position * INDEX_RECORD.size)
+    return url_id, queue['urls'][offset:offset + length].decode()
+
+
+def close_queue(queue):
+    for k in ['index', 'urls']:
+        if queue[k] is not None:
+            queue[k].close()
+
+
+def open_progress(queue_directory, num_positions):
+    # returns a writable memory-mapped bitmap, existing progress is kept to resume the queue
+    filename = os.path.join(queue_directory, PROGRESS_FILENAME)
+    size = max(1, (num_positions + 7) // 8)
+    with open(filename, 'ab') as f:
+        if f.tell() < size:
+            f.truncate(size)
+    return _mmap_file(filename, write=True)
+
+
+def close_progress(progress):
+    progress.flush()
+    progress.close()
+
+
+def bitmap_get(bitmap, i):
+    byte = i >> 3
+    return byte < len(bitmap) and bitmap[byte] & (1 << (i & 7)) != 0
+
+
+def bitmap_set(bitmap, i):
+    # returns True if the bit wasn't set before, bytearray bitmaps are extended as needed
+    byte, bit = i >> 3, 1 << (i & 7)
+    if byte >= len(bitmap):
+        bitmap.extend(bytes(byte + 1 - len(bitmap)))
+    if bitmap[byte] & bit:
+        return False
+    else:
+        bitmap[byte] |= bit
+        return True
+
+
+def bitmap_count(bitmap, chunk_size=1024*1024):
+    return sum(
+        sum(bitmap[start:start + chunk_size].translate(BITMAP_POPCOUNT))
+        for start in range(0, len(bitmap), chunk_size)
+    )
@@ -0,0 +1,85 @@
+import time
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from . import db
+
+
+# resolves domains in background threads before their urls are downloaded
+# the addresses are passed to curl (RESOLVE option) so transfers don't wait for DNS
+# RESOLVE entries are kept permanently in the shared curl DNS cache, so when a host is re-resolved after RESOLVE_TTL_SECONDS
+# with different addresses, the previous entry is removed by a '-HOST:PORT' entry
+
+RESOLVE_THREADS = 8
+RESOLVE_TTL_SECONDS = 300
+PREFETCH_MAX_DUE_DOMAINS = 10000
+
+
+def create_resolver(threads=RESOLVE_THREADS):
+    return {
+        'executor': ThreadPoolExecutor(threads),
+        'hosts': {},
+        # addresses of the RESOLVE entry which was last passed to curl, by HOST:PORT
+        'entries': {},
+    }
+
+
+def _resolve_host(host):
+    # all the A / AAAA addresses, curl falls back to the next address if connecting fails
+    addresses = []
+    for family, type, proto, canonname, sockaddr in socket.getaddrinfo(host, None, type=socket.SOCK_STREAM):
+        if sockaddr[0] not in addresses:
+            addresses.append(sockaddr[0])
+    return addresses
+
+
+def resolver_prefetch(resolver, domains):
+    for domain in domains:
+        host = urlsplit('//' + domain).hostname
+        if host:
+            resolved = resolver['hosts'].get(host)
+            if resolved is None or resolved['time'] + RESOLVE_TTL_SECONDS < time.time():
+                resolver['hosts'][host] = {'future': resolver['executor'].submit(_resolve_host, host), 'time': time.time()}
+
+
+def resolver_prefetch_due_domains(resolver, max_domains=PREFETCH_MAX_DUE_DOMAINS):
+    # domains with most due urls are resolved first
+    resolver_prefetch(resolver, [row['domain'] for row in db.rows_iterator("""
+        select domain.domain
+        from
+            url_schedule
+            join url on url.id = url_schedule.url_id
+            join domain on domain.id = url.domain_id
+        where url_schedule.next_due_at <= now()
+        group by domain.domain
+        order by count(*) desc
+        limit %s
+    """, (max_domains,))])
+
+
+def get_resolve_entries(resolver, url):
+    # returns curl RESOLVE option entries for the url, or an empty list if the host was not resolved (yet)
+    # multiple addresses in a single entry require libcurl >= 7.59
+    parts = urlsplit(url)
+    resolved = resolver['hosts'].get(parts.hostname)
+    if resolved is None or not resolved['future'].done():
+        return []
+    host_port = '%s:%s' % (parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+    if resolved['future'].exception() is None:
+        addresses = ','.join('[%s]' % address if ':' in address else address for address in resolved['future'].result())
+    else:
+        addresses = None
+    entries = []
+    previous_addresses = resolver['entries'].get(host_port)
+    if previous_addresses is not None and previous_addresses != addresses:
+        entries.append('-' + host_port)
+    if addresses:
+        entries.append('%s:%s' % (host_port, addresses))
+        resolver['entries'][host_port] = addresses
+    else:
+        resolver['entries'].pop(host_port, None)
+    return entries
+
+
+def close_resolver(resolver):
+    resolver['executor'].shutdown(wait=False)
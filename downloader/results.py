@@ -0,0 +1,224 @@
+import os
+import time
+import datetime
+import threading
+from queue import Queue, Empty, Full
+from collections import defaultdict, OrderedDict
+from . import db
+from . import schedule
+from . import lease
+from . import storage
+from . import timing
+from . import metrics
+from . import profiling
+
+
+FLUSH_MAX_RESULTS = 500
+FLUSH_INTERVAL_SECONDS = 2
+MAX_BACKLOG_RESULTS = 10000
+
+RETRY_FAILED_MIN_SECONDS = 600  # retry delay after first failure, doubled on each consecutive failure
+RETRY_FAILED_MAX_SECONDS = 60*60*24*7
+
+
+def _save_hashes(results, stats):
+    # sets the hash id of the results, returns the files of newly inserted hashes and their download paths
+    # the files are moved to the output directory by save_results after the transaction is committed
+    hash_results = OrderedDict()
+    for result in results:
+        if result['hash'] is not None:
+            hash_results.setdefault((result['hash'], result['size_bytes']), result)
+    hash_ids = {}
+    new_files = []
+    if len(hash_results) > 0:
+        for row in db.execute_values(
+            "insert into hash (hash, size_bytes, download_path, downloaded_at, content_encoding) values %s on conflict do nothing returning id, hash, size_bytes",
+            [(hash, size_bytes, result['download_path'], result['updated_at'], result.get('content_encoding'))
+             for (hash, size_bytes), result in hash_results.items()],
+            fetch=True
+        ):
+            hash_ids[(row['hash'], row['size_bytes'])] = row['id']
+        for key, result in hash_results.items():
+            if key in hash_ids:
+                stats['num_new_hash_id'] += 1
+                new_files.append((result['output_filename'], result['download_path']))
+                result['output_filename'] = None
+        existing_keys = [key for key in hash_results if key not in hash_ids]
+        if len(existing_keys) > 0:
+            for row in db.execute_values(
+                "select id, hash, size_bytes from hash where (hash, size_bytes) in (values %s)",
+                existing_keys, fetch=True
+            ):
+                hash_ids[(row['hash'], row['size_bytes'])] = row['id']
+    previous_hashes = {}
+    not_modified_url_ids = [result['url_id'] for result in results if result.get('not_modified')]
+    if len(not_modified_url_ids) > 0:
+        # not modified responses reuse the hash and validators of the last successful update
+        for row in db.rows_iterator("""
+            select url_last_successful_update.url_id, url_update_history.hash_id,
+                   url_last_successful_update.etag, url_last_successful_update.last_modified
+            from url_last_successful_update
+            join url_update_history on url_update_history.id = url_last_successful_update.url_update_history_id
+            where url_last_successful_update.url_id = any(%s)
+        """, (not_modified_url_ids,)):
+            previous_hashes[row['url_id']] = row
+    for result in results:
+        if result['hash'] is not None:
+            if result['output_filename'] is not None:
+                stats['num_existing_hash_id'] += 1
+            result['hash_id'] = hash_ids.get((result['hash'], result['size_bytes']))
+        elif result.get('not_modified') and result['url_id'] in previous_hashes:
+            previous_hash = previous_hashes[result['url_id']]
+            result['hash_id'] = previous_hash['hash_id']
+            result['etag'] = result.get('etag') or previous_hash['etag']
+            result['last_modified'] = result.get('last_modified') or previous_hash['last_modified']
+        else:
+            result['hash_id'] = None
+    return new_files
+
+
+def _last_results_per_url(results):
+    # upserts can't affect the same row twice in one statement, so only the last result of each url is used
+    last_results = OrderedDict()
+    for result in results:
+        last_results[result['url_id']] = result
+    return list(last_results.values())
+
+
+def save_results(results, output_directory):
+    stats = defaultdict(int)
+    with db.transaction():
+        with profiling.span('results.save_hashes'):
+            new_files = _save_hashes(results, stats)
+        for result, row in zip(results, db.execute_values(
+            "insert into url_update_history (url_id, updated_at, hash_id, error, error_code, timedout_seconds, "
+            "connect_seconds, first_byte_seconds, total_seconds) values %s returning id",
+            [(result['url_id'], result['updated_at'], result['hash_id'],
+              result['error'], result['error_code'], result['timedout_seconds'],
+              *[(result.get('timings') or {}).get(name) for name in ['connect_seconds', 'first_byte_seconds', 'total_seconds']])
+             for result in results],
+            fetch=True
+        )):
+            result['url_update_history_id'] = row['id']
+        last_results = _last_results_per_url(results)
+        # maintains the consecutive failures streak and the exponential backoff retry time of failed urls
+        db.execute_values("""
+            insert into url_last_update (url_id, url_update_history_id, consecutive_failures, next_retry_at)
+            values %s
+            on conflict (url_id) do update set
+                url_update_history_id = excluded.url_update_history_id,
+                consecutive_failures = case when excluded.consecutive_failures = 0 then 0 else url_last_update.consecutive_failures + 1 end,
+                next_retry_at = case when excluded.consecutive_failures = 0 then null else
+                    (select updated_at from url_update_history where id = excluded.url_update_history_id)
+                    + make_interval(secs => least({retry_min_seconds} * power(2, least(url_last_update.consecutive_failures, 30)), {retry_max_seconds}))
+                end
+        """.format(retry_min_seconds=RETRY_FAILED_MIN_SECONDS, retry_max_seconds=RETRY_FAILED_MAX_SECONDS), [
+            (
+                result['url_id'], result['url_update_history_id'],
+                0 if result['hash_id'] else 1,
+                None if result['hash_id'] else result['updated_at'] + datetime.timedelta(seconds=RETRY_FAILED_MIN_SECONDS)
+            ) for result in last_results
+        ])
+        successful_results = [result for result in last_results if result['hash_id']]
+        if len(successful_results) > 0:
+            db.execute_values(
+                "insert into url_last_successful_update (url_id, url_update_history_id, etag, last_modified) values %s "
+                "on conflict (url_id) do update set url_update_history_id=excluded.url_update_history_id, "
+                "etag=excluded.etag, last_modified=excluded.last_modified",
+                [(result['url_id'], result['url_update_history_id'], result.get('etag'), result.get('last_modified'))
+                 for result in successful_results]
+            )
+        with profiling.span('results.save_timings'):
+            timing.save_timings(results)
+        with profiling.span('results.refresh_schedule'):
+            schedule.refresh(result['url_id'] for result in last_results)
+        # results of urls claimed by workers (see queue.get_download_iterator) complete their leases
+        worker_url_ids = defaultdict(list)
+        for result in last_results:
+            if result.get('worker_id'):
+                worker_url_ids[result['worker_id']].append(result['url_id'])
+        for worker_id, url_ids in worker_url_ids.items():
+            lease.complete(url_ids, worker_id)
+    # files are moved only after commit, so a rolled back transaction doesn't leave files without a hash row
+    for filename, download_path in new_files:
+        storage.store_file(output_directory, filename, download_path)
+    for result in results:
+        if result.get('output_filename') is not None and os.path.exists(result['output_filename']):
+            os.unlink(result['output_filename'])
+    return stats
+
+
+def _writer_thread(writer):
+    stopped = False
+    while not stopped:
+        results = []
+        flush_time = None
+        while len(results) < FLUSH_MAX_RESULTS:
+            try:
+                if flush_time is None:
+                    result = writer['queue'].get()
+                else:
+                    result = writer['queue'].get(timeout=max(0, flush_time - time.time()))
+            except Empty:
+                break
+            if result is None:
+                stopped = True
+                break
+            results.append(result)
+            if flush_time is None:
+                flush_time = time.time() + FLUSH_INTERVAL_SECONDS
+        if len(results) > 0:
+            try:
+                with metrics.timer('downloader_db_write_seconds'), profiling.span('results.save', num_results=len(results)):
+                    save_stats = save_results(results, writer['output_directory'])
+                metrics.inc('downloader_saved_results_total', len(results))
+                metrics.inc('downloader_hashes_total', save_stats['num_new_hash_id'], hash='new')
+                metrics.inc('downloader_hashes_total', save_stats['num_existing_hash_id'], hash='existing')
+                for k, v in save_stats.items():
+                    writer['stats'][k] += v
+                if writer['on_saved'] is not None:
+                    writer['on_saved'](results)
+            except Exception as e:
+                writer['error'] = e
+                return
+
+
+def start_writer(output_directory, on_saved=None):
+    # results are saved in batches from a separate thread so that saving doesn't block the running transfers
+    writer = {
+        'output_directory': output_directory,
+        'on_saved': on_saved,
+        'queue': Queue(maxsize=MAX_BACKLOG_RESULTS),
+        'stats': defaultdict(int),
+        'error': None,
+    }
+    writer['thread'] = threading.Thread(target=_writer_thread, args=(writer,), daemon=True)
+    writer['thread'].start()
+    metrics.set_gauge_function('downloader_results_writer_backlog', lambda: writer_backlog(writer))
+    return writer
+
+
+def _raise_writer_error(writer):
+    if writer['error'] is not None:
+        raise Exception('failed to save results') from writer['error']
+
+
+def writer_put(writer, result):
+    while True:
+        _raise_writer_error(writer)
+        try:
+            writer['queue'].put(result, timeout=1)
+            break
+        except Full:
+            pass
+
+
+def writer_backlog(writer):
+    return writer['queue'].qsize()
+
+
+def stop_writer(writer):
+    if writer['thread'].is_alive():
+        writer_put(writer, None)
+        writer['thread'].join()
+    _raise_writer_error(writer)
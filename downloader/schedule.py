@@ -0,0 +1,48 @@
+from . import db
+
+
+def _refresh(where_sql, params):
+    # next_due_at is computed from the url's last update and the minimal update frequency of all its collections:
+    # new urls are due now, failed urls are due on their retry time and successful urls are due after the update frequency
+    # urls which don't need to be updated or don't belong to any collection (e.g. left by a rejected import row) have next_due_at = null
+    db.execute("""
+        insert into url_schedule (url_id, next_due_at)
+        select
+            url.id,
+            case
+                when freq.num_collections = 0 then null
+                when url_last_update.url_id is null then now()
+                when last_update.hash_id is null then coalesce(url_last_update.next_retry_at, last_update.updated_at)
+                when freq.update_freq_minutes > 0 then last_successful_update.updated_at + make_interval(mins => freq.update_freq_minutes)
+                else null
+            end
+        from
+            url
+            left join url_last_update on url_last_update.url_id = url.id
+            left join url_update_history last_update on last_update.id = url_last_update.url_update_history_id
+            left join url_last_successful_update on url_last_successful_update.url_id = url.id
+            left join url_update_history last_successful_update on last_successful_update.id = url_last_successful_update.url_update_history_id
+            left join lateral (
+                select
+                    min(collection_url.update_freq_minutes) filter (where collection_url.update_freq_minutes > 0) update_freq_minutes,
+                    count(1) num_collections
+                from collection_url where collection_url.url_id = url.id
+            ) freq on true
+        where {}
+        on conflict (url_id) do update set next_due_at = excluded.next_due_at
+    """.format(where_sql), params)
+
+
+def refresh(url_ids):
+    url_ids = list(url_ids)
+    if len(url_ids) > 0:
+        _refresh('url.id = any(%(url_ids)s)', {'url_ids': url_ids})
+
+
+def refresh_unscheduled():
+    _refresh('not exists (select 1 from url_schedule where url_schedule.url_id = url.id)', {})
+    # urls which were scheduled before urls without a collection were excluded
+    db.execute("""
+        update url_schedule set next_due_at = null
+        where next_due_at is not null and not exists (select 1 from collection_url where collection_url.url_id = url_schedule.url_id)
+    """)
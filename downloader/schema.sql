@@ -41,14 +41,14 @@ CREATE TABLE IF NOT EXISTS hash (
   hash TEXT NOT NULL,
   size_bytes INTEGER NOT NULL,
   download_path TEXT UNIQUE NOT NULL,
-  downloaded_at TEXT NOT NULL,
+  downloaded_at TIMESTAMPTZ NOT NULL,
   UNIQUE (hash, size_bytes)
 );
 
 CREATE TABLE IF NOT EXISTS url_update_history (
   id SERIAL PRIMARY KEY,
   url_id INTEGER NOT NULL,
-  updated_at TEXT NOT NULL,
+  updated_at TIMESTAMPTZ NOT NULL,
   hash_id INTEGER,
   error TEXT,
   error_code INTEGER,
@@ -111,6 +111,56 @@ CREATE TABLE IF NOT EXISTS url_tag (
 CREATE TABLE IF NOT EXISTS queue (
   url_id INTEGER UNIQUE NOT NULL,
   timeout_seconds INTEGER NOT NULL,
-  added_at TEXT NOT NULL,
+  added_at TIMESTAMPTZ NOT NULL,
   status TEXT NOT NULL
 );
+
+ALTER TABLE url_last_update ADD COLUMN IF NOT EXISTS consecutive_failures INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE url_last_update ADD COLUMN IF NOT EXISTS next_retry_at TIMESTAMPTZ;
+
+-- backfill the failure streak for urls which failed before the column was added
+UPDATE url_last_update SET consecutive_failures = (
+  SELECT count(1) FROM url_update_history
+  WHERE url_update_history.url_id = url_last_update.url_id
+  AND url_update_history.id > coalesce((
+    SELECT url_update_history_id FROM url_last_successful_update
+    WHERE url_last_successful_update.url_id = url_last_update.url_id
+  ), 0)
+)
+WHERE consecutive_failures = 0 AND url_update_history_id IN (
+  SELECT id FROM url_update_history WHERE hash_id IS NULL
+);
+
+CREATE TABLE IF NOT EXISTS url_schedule (
+  url_id INTEGER PRIMARY KEY,
+  next_due_at TIMESTAMPTZ,
+  FOREIGN KEY (url_id) REFERENCES url (id)
+);
+
+CREATE INDEX IF NOT EXISTS url_schedule_next_due_at ON url_schedule (next_due_at) WHERE next_due_at IS NOT NULL;
+
+ALTER TABLE url_last_successful_update ADD COLUMN IF NOT EXISTS etag TEXT;
+ALTER TABLE url_last_successful_update ADD COLUMN IF NOT EXISTS last_modified TEXT;
+
+ALTER TABLE queue ADD COLUMN IF NOT EXISTS worker TEXT;
+
+ALTER TABLE hash ADD COLUMN IF NOT EXISTS content_encoding TEXT;
+
+ALTER TABLE url_update_history ADD COLUMN IF NOT EXISTS connect_seconds REAL;
+ALTER TABLE url_update_history ADD COLUMN IF NOT EXISTS first_byte_seconds REAL;
+ALTER TABLE url_update_history ADD COLUMN IF NOT EXISTS total_seconds REAL;
+
+CREATE TABLE IF NOT EXISTS domain_timing (
+  domain_id INTEGER PRIMARY KEY,
+  connect_seconds REAL,
+  connect_seconds_deviation REAL,
+  first_byte_seconds REAL,
+  first_byte_seconds_deviation REAL,
+  bytes_per_second REAL,
+  size_bytes REAL,
+  num_samples INTEGER NOT NULL,
+  updated_at TIMESTAMPTZ NOT NULL,
+  FOREIGN KEY (domain_id) REFERENCES domain (id)
+);
+
+CREATE INDEX IF NOT EXISTS collection_url_collection_id_id ON collection_url (collection_id, id);
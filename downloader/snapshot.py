@@ -0,0 +1,155 @@
+from array import array
+from collections import defaultdict
+from . import db
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# compact in-memory columnar snapshot of the due collection urls
+# each column is a typed array with one item per collection url, urls are kept in a single string table
+# used instead of the dataflows csv files to filter and order the queue with vectorized numpy operations
+
+BUCKET_TYPES = ['new', 'update', 'failed']
+
+NULL_EPOCH = -1
+
+
+def check_numpy():
+    if np is None:
+        raise Exception('numpy is required for the columnar snapshot, install it with: pip install -e .[columnar]')
+
+
+def create_snapshot():
+    check_numpy()
+    created_at = int(db.only_one('select extract(epoch from now())::bigint created_at')['created_at'])
+    columns = {
+        'collection_id': array('i'),
+        'url_id': array('i'),
+        'domain_id': array('i'),
+        'bucket_type': array('b'),
+        'updated_at': array('q'),
+        'timedout_seconds': array('i'),
+    }
+    url_offsets = array('q', [0])
+    urls = bytearray()
+    validators = {}
+    # bucket_type is the index in BUCKET_TYPES, see queue.get_row_bucket_type
+    for (
+        collection_id, url_id, domain_id, url, bucket_type, updated_at, timedout_seconds, etag, last_modified
+    ) in db.rows_stream("""
+        select
+            collection_url.collection_id,
+            url.id,
+            url.domain_id,
+            url.url,
+            case
+                when url_update_history.id is null then 0
+                when url_update_history.hash_id is not null then 1
+                else 2
+            end,
+            extract(epoch from url_update_history.updated_at)::bigint,
+            url_update_history.timedout_seconds,
+            url_last_successful_update.etag,
+            url_last_successful_update.last_modified
+        from
+            url_schedule
+            join collection_url on collection_url.url_id = url_schedule.url_id
+            join url on url.id = collection_url.url_id
+            left join url_last_update on url_last_update.url_id = url.id
+            left join url_update_history on url_update_history.id = url_last_update.url_update_history_id
+            left join url_last_successful_update on url_last_successful_update.url_id = url.id
+        where
+            url_schedule.next_due_at <= now()
+    """):
+        columns['collection_id'].append(collection_id)
+        columns['url_id'].append(url_id)
+        columns['domain_id'].append(domain_id)
+        columns['bucket_type'].append(bucket_type)
+        columns['updated_at'].append(NULL_EPOCH if updated_at is None else updated_at)
+        columns['timedout_seconds'].append(timedout_seconds or 0)
+        urls += url.encode()
+        url_offsets.append(len(urls))
+        if bucket_type == 1 and (etag or last_modified):
+            validators[url_id] = (etag, last_modified)
+    snapshot = {k: np.frombuffer(v, dtype=v.typecode) if len(v) > 0 else np.zeros(0, dtype=v.typecode)
+                for k, v in columns.items()}
+    snapshot.update({
+        'created_at': created_at,
+        'url_offsets': url_offsets,
+        'urls': bytes(urls),
+        'validators': validators,
+        'collections': {row['id']: (row['app_name'], row['collection_name']) for row in db.rows_iterator("""
+            select collection.id, app.name app_name, collection.name collection_name
+            from collection join app on app.id = collection.app_id
+        """)},
+    })
+    return snapshot
+
+
+def snapshot_len(snapshot):
+    return len(snapshot['url_id'])
+
+
+def snapshot_url(snapshot, i):
+    return snapshot['urls'][snapshot['url_offsets'][i]:snapshot['url_offsets'][i + 1]].decode()
+
+
+def get_app_stats(snapshot):
+    app_stats = {}
+    collection_ids, counts = np.unique(snapshot['collection_id'], return_counts=True)
+    for collection_id, count in zip(collection_ids.tolist(), counts.tolist()):
+        app_name, collection_name = snapshot['collections'][collection_id]
+        app_stats.setdefault(app_name, defaultdict(int))[collection_name] += count
+    return app_stats
+
+
+def get_domain_stats(snapshot):
+    domain_ids, counts = np.unique(snapshot['domain_id'], return_counts=True)
+    return defaultdict(int, zip(domain_ids.tolist(), counts.tolist()))
+
+
+def filter_snapshot(snapshot, min_timeout_seconds=None, max_timeout_seconds=None,
+                    min_same_domains=None, max_same_domains=None,
+                    min_last_update_seconds=None):
+    # returns a boolean mask of the rows to keep, same conditions as queue.filter_collection_urls
+    mask = np.ones(snapshot_len(snapshot), dtype=bool)
+    timeout_seconds = snapshot['timedout_seconds']
+    if min_timeout_seconds is not None:
+        mask &= timeout_seconds >= min_timeout_seconds
+    if max_timeout_seconds is not None:
+        mask &= timeout_seconds <= max_timeout_seconds
+    if min_same_domains is not None or max_same_domains is not None:
+        _, inverse, counts = np.unique(snapshot['domain_id'], return_inverse=True, return_counts=True)
+        num_same_domain = counts[inverse]
+        if min_same_domains is not None:
+            mask &= num_same_domain >= min_same_domains
+        if max_same_domains is not None:
+            mask &= num_same_domain <= max_same_domains
+    if min_last_update_seconds is not None:
+        updated_at = snapshot['updated_at']
+        mask &= (updated_at == NULL_EPOCH) | (snapshot['created_at'] - updated_at >= min_last_update_seconds)
+    return mask
+
+
+def get_queue_order(snapshot, mask):
+    # returns the row indexes of the queue, ordered round-robin between the (bucket_type, collection_id) buckets
+    # each url appears once, in the first bucket it was reached from
+    rows = np.flatnonzero(mask)
+    if len(rows) == 0:
+        return rows
+    bucket_types = snapshot['bucket_type'][rows]
+    collection_ids = snapshot['collection_id'][rows]
+    rows = rows[np.lexsort((rows, collection_ids, bucket_types))]
+    bucket_types = snapshot['bucket_type'][rows]
+    collection_ids = snapshot['collection_id'][rows]
+    bucket_starts = np.ones(len(rows), dtype=bool)
+    bucket_starts[1:] = (bucket_types[1:] != bucket_types[:-1]) | (collection_ids[1:] != collection_ids[:-1])
+    bucket_index = np.cumsum(bucket_starts) - 1
+    # position of each row inside its bucket
+    bucket_rank = np.arange(len(rows)) - np.flatnonzero(bucket_starts)[bucket_index]
+    rows = rows[np.lexsort((bucket_index, bucket_rank))]
+    _, first_rows = np.unique(snapshot['url_id'][rows], return_index=True)
+    return rows[np.sort(first_rows)]
@@ -0,0 +1,142 @@
+import os
+import gzip
+import tempfile
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# downloaded files can be stored compressed in the output directory, the hash and size are of the decoded content
+# the content encoding of each file is stored in hash.content_encoding (null for uncompressed files)
+
+OUTPUT_COMPRESSION = os.environ.get('DOWNLOADER_OUTPUT_COMPRESSION') or None  # gzip / zstd
+
+CONTENT_ENCODING_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+GZIP_COMPRESS_LEVEL = 6
+ZSTD_COMPRESS_LEVEL = 3
+
+READ_CHUNK_SIZE = 64*1024
+
+# downloaded files are stored by content: sha256/<hash[0:2]>/<hash[2:4]>/<hash>-<size_bytes>[.gz|.zst]
+# new files are downloaded to TMP_DIRECTORY_NAME inside the output directory and renamed to their final path
+STORE_DIRECTORY_NAME = 'sha256'
+TMP_DIRECTORY_NAME = '.tmp'
+PARTIAL_DIRECTORY_NAME = '.partial'  # partial downloads which can be resumed
+PARTIAL_MAX_AGE_SECONDS = 60*60*24*7
+MIGRATE_BATCH_SIZE = 1000
+
+
+def _verify_content_encoding(content_encoding):
+    if content_encoding not in CONTENT_ENCODING_EXTENSIONS:
+        raise Exception('unsupported content encoding: ' + content_encoding)
+    elif content_encoding == 'zstd' and zstandard is None:
+        raise Exception('zstandard is required for zstd content encoding (pip install zstandard)')
+
+
+def get_extension(content_encoding):
+    return CONTENT_ENCODING_EXTENSIONS[content_encoding] if content_encoding else ''
+
+
+def open_writer(filename, content_encoding=None):
+    # returns a binary file object which compresses the written content
+    if not content_encoding:
+        return open(filename, 'wb')
+    _verify_content_encoding(content_encoding)
+    if content_encoding == 'gzip':
+        return gzip.open(filename, 'wb', compresslevel=GZIP_COMPRESS_LEVEL)
+    else:
+        return zstandard.ZstdCompressor(level=ZSTD_COMPRESS_LEVEL).stream_writer(open(filename, 'wb'))
+
+
+def open_reader(filename, content_encoding=None):
+    # returns a binary file object which reads the decoded content
+    if not content_encoding:
+        return open(filename, 'rb')
+    _verify_content_encoding(content_encoding)
+    if content_encoding == 'gzip':
+        return gzip.open(filename, 'rb')
+    else:
+        return zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'))
+
+
+def iterate_chunks(f, chunk_size=READ_CHUNK_SIZE):
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
+
+
+def get_download_path(hash, size_bytes, content_encoding=None):
+    return os.path.join(STORE_DIRECTORY_NAME, hash[:2], hash[2:4], '%s-%s%s' % (hash, size_bytes, get_extension(content_encoding)))
+
+
+def create_tmp_directory(output_directory):
+    # temporary directory on the same filesystem as the output directory, so that files can be moved atomically
+    os.makedirs(os.path.join(output_directory, TMP_DIRECTORY_NAME), exist_ok=True)
+    return tempfile.TemporaryDirectory(dir=os.path.join(output_directory, TMP_DIRECTORY_NAME))
+
+
+def get_partial_directory(output_directory):
+    # partial downloads which were not resumed for PARTIAL_MAX_AGE_SECONDS are deleted
+    partial_directory = os.path.join(output_directory, PARTIAL_DIRECTORY_NAME)
+    os.makedirs(partial_directory, exist_ok=True)
+    for entry in os.scandir(partial_directory):
+        if entry.stat().st_mtime + PARTIAL_MAX_AGE_SECONDS < time.time():
+            os.unlink(entry.path)
+    return partial_directory
+
+
+def store_file(output_directory, filename, download_path):
+    output_filename = os.path.join(output_directory, download_path)
+    os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+    os.replace(filename, output_filename)
+
+
+def _remove_empty_directories(output_directory, path):
+    # removes the empty parent directories of the old per-minute layout
+    path = os.path.dirname(path)
+    while path:
+        try:
+            os.rmdir(os.path.join(output_directory, path))
+        except OSError:
+            break
+        path = os.path.dirname(path)
+
+
+def migrate(output_directory, batch_size=MIGRATE_BATCH_SIZE):
+    # moves existing files to the content addressed layout and updates hash.download_path
+    # safe to run while downloading and to run again if interrupted
+    from . import db
+    stats = {'num_migrated': 0, 'num_already_migrated': 0, 'num_missing_files': 0}
+    last_id = 0
+    while True:
+        rows = list(db.rows_iterator(
+            'select id, hash, size_bytes, download_path, content_encoding from hash where id > %s order by id limit %s',
+            (last_id, batch_size)
+        ))
+        if len(rows) == 0:
+            break
+        for row in rows:
+            last_id = row['id']
+            download_path = get_download_path(row['hash'], row['size_bytes'], row['content_encoding'])
+            if row['download_path'] == download_path:
+                stats['num_already_migrated'] += 1
+                continue
+            old_filename = os.path.join(output_directory, row['download_path'])
+            if os.path.exists(old_filename):
+                store_file(output_directory, old_filename, download_path)
+                _remove_empty_directories(output_directory, row['download_path'])
+            elif not os.path.exists(os.path.join(output_directory, download_path)):
+                stats['num_missing_files'] += 1
+                continue
+            db.execute('update hash set download_path = %s where id = %s', (download_path, row['id']))
+            stats['num_migrated'] += 1
+    return stats
@@ -0,0 +1,68 @@
+import heapq
+from collections import deque
+
+
+# per-domain FIFOs of pending items in a heap keyed by the time each domain is allowed to start its next item
+
+
+def create_throttle(domain_interval_seconds):
+    return {
+        'interval': domain_interval_seconds,
+        'domains': {},
+        'heap': [],
+        'seq': 0,
+        'size': 0,
+    }
+
+
+def _heap_push(throttle, domain):
+    throttle['seq'] += 1
+    heapq.heappush(throttle['heap'], (throttle['domains'][domain]['ready_at'], throttle['seq'], domain))
+
+
+def throttle_push(throttle, domain, item):
+    domain_items = throttle['domains'].get(domain)
+    if domain_items is None:
+        domain_items = throttle['domains'][domain] = {'items': deque(), 'ready_at': 0}
+    domain_items['items'].append(item)
+    throttle['size'] += 1
+    if len(domain_items['items']) == 1:
+        _heap_push(throttle, domain)
+
+
+def throttle_pop(throttle, now, domain_ready=None, domain_interval=None):
+    # returns the next item of the earliest ready domain, or None if no domain is ready
+    # domain_ready - optional callback, domains which are not ready are postponed by the interval
+    # domain_interval - optional callback, returns the interval of a domain instead of the throttle interval
+    while len(throttle['heap']) > 0 and throttle['heap'][0][0] <= now:
+        ready_at, seq, domain = heapq.heappop(throttle['heap'])
+        domain_items = throttle['domains'][domain]
+        interval = throttle['interval'] if domain_interval is None else domain_interval(domain)
+        if domain_ready is not None and not domain_ready(domain):
+            domain_items['ready_at'] = now + interval
+            _heap_push(throttle, domain)
+            continue
+        item = domain_items['items'].popleft()
+        throttle['size'] -= 1
+        domain_items['ready_at'] = now + interval
+        if len(domain_items['items']) > 0:
+            _heap_push(throttle, domain)
+        return item
+    return None
+
+
+def throttle_wait_seconds(throttle, now):
+    # seconds until the next domain is ready, None if there are no pending items
+    if len(throttle['heap']) > 0:
+        return max(0, throttle['heap'][0][0] - now)
+    else:
+        return None
+
+
+def throttle_len(throttle):
+    return throttle['size']
+
+
+def throttle_domain_len(throttle, domain):
+    domain_items = throttle['domains'].get(domain)
+    return len(domain_items['items']) if domain_items is not None else 0
@@ -0,0 +1,122 @@
+import time
+from . import db
+
+
+# per domain estimates of the connect time, time to first byte and throughput, learned from the curl timing info of each result
+# like the TCP retransmission timeout, each estimate is a smoothed average and mean deviation, and a timeout is average + 4 deviations
+# the timeouts of a transfer are derived from the estimates of its domain and the expected size of the url (see get_timeouts)
+
+ESTIMATE_ALPHA = 0.125
+ESTIMATE_BETA = 0.25
+TIMEOUT_DEVIATIONS = 4
+MIN_SAMPLES = 5  # domains with less samples use the default timeouts
+MIN_THROUGHPUT_SAMPLE_BYTES = 64*1024  # smaller transfers measure the latency rather than the throughput
+SIZE_TIMEOUT_MARGIN = 2  # multiplies the expected time to transfer the expected size
+
+MIN_CONNECT_TIMEOUT_SECONDS = 3
+MIN_STALL_TIMEOUT_SECONDS = 5
+
+REFRESH_SECONDS = 300
+
+ESTIMATE_COLUMNS = [
+    'connect_seconds', 'connect_seconds_deviation', 'first_byte_seconds', 'first_byte_seconds_deviation',
+    'bytes_per_second', 'size_bytes', 'num_samples',
+]
+
+
+def create_timings():
+    return {'domains': {}, 'loaded_at': None}
+
+
+def refresh_timings(timings):
+    # loads the estimates of all domains with enough samples, reloaded every REFRESH_SECONDS
+    if timings['loaded_at'] is None or timings['loaded_at'] + REFRESH_SECONDS < time.time():
+        timings['domains'] = {row['domain']: row for row in db.rows_iterator("""
+            select domain.domain, {columns}
+            from domain_timing join domain on domain.id = domain_timing.domain_id
+            where domain_timing.num_samples >= %s
+        """.format(columns=', '.join('domain_timing.' + column for column in ESTIMATE_COLUMNS)), (MIN_SAMPLES,))}
+        timings['loaded_at'] = time.time()
+
+
+def _clamp(value, min_value, max_value):
+    return max(min_value, min(max_value, value))
+
+
+def get_timeouts(timings, domain, connect_timeout_seconds, timeout_seconds, max_timeout_seconds, expected_size_bytes=None,
+                 expected_total_seconds=None):
+    # returns (connect_timeout_seconds, stall_timeout_seconds, timeout_seconds) of a transfer
+    # connect_timeout_seconds and timeout_seconds are the defaults, used when the domain has no estimates
+    # dead hosts fail fast - the connect timeout and stall timeout (no data received) are lowered down to the domain estimates
+    # slow but healthy urls get more time - the total timeout is raised up to max_timeout_seconds according to the expected size
+    # the total timeout is never lowered, so that the timedout_seconds of a result keep their meaning for the queue types
+    estimate = timings['domains'].get(domain)
+    if estimate is None:
+        return connect_timeout_seconds, None, timeout_seconds
+    if estimate['connect_seconds'] is not None:
+        connect_timeout_seconds = _clamp(
+            estimate['connect_seconds'] + TIMEOUT_DEVIATIONS * estimate['connect_seconds_deviation'],
+            MIN_CONNECT_TIMEOUT_SECONDS, connect_timeout_seconds
+        )
+    stall_timeout_seconds = None
+    if estimate['first_byte_seconds'] is not None:
+        first_byte_timeout_seconds = estimate['first_byte_seconds'] + TIMEOUT_DEVIATIONS * estimate['first_byte_seconds_deviation']
+        stall_timeout_seconds = _clamp(first_byte_timeout_seconds, MIN_STALL_TIMEOUT_SECONDS, timeout_seconds)
+        expected_size_bytes = expected_size_bytes or estimate['size_bytes']
+        expected_seconds = expected_total_seconds or 0
+        if expected_size_bytes and estimate['bytes_per_second']:
+            expected_seconds = max(expected_seconds, expected_size_bytes / estimate['bytes_per_second'])
+        timeout_seconds = _clamp(first_byte_timeout_seconds + SIZE_TIMEOUT_MARGIN * expected_seconds, timeout_seconds, max_timeout_seconds)
+    return connect_timeout_seconds, stall_timeout_seconds, timeout_seconds
+
+
+def _update_estimate(estimate, name, sample):
+    if estimate[name] is None:
+        estimate[name], estimate[name + '_deviation'] = sample, sample / 2
+    else:
+        estimate[name + '_deviation'] = (1 - ESTIMATE_BETA) * estimate[name + '_deviation'] + ESTIMATE_BETA * abs(estimate[name] - sample)
+        estimate[name] = (1 - ESTIMATE_ALPHA) * estimate[name] + ESTIMATE_ALPHA * sample
+
+
+def _update_average(estimate, name, sample):
+    estimate[name] = sample if estimate[name] is None else (1 - ESTIMATE_ALPHA) * estimate[name] + ESTIMATE_ALPHA * sample
+
+
+def save_timings(results):
+    # updates the domain estimates from the timings of the results, called from results.save_results in the same transaction
+    results = [result for result in results if result.get('timings')]
+    if len(results) == 0:
+        return
+    url_domain_ids = {row['id']: row['domain_id'] for row in db.rows_iterator(
+        'select id, domain_id from url where id = any(%s)', ([result['url_id'] for result in results],)
+    )}
+    estimates = {row['domain_id']: dict(row) for row in db.rows_iterator(
+        'select domain_id, {columns} from domain_timing where domain_id = any(%s) order by domain_id for update'.format(
+            columns=', '.join(ESTIMATE_COLUMNS)
+        ), (list(set(url_domain_ids.values())),)
+    )}
+    for result in results:
+        domain_id = url_domain_ids[result['url_id']]
+        estimate = estimates.setdefault(domain_id, dict({column: None for column in ESTIMATE_COLUMNS}, domain_id=domain_id, num_samples=0))
+        timings = result['timings']
+        # connect time is 0 when an existing connection was reused
+        if timings['connect_seconds'] > 0:
+            _update_estimate(estimate, 'connect_seconds', timings['connect_seconds'])
+        if timings['first_byte_seconds'] > 0:
+            _update_estimate(estimate, 'first_byte_seconds', timings['first_byte_seconds'])
+        if result['error'] is None and result['hash'] is not None:
+            _update_average(estimate, 'size_bytes', result['size_bytes'])
+            transfer_seconds = timings['total_seconds'] - timings['first_byte_seconds']
+            if timings['downloaded_bytes'] >= MIN_THROUGHPUT_SAMPLE_BYTES and transfer_seconds > 0:
+                _update_average(estimate, 'bytes_per_second', timings['downloaded_bytes'] / transfer_seconds)
+        estimate['num_samples'] += 1
+    db.execute_values("""
+        insert into domain_timing (domain_id, {columns}, updated_at) values %s
+        on conflict (domain_id) do update set {updates}, updated_at = excluded.updated_at
+    """.format(
+        columns=', '.join(ESTIMATE_COLUMNS),
+        updates=', '.join('{column} = excluded.{column}'.format(column=column) for column in ESTIMATE_COLUMNS)
+    ), [
+        (estimate['domain_id'], *[estimate[column] for column in ESTIMATE_COLUMNS], max(result['updated_at'] for result in results))
+        for estimate in estimates.values()
+    ])
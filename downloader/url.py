@@ -1,7 +1,11 @@
 import json
+import io
+import datetime
+import csv
 from . import db
 from collections import OrderedDict
 from . import user
+from . import schedule
 import os
 
 
@@ -9,23 +13,17 @@ GET_URL_MAX_HISTORY_ITEMS = 100
 GET_URL_MAX_TAGS = 100
 SEARCH_URL_MAX_HISTORY_ITEMS = 10
 SEARCH_URL_MAX_TAGS = 10
+# search results are paged by collection_url.id, use the id of the last url as after_id of the next page
+SEARCH_URL_DEFAULT_LIMIT = 100
+SEARCH_URL_MAX_LIMIT = 1000
+IMPORT_BATCH_SIZE = 10000
 
 
 class UrlOrTitleAlreadyExistsInCollection(Exception):
     pass
 
 
-def add(app_name, url, extra_json=None, verify_username=None):
-    if extra_json is None:
-        extra = {}
-    else:
-        extra = json.loads(extra_json)
-    app_name = app_name.strip()
-    row = db.only_one('SELECT id FROM app WHERE name = %s', (app_name,))
-    if not row:
-        raise Exception('invalid app name')
-    app_id = row['id']
-    user.verify_user_app(verify_username, app_id)
+def _parse_url(url, extra):
     url = url.strip()
     title = extra.pop('title', url).strip()
     collection = extra.pop('collection', 'default').strip()
@@ -52,44 +50,190 @@ def add(app_name, url, extra_json=None, verify_username=None):
         raise Exception('all tags must be a string')
     else:
         domain = url.split('://')[1].split('/')[0]
-        try:
-            db.execute('insert into domain (domain) values (%s)', (domain,))
-        except db.UniqueViolation:
-            pass
-        domain_id = db.only_one('select id from domain where domain=%s', (domain,))['id']
-        try:
-            db.execute('insert into url (url, domain_id) values (%s, %s)', (url, domain_id))
-        except db.UniqueViolation:
-            pass
-        row = db.only_one('select id from url where url=%s', (url,))
+        return OrderedDict(
+            url=url,
+            domain=domain,
+            title=title,
+            collection=collection,
+            tags=tags,
+            metadata=metadata,
+            update_freq_minutes=update_freq_minutes
+        )
+
+
+def _get_app_id(app_name, verify_username):
+    app_name = app_name.strip()
+    row = db.only_one('SELECT id FROM app WHERE name = %s', (app_name,))
+    if not row:
+        raise Exception('invalid app name')
+    app_id = row['id']
+    user.verify_user_app(verify_username, app_id)
+    return app_id
+
+
+def add(app_name, url, extra_json=None, verify_username=None):
+    if extra_json is None:
+        extra = {}
+    else:
+        extra = json.loads(extra_json)
+    app_id = _get_app_id(app_name, verify_username)
+    parsed_url = _parse_url(url, extra)
+    with db.transaction():
+        db.execute('insert into domain (domain) values (%s) on conflict do nothing', (parsed_url['domain'],))
+        domain_id = db.only_one('select id from domain where domain=%s', (parsed_url['domain'],))['id']
+        db.execute('insert into url (url, domain_id) values (%s, %s) on conflict do nothing', (parsed_url['url'], domain_id))
+        row = db.only_one('select id from url where url=%s', (parsed_url['url'],))
         url_id = row['id']
-        try:
-            db.execute('insert into collection (app_id, name) values (%s, %s)', (app_id, collection))
-        except db.UniqueViolation:
-            pass
-        row = db.only_one('select id from collection where app_id=%s and name=%s', (app_id, collection))
+        db.execute('insert into collection (app_id, name) values (%s, %s) on conflict do nothing', (app_id, parsed_url['collection']))
+        row = db.only_one('select id from collection where app_id=%s and name=%s', (app_id, parsed_url['collection']))
         collection_id = row['id']
-        try:
-            db.execute(
-                'insert into collection_url (collection_id, url_id, title, metadata, update_freq_minutes) values (%s, %s, %s, %s, %s)',
-                (collection_id, url_id, title, json.dumps(metadata), update_freq_minutes)
-            )
-        except db.UniqueViolation:
+        row = db.only_one(
+            'insert into collection_url (collection_id, url_id, title, metadata, update_freq_minutes) values (%s, %s, %s, %s, %s) on conflict do nothing returning id',
+            (collection_id, url_id, parsed_url['title'], json.dumps(parsed_url['metadata']), parsed_url['update_freq_minutes'])
+        )
+        if not row:
             raise UrlOrTitleAlreadyExistsInCollection('URL or URL title already exists in the collection')
-        row = db.only_one('select id from collection_url where collection_id=%s and url_id=%s', (collection_id, url_id))
         collection_url_id = row['id']
-        db.execute('delete from url_tag where collection_url_id=%s', (collection_url_id,))
-        for tag, value in tags.items():
-            if not value:
-                continue
-            try:
-                db.execute('insert into tag (name) values (%s)', (tag,))
-            except db.UniqueViolation:
-                pass
-            row = db.only_one('select id from tag where name=%s', (tag,))
-            tag_id = row['id']
-            db.execute('insert into url_tag (collection_url_id, tag_id, value) values (%s, %s, %s)', (collection_url_id, tag_id, value))
-        return {'id': collection_url_id}
+        _set_tags(collection_url_id, parsed_url['tags'])
+        schedule.refresh([url_id])
+    return {'id': collection_url_id}
+
+
+def _get_import_conflicts(app_id, urls):
+    # row numbers of urls which conflict with existing collection urls or with previous rows of the batch
+    # conflicting rows are rejected before inserting anything, so they don't leave urls and domains without a collection url
+    existing_urls, existing_titles = set(), set()
+    for row in db.execute_values("""
+        select collection.name collection, url.url, collection_url.title
+        from (values %s) import_url (collection, url, title)
+        join collection on collection.app_id = {app_id} and collection.name = import_url.collection
+        join collection_url on collection_url.collection_id = collection.id
+        join url on url.id = collection_url.url_id
+        where url.url = import_url.url or collection_url.title = import_url.title
+    """.format(app_id=int(app_id)), [(parsed_url['collection'], parsed_url['url'], parsed_url['title']) for row_num, parsed_url in urls], fetch=True):
+        existing_urls.add((row['collection'], row['url']))
+        existing_titles.add((row['collection'], row['title']))
+    conflicts = set()
+    for row_num, parsed_url in urls:
+        collection_url, collection_title = (parsed_url['collection'], parsed_url['url']), (parsed_url['collection'], parsed_url['title'])
+        if collection_url in existing_urls or collection_title in existing_titles:
+            conflicts.add(row_num)
+        else:
+            existing_urls.add(collection_url)
+            existing_titles.add(collection_title)
+    return conflicts
+
+
+def _import_batch(app_id, urls, errors):
+    # errors - row numbers and errors of the batch's rows which failed parsing, yielded in row order with the imported rows
+    results = [OrderedDict(row=row_num, error=error) for row_num, error in errors]
+    with db.transaction():
+        conflicts = _get_import_conflicts(app_id, urls) if len(urls) > 0 else set()
+        urls = [(row_num, parsed_url) for row_num, parsed_url in urls if row_num not in conflicts]
+        if len(urls) > 0:
+            results += _import_rows(app_id, urls)
+    results += [OrderedDict(row=row_num, error='URL or URL title already exists in the collection') for row_num in conflicts]
+    return sorted(results, key=lambda result: result['row'])
+
+
+def _import_rows(app_id, urls):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row_num, parsed_url in urls:
+        writer.writerow([row_num, parsed_url['url'], parsed_url['domain'], parsed_url['title'], parsed_url['collection'],
+                         json.dumps(parsed_url['metadata']), parsed_url['update_freq_minutes'], json.dumps(parsed_url['tags'])])
+    buf.seek(0)
+    db.execute("""
+        create temporary table url_import (
+            row_num integer, url text, domain text, title text, collection text,
+            metadata text, update_freq_minutes integer, tags jsonb, collection_url_id integer
+        ) on commit drop
+    """)
+    # csv.writer writes empty strings as unquoted empty fields which copy reads as null, unless force_not_null
+    db.copy_expert("copy url_import (row_num, url, domain, title, collection, metadata, update_freq_minutes, tags) from stdin "
+                   "with (format csv, force_not_null (title, collection))", buf)
+    db.execute("insert into domain (domain) select distinct domain from url_import on conflict do nothing")
+    db.execute("""
+        insert into url (url, domain_id)
+        select distinct url_import.url, domain.id from url_import join domain on domain.domain = url_import.domain
+        on conflict do nothing
+    """)
+    db.execute("insert into collection (app_id, name) select distinct %s, collection from url_import on conflict do nothing", (app_id,))
+    # rows may still conflict with collection urls which were added concurrently, they are not matched to an inserted id
+    db.execute("""
+        with inserted as (
+            insert into collection_url (collection_id, url_id, title, metadata, update_freq_minutes)
+            select collection.id, url.id, url_import.title, url_import.metadata, url_import.update_freq_minutes
+            from url_import
+            join url on url.url = url_import.url
+            join collection on collection.app_id = %(app_id)s and collection.name = url_import.collection
+            order by url_import.row_num
+            on conflict do nothing
+            returning id, collection_id, url_id
+        )
+        update url_import set collection_url_id = inserted.id
+        from inserted, url, collection
+        where url.url = url_import.url
+        and collection.app_id = %(app_id)s and collection.name = url_import.collection
+        and inserted.collection_id = collection.id and inserted.url_id = url.id
+    """, {'app_id': app_id})
+    db.execute("""
+        insert into tag (name)
+        select distinct tags.key from url_import, jsonb_each_text(url_import.tags) tags
+        where url_import.collection_url_id is not null and tags.value != ''
+        on conflict do nothing
+    """)
+    db.execute("""
+        insert into url_tag (collection_url_id, tag_id, value)
+        select url_import.collection_url_id, tag.id, tags.value
+        from url_import, jsonb_each_text(url_import.tags) tags, tag
+        where url_import.collection_url_id is not null and tags.value != '' and tag.name = tags.key
+    """)
+    schedule.refresh(row['id'] for row in db.rows_iterator("""
+        select distinct url.id from url_import join url on url.url = url_import.url
+        where url_import.collection_url_id is not null
+    """))
+    return [
+        OrderedDict(row=row['row_num'], id=row['collection_url_id']) if row['collection_url_id']
+        else OrderedDict(row=row['row_num'], error='URL or URL title already exists in the collection')
+        for row in db.rows_iterator("select row_num, collection_url_id from url_import")
+    ]
+
+
+def import_urls(app_name, lines, verify_username=None):
+    # bulk version of add, each line is a json object with the url and the same attributes as add's extra_json
+    # results are yielded in row order, rows with errors are not imported
+    app_id = _get_app_id(app_name, verify_username)
+    urls, errors = [], []
+    for row_num, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            extra = json.loads(line)
+            if not isinstance(extra, dict):
+                raise Exception('row must be an object')
+            url = extra.pop('url', None)
+            if not isinstance(url, str):
+                raise Exception('url must be a string')
+            urls.append((row_num, _parse_url(url, extra)))
+        except Exception as e:
+            errors.append((row_num, str(e)))
+        if len(urls) >= IMPORT_BATCH_SIZE:
+            yield from _import_batch(app_id, urls, errors)
+            urls, errors = [], []
+    if len(urls) > 0 or len(errors) > 0:
+        yield from _import_batch(app_id, urls, errors)
+
+
+def _set_tags(collection_url_id, tags):
+    db.execute('delete from url_tag where collection_url_id=%s', (collection_url_id,))
+    for tag, value in tags.items():
+        if not value:
+            continue
+        db.execute('insert into tag (name) values (%s) on conflict do nothing', (tag,))
+        row = db.only_one('select id from tag where name=%s', (tag,))
+        tag_id = row['id']
+        db.execute('insert into url_tag (collection_url_id, tag_id, value) values (%s, %s, %s)', (collection_url_id, tag_id, value))
 
 
 def edit(collection_url_id, update_json, verify_username=None):
@@ -122,44 +266,53 @@ def edit(collection_url_id, update_json, verify_username=None):
         except Exception:
             raise Exception('invalid id')
         user.verify_user_app(verify_username, app_id)
-        if new_title:
-            try:
-                db.execute('update collection_url set title=%s where id=%s', (new_title, collection_url_id))
-            except db.UniqueViolation:
-                raise UrlOrTitleAlreadyExistsInCollection('new title already exists in collection')
-        if new_metadata:
-            db.execute('update collection_url set metadata=%s where id=%s', (json.dumps(new_metadata), collection_url_id))
-        if new_update_freq_minutes:
-            db.execute('update collection_url set update_freq_minutes=%s where id=%s', (new_update_freq_minutes, collection_url_id))
-        if new_tags:
-            db.execute('delete from url_tag where collection_url_id=%s', (collection_url_id,))
-            for tag, value in new_tags.items():
-                if not value: continue
+        with db.transaction():
+            if new_title:
                 try:
-                    db.execute('insert into tag (name) values (%s)', (tag,))
+                    db.execute('update collection_url set title=%s where id=%s', (new_title, collection_url_id))
                 except db.UniqueViolation:
-                    pass
-                row = db.only_one('select id from tag where name=%s', (tag,))
-                tag_id = row['id']
-                db.execute('insert into url_tag (collection_url_id, tag_id, value) values (%s, %s, %s)', (collection_url_id, tag_id, value))
+                    raise UrlOrTitleAlreadyExistsInCollection('new title already exists in collection')
+            if new_metadata:
+                db.execute('update collection_url set metadata=%s where id=%s', (json.dumps(new_metadata), collection_url_id))
+            if new_update_freq_minutes:
+                row = db.only_one('update collection_url set update_freq_minutes=%s where id=%s returning url_id', (new_update_freq_minutes, collection_url_id))
+                schedule.refresh([row['url_id']])
+            if new_tags:
+                _set_tags(collection_url_id, new_tags)
+
+
+def _format_datetime(value):
+    # standard datetime string in UTC timezone
+    return value.astimezone(datetime.timezone.utc).strftime(db.DATETIME_FORMAT) if value is not None else None
+
+
+def _get_download_url(collection_url_id, download_path, content_encoding):
+    # compressed files are linked to the REST API download endpoint which decodes them, if OUTPUT_API_URL_PREFIX is set
+    api_url_prefix = os.environ.get('OUTPUT_API_URL_PREFIX')
+    if content_encoding and api_url_prefix:
+        return '%s/url/download?id=%s' % (api_url_prefix.strip('/'), collection_url_id)
+    else:
+        return os.environ.get('OUTPUT_URL_PREFIX', '').strip('/') + '/' + download_path
 
 
 def _get_url(row, max_history_rows, max_tags_rows):
     collection_url_id = row['collection_url_id']
     url_id = row['url_id']
     url = OrderedDict(
+        id=collection_url_id,
         app=row['app_name'],
         collection=row['collection_name'],
         url=row['url'],
         title=row['title'],
         metadata=json.loads(row['metadata']),
         update_freq_minutes=row['update_freq_minutes'],
-        downloaded_at=row['last_successfull_downloaded_at'] if row['last_update_hash_id'] else None,
-        download_url=os.environ.get('OUTPUT_URL_PREFIX', '').strip('/') + '/' + row['last_successfull_download_path'] if
+        downloaded_at=_format_datetime(row['last_successfull_downloaded_at']) if row['last_update_hash_id'] else None,
+        download_url=_get_download_url(collection_url_id, row['last_successfull_download_path'], row['last_successfull_content_encoding']) if
         row['last_update_hash_id'] else None,
+        download_content_encoding=row['last_successfull_content_encoding'] if row['last_update_hash_id'] else None,
         downloaded_hash=row['last_successfull_hash'] if row['last_update_hash_id'] else None,
         downloaded_size_bytes=row['last_successfull_size_bytes'] if row['last_update_hash_id'] else None,
-        last_error_at=row['last_updated_at'] if not row['last_update_hash_id'] else None,
+        last_error_at=_format_datetime(row['last_updated_at']) if not row['last_update_hash_id'] else None,
         last_error=row['last_error'] if not row['last_update_hash_id'] else None,
         last_error_code=row['last_error_code'] if not row['last_update_hash_id'] else None,
         last_error_timedout_seconds=row['last_timedout_seconds'] if not row['last_update_hash_id'] else None
@@ -185,7 +338,7 @@ def _get_url(row, max_history_rows, max_tags_rows):
                                 limit %s
                             """, (url_id, max_history_rows)):
             url['history'].append(OrderedDict(
-                updated_at=row['updated_at'],
+                updated_at=_format_datetime(row['updated_at']),
                 download_path=row['download_path'],
                 size_bytes=row['size_bytes'],
                 hash=row['hash'],
@@ -206,9 +359,10 @@ def _get_url(row, max_history_rows, max_tags_rows):
     return url
 
 
-def get_urls(collection_url_id=None, app_name=None, collection_name=None, title=None, title_startswith=None, title_contains=None, tag=None, with_history=False, with_tags=False, verify_username=None):
+def get_urls(collection_url_id=None, app_name=None, collection_name=None, title=None, title_startswith=None, title_contains=None, tag=None, with_history=False, with_tags=False, verify_username=None,
+             after_id=None, limit=SEARCH_URL_DEFAULT_LIMIT):
     if collection_url_id is not None:
-        if app_name is not None or collection_name is not None or title is not None or title_startswith is not None or title_contains is not None or tag is not None:
+        if app_name is not None or collection_name is not None or title is not None or title_startswith is not None or title_contains is not None or tag is not None or after_id is not None:
             raise Exception('invalid arguments')
         is_single = True
         collection_url_from = ''
@@ -265,6 +419,15 @@ def get_urls(collection_url_id=None, app_name=None, collection_name=None, title=
         else:
             is_single = False
             collection_url_from = ''
+        limit = int(limit)
+        if limit < 1 or limit > SEARCH_URL_MAX_LIMIT:
+            raise Exception('limit must be between 1 and {}'.format(SEARCH_URL_MAX_LIMIT))
+        if after_id is not None:
+            collection_url_where += ' and collection_url.id > %s'
+            collection_url_values.append(int(after_id))
+        # keyset pagination on the primary key, so each page is an index range scan regardless of the offset
+        collection_url_where += ' order by collection_url.id limit %s'
+        collection_url_values.append(limit)
     collection_url_sql = """
         select
             collection_url.id collection_url_id,
@@ -284,7 +447,8 @@ def get_urls(collection_url_id=None, app_name=None, collection_name=None, title=
             last_successfull_update_hash.size_bytes last_successfull_size_bytes,
             last_successfull_update_hash.download_path last_successfull_download_path,
             last_successfull_update_hash.downloaded_at last_successfull_downloaded_at,
-            last_successfull_update_hash.hash last_successfull_hash
+            last_successfull_update_hash.hash last_successfull_hash,
+            last_successfull_update_hash.content_encoding last_successfull_content_encoding
         from
             collection_url
             join collection on collection.id = collection_url.collection_id
@@ -310,3 +474,23 @@ def get_urls(collection_url_id=None, app_name=None, collection_name=None, title=
     else:
         for row in rows:
             yield _get_url(row, SEARCH_URL_MAX_HISTORY_ITEMS if with_history else 0, SEARCH_URL_MAX_TAGS if with_tags else 0)
+
+
+def get_download(collection_url_id, verify_username=None):
+    # returns the download path and content encoding of the last successful download of the url
+    row = db.only_one("""
+        select collection.app_id, hash.download_path, hash.content_encoding
+        from
+            collection_url
+            join collection on collection.id = collection_url.collection_id
+            left join url_last_successful_update on url_last_successful_update.url_id = collection_url.url_id
+            left join url_update_history on url_update_history.id = url_last_successful_update.url_update_history_id
+            left join hash on hash.id = url_update_history.hash_id
+        where collection_url.id = %s
+    """, (collection_url_id,))
+    if not row:
+        raise Exception('failed to find url')
+    user.verify_user_app(verify_username, row['app_id'])
+    if not row['download_path']:
+        raise Exception('url was not downloaded')
+    return row['download_path'], row['content_encoding']
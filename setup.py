@@ -19,6 +19,9 @@ setup(
     author='''Ori Hoch''',
     license='MIT',
     packages=find_packages(exclude=['examples', 'tests', '.tox']),
+    extras_require={
+        'columnar': ['numpy'],
+    },
     entry_points={
       'console_scripts': [
         'downloader = downloader.cli:main',
@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import socket
+import base64
+import hashlib
+import datetime
+import pytest
+
+
+# tests which use the db fixture run against the DB of DOWNLOADER_DB_DSN and are skipped if it's not set
+# the DB must be dedicated to the tests, all its data is deleted before each test
+
+
+@pytest.fixture(scope='session')
+def migrated_db():
+    if not os.environ.get('DOWNLOADER_DB_DSN'):
+        pytest.skip('DOWNLOADER_DB_DSN is not set')
+    from downloader import db
+    db.migrate()
+    return db
+
+
+@pytest.fixture
+def db(migrated_db):
+    tables = [row['tablename'] for row in migrated_db.rows_iterator("select tablename from pg_tables where schemaname = current_schema()")]
+    migrated_db.execute('truncate {} restart identity cascade'.format(', '.join('"%s"' % table for table in tables)))
+    return migrated_db
+
+
+@pytest.fixture
+def add_urls(db):
+    # adds the urls to the app (created if needed), extra - the url attributes (see url.add), returns the collection url ids
+    from downloader import app
+    from downloader import url as url_lib
+
+    def _add_urls(urls, app_name='app1', **extra):
+        if db.only_one('select id from app where name = %s', (app_name,)) is None:
+            app.create(app_name)
+        return [url_lib.add(app_name, url, json.dumps(extra))['id'] for url in urls]
+
+    return _add_urls
+
+
+@pytest.fixture
+def create_result(db):
+    # download result of the url (see queue.get_save_result), kwargs override the result of a failed download
+    # if content is set, it's saved as the successfully downloaded content of the url in the output directory
+    from downloader import storage
+
+    def _create_result(url, output_directory=None, content=None, **kwargs):
+        if content is not None:
+            hash = hashlib.sha256(content.encode()).hexdigest()
+            output_filename = os.path.join(output_directory, hash + '.output')
+            with open(output_filename, 'w') as f:
+                f.write(content)
+            kwargs = dict(dict(hash=hash, size_bytes=len(content), output_filename=output_filename,
+                               download_path=storage.get_download_path(hash, len(content)), error=None, error_code=None), **kwargs)
+        return dict({
+            'url_id': db.only_one('select id from url where url = %s', (url,))['id'],
+            'updated_at': datetime.datetime.now().astimezone(),
+            'hash': None, 'size_bytes': 0, 'output_filename': None, 'download_path': None, 'content_encoding': None,
+            'error': 'failed', 'error_code': 7, 'timedout_seconds': None, 'not_modified': False,
+            'etag': None, 'last_modified': None, 'timings': None,
+        }, **kwargs)
+
+    return _create_result
+
+
+@pytest.fixture
+def save_result(create_result):
+    # saves a download result of the url, same arguments as create_result
+    from downloader import results
+
+    def _save_result(url, output_directory=None, content=None, **kwargs):
+        result = create_result(url, output_directory, content, **kwargs)
+        results.save_results([result], output_directory)
+        return result
+
+    return _save_result
+
+
+@pytest.fixture
+def api_client(db):
+    # test client of the REST API, authenticated as a superuser
+    from downloader import api
+    from downloader import user
+    user.create('admin', 'password1')
+    user.set_superuser('admin')
+    client = api.app.test_client()
+    client.environ_base['HTTP_AUTHORIZATION'] = 'Basic ' + base64.b64encode(b'admin:password1').decode()
+    return client
+
+
+@pytest.fixture(scope='session')
+def http_server():
+    # the local HTTP server of the benchmark, returns its base url (see benchmark._BenchmarkHandler for the url parameters)
+    from downloader import benchmark
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    process = benchmark.start_server_process(port)
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        yield 'http://127.0.0.1:%s' % port
+    finally:
+        process.terminate()
+
+
+# fixtures of test_download.test_download
+
+
+@pytest.fixture
+def output_directory(tmp_path):
+    return str(tmp_path / 'output')
+
+
+@pytest.fixture
+def concurrent_connections():
+    return 2
+
+
+@pytest.fixture
+def multiply_urls():
+    return 2
+
+
+@pytest.fixture
+def urls(http_server):
+    return [http_server + '/1?size=100', http_server + '/2?size=100000', http_server + '/3?status=404']
@@ -0,0 +1,36 @@
+import json
+import socket
+import pytest
+from downloader import app
+from downloader import benchmark
+
+
+def test_generate_urls_is_reproducible():
+    urls = list(benchmark.generate_urls(100, 8080, urls_per_domain=10, num_collections=3))
+    assert urls == list(benchmark.generate_urls(100, 8080, urls_per_domain=10, num_collections=3))
+    assert urls != list(benchmark.generate_urls(100, 8080, urls_per_domain=10, num_collections=3, seed=2))
+    rows = [json.loads(url) for url in urls]
+    assert len({row['url'].split('/')[2] for row in rows}) == 10
+    assert {row['collection'] for row in rows} == {'collection0', 'collection1', 'collection2'}
+    assert rows[11]['url'].startswith('http://127.0.0.3:8080/11?')
+
+
+def test_run(db):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    results = benchmark.run(num_urls=20, port=port, max_downloads=20, concurrent_connections=5,
+                            urls_per_domain=1, latency_ms=10, error_rate=0, redirect_rate=0.5, slow_drip_rate=0)
+    assert results['queue_urls'] == 20
+    assert results['downloaded_urls'] == 20
+    assert results['error_urls'] == 0
+    assert db.only_one('select count(1) from url_last_successful_update')['count'] == 20
+
+
+def test_reset_only_benchmark_db(db):
+    app.create(benchmark.APP_NAME)
+    benchmark.reset()
+    assert db.only_one('select count(1) from app')['count'] == 0
+    app.create('app1')
+    with pytest.raises(Exception, match='refusing to reset'):
+        benchmark.reset()
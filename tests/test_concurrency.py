@@ -0,0 +1,97 @@
+import pytest
+from downloader import concurrency
+
+
+@pytest.fixture(autouse=True)
+def no_open_files_limit(monkeypatch):
+    monkeypatch.setattr(concurrency, '_open_files_ratio', lambda: 0)
+
+
+def _end_window(controller):
+    controller['window_started_at'] -= concurrency.CONTROL_INTERVAL_SECONDS + 1
+    concurrency.update(controller)
+
+
+def test_initial_limits():
+    controller = concurrency.create_controller(100, 5)
+    assert controller['limit'] == 25
+    assert controller['step'] == 5
+    assert concurrency.create_controller(4, 5)['limit'] == 2
+    assert concurrency.create_controller(1, 5)['limit'] == 1
+
+
+def test_increase_when_saturated():
+    controller = concurrency.create_controller(100, 5)
+    assert concurrency.can_start(controller, 24)
+    _end_window(controller)
+    # not saturated, the limit is kept
+    assert controller['limit'] == 25
+    assert not concurrency.can_start(controller, 25)
+    _end_window(controller)
+    assert controller['limit'] == 30
+    controller['limit'] = 98
+    concurrency.can_start(controller, 98)
+    _end_window(controller)
+    assert controller['limit'] == 100
+
+
+def test_decrease_when_congested():
+    controller = concurrency.create_controller(100, 5)
+    for i in range(concurrency.MIN_WINDOW_RESULTS):
+        concurrency.started(controller, 'a')
+        concurrency.completed(controller, 'a', response_code=503 if i < 3 else 200)
+    _end_window(controller)
+    assert controller['limit'] == 12.5
+    controller['limit'] = 3
+    for _ in range(concurrency.MIN_WINDOW_RESULTS):
+        concurrency.started(controller, 'a')
+        concurrency.completed(controller, 'a', is_timeout=True)
+    _end_window(controller)
+    assert controller['limit'] == concurrency.MIN_CONNECTIONS
+
+
+def test_decrease_when_backlogged():
+    controller = concurrency.create_controller(100, 5, is_backlogged=lambda: True)
+    concurrency.can_start(controller, 25)
+    _end_window(controller)
+    assert controller['limit'] == 12.5
+
+
+def test_no_update_before_interval():
+    controller = concurrency.create_controller(100, 5)
+    concurrency.can_start(controller, 25)
+    concurrency.update(controller)
+    assert controller['limit'] == 25
+
+
+def test_domain_limits():
+    controller = concurrency.create_controller(100, 5)
+    assert concurrency.domain_ready(controller, 'a')
+    assert concurrency.domain_interval(controller, 'a') == 5
+    concurrency.started(controller, 'a')
+    assert not concurrency.domain_ready(controller, 'a')
+    concurrency.completed(controller, 'a', response_code=200)
+    assert controller['domains']['a']['limit'] == 2
+    assert concurrency.domain_interval(controller, 'a') == 2.5
+    for _ in range(20):
+        concurrency.started(controller, 'a')
+        concurrency.completed(controller, 'a', response_code=200)
+    assert controller['domains']['a']['limit'] == concurrency.DOMAIN_MAX_CONNECTIONS
+    concurrency.started(controller, 'a')
+    concurrency.completed(controller, 'a', response_code=429)
+    assert controller['domains']['a']['limit'] == concurrency.DOMAIN_MAX_CONNECTIONS * concurrency.DECREASE_FACTOR
+    # decreased at most once per interval
+    concurrency.started(controller, 'a')
+    concurrency.completed(controller, 'a', is_timeout=True)
+    assert controller['domains']['a']['limit'] == concurrency.DOMAIN_MAX_CONNECTIONS * concurrency.DECREASE_FACTOR
+
+
+def test_idle_domains_are_removed():
+    controller = concurrency.create_controller(100, 5)
+    concurrency.started(controller, 'a')
+    concurrency.completed(controller, 'a', is_timeout=True)
+    concurrency.started(controller, 'b')
+    concurrency.started(controller, 'c')
+    concurrency.completed(controller, 'c', response_code=200)
+    _end_window(controller)
+    assert set(controller['domains']) == {'b', 'c'}
@@ -0,0 +1,54 @@
+import threading
+import pytest
+
+
+def test_transaction_commit(db):
+    with db.transaction():
+        db.execute("insert into app (name) values ('app1')")
+        # statements inside the transaction see its uncommitted changes
+        assert db.only_one("select count(1) cnt from app")['cnt'] == 1
+        with db.transaction():
+            db.execute("insert into app (name) values ('app2')")
+    assert [row['name'] for row in db.rows_iterator('select name from app order by name')] == ['app1', 'app2']
+
+
+def test_transaction_rollback(db):
+    with pytest.raises(Exception, match='failed'):
+        with db.transaction():
+            db.execute("insert into app (name) values ('app1')")
+            with db.transaction():
+                db.execute("insert into app (name) values ('app2')")
+            raise Exception('failed')
+    assert db.only_one("select count(1) cnt from app")['cnt'] == 0
+
+
+def test_transaction_is_not_visible_to_other_threads(db):
+    counts = []
+    with db.transaction():
+        db.execute("insert into app (name) values ('app1')")
+        thread = threading.Thread(target=lambda: counts.append(db.only_one("select count(1) cnt from app")['cnt']))
+        thread.start()
+        thread.join()
+    assert counts == [0]
+
+
+def test_rows(db):
+    db.execute_values("insert into app (name) values %s", [('app%s' % i,) for i in range(25)], page_size=10)
+    assert [name for name, in db.rows_stream("select name from app order by id", itersize=7)] == ['app%s' % i for i in range(25)]
+    # nested queries while iterating
+    assert [db.only_one('select count(1) cnt from app where id <= %s', (row['id'],))['cnt']
+            for row in db.rows_iterator('select id from app order by id limit 3')] == [1, 2, 3]
+    with pytest.raises(Exception, match='Unexpected result'):
+        db.only_one('select id from app')
+    assert db.only_one("select id from app where name = 'none'") is None
+
+
+def test_execute_autocommit_inside_transaction(db):
+    with pytest.raises(Exception, match="can't execute autocommit"):
+        with db.transaction():
+            db.execute_autocommit('select 1')
+
+
+def test_migrate_is_idempotent(db):
+    db.migrate()
+    db.migrate()
@@ -1,4 +1,13 @@
 import os
+import gzip
+import socket
+import hashlib
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import pycurl
+from downloader import download as download_lib
 from downloader.download import download
 
 
@@ -24,5 +33,167 @@ def test_download(output_directory, concurrent_connections, multiply_urls, urls)
     download(int(concurrent_connections), _iterator(), _save_result)
 
 
+class _ValidatorsHandler(BaseHTTPRequestHandler):
+    # serves the content of the version in the query string (?version=1, default_version if not set)
+    # with its etag and last modified validators
+    # supports conditional requests (If-None-Match) and range requests (Range with an optional If-Range)
+    # ?truncate=N closes the connection after sending N bytes of the body of a non-range response
+    protocol_version = 'HTTP/1.1'
+    default_version = '1'
+
+    def do_GET(self):
+        params = {k: v[0] for k, v in parse_qs(urlsplit(self.path).query).items()}
+        version = params.get('version', self.default_version)
+        content = _get_validators_server_content(version)
+        etag = '"%s"' % version
+        range_start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range', etag) == etag:
+            range_start = int(self.headers['Range'].split('=')[1].split('-')[0])
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+        elif range_start > 0:
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (range_start, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', 'Mon, 01 Jan 2024 00:00:0%s GMT' % version)
+        if self.headers.get('If-None-Match') == etag:
+            self.end_headers()
+            return
+        body = content[range_start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if params.get('truncate') and range_start == 0:
+            self.wfile.write(body[:int(params['truncate'])])
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _get_validators_server_content(version):
+    return ('version %s\n' % version).encode() * 10000
+
+
+@pytest.fixture(scope='module')
+def http_validators_server():
+    # HTTP server which supports conditional and range requests (see _ValidatorsHandler), returns its base url
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _ValidatorsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield 'http://127.0.0.1:%s' % server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _download(urlobjs, **kwargs):
+    # downloads the url objects, returns the url objects with the response code, errno and errmsg of their result (in the same order)
+    results = {}
+
+    def _save_result(urlobj, response_code=None, errno=None, errmsg=None):
+        results[urlobj['i']] = dict(urlobj, response_code=response_code, errno=errno, errmsg=errmsg)
+
+    download(2, (dict(urlobj, i=i) for i, urlobj in enumerate(urlobjs)), _save_result, **kwargs)
+    return [results[i] for i in range(len(urlobjs))]
+
+
+def _get_content(path, size):
+    # content of the benchmark's local HTTP server
+    return (hashlib.sha256(path.encode()).hexdigest().encode() * (size // 64 + 1))[:size]
+
+
+def test_hash_while_streaming(http_server, tmp_path):
+    results = _download([
+        {'url': http_server + '/%s?size=%s' % (i, size), 'output_filename': str(tmp_path / str(i))}
+        for i, size in enumerate([0, 100, 1000000])
+    ])
+    assert [result['response_code'] for result in results] == [200, 200, 200]
+    for i, (result, size) in enumerate(zip(results, [0, 100, 1000000])):
+        content = _get_content('/%s' % i, size)
+        assert (result['hash'], result['size_bytes']) == (hashlib.sha256(content).hexdigest(), size)
+        with open(result['output_filename'], 'rb') as f:
+            assert f.read() == content
+
+
+def test_compressed_output(http_server, tmp_path):
+    result, = _download([{'url': http_server + '/1?size=100000', 'output_filename': str(tmp_path / '1.gz'), 'content_encoding': 'gzip'}])
+    # the hash and size are of the decoded content
+    content = _get_content('/1', 100000)
+    assert (result['hash'], result['size_bytes']) == (hashlib.sha256(content).hexdigest(), 100000)
+    with gzip.open(result['output_filename']) as f:
+        assert f.read() == content
+
+
+@pytest.mark.parametrize('engine', ['select', 'socket_action'])
+def test_download_engines(http_server, tmp_path, engine):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        closed_port = sock.getsockname()[1]
+    results = _download([
+        {'url': http_server + '/%s?size=%s&latency=%s' % (i, 10000 * i, 10 * i), 'output_filename': str(tmp_path / str(i))} for i in range(5)
+    ] + [
+        {'url': http_server + '/error?status=404', 'output_filename': str(tmp_path / 'error')},
+        {'url': http_server + '/redirect?redirects=2&size=10', 'output_filename': str(tmp_path / 'redirect')},
+        {'url': 'http://127.0.0.1:%s/' % closed_port, 'output_filename': str(tmp_path / 'refused')},
+    ], engine=engine)
+    assert [(result['response_code'], result['errno']) for result in results] == [(200, None)] * 5 + [
+        (404, None), (200, None), (None, pycurl.E_COULDNT_CONNECT)
+    ]
+    assert [result['size_bytes'] for result in results[:5]] == [10000 * i for i in range(5)]
+    assert results[6]['size_bytes'] == 10
+
+
+def test_conditional_request(http_validators_server, tmp_path):
+    url = http_validators_server + '/file?version=1'
+    results = _download([
+        {'url': url, 'output_filename': str(tmp_path / 'modified'), 'etag': '"0"', 'last_modified': 'Mon, 01 Jan 2024 00:00:00 GMT'},
+        {'url': url + '&', 'output_filename': str(tmp_path / 'not_modified'), 'etag': '"1"'},
+    ])
+    assert [(result['response_code'], result['size_bytes']) for result in results] == [
+        (200, len(_get_validators_server_content('1'))), (304, 0)
+    ]
+    # the validators of the response are used for the next conditional request
+    assert results[0]['validators'] == {'etag': '"1"', 'last_modified': 'Mon, 01 Jan 2024 00:00:01 GMT'}
+
+
+def test_resume_partial_download(http_validators_server, tmp_path):
+    urlobj = {'url': http_validators_server + '/file?truncate=30000', 'output_filename': str(tmp_path / 'partial'), 'resumable': True}
+    result, = _download([urlobj])
+    assert result['errno'] == pycurl.E_PARTIAL_FILE and result['partial_saved']
+    assert os.path.getsize(urlobj['output_filename']) == 30000
+    # the next attempt continues from the end of the partial content, the hash and size are of the full content
+    result, = _download([urlobj])
+    content = _get_validators_server_content('1')
+    assert (result['response_code'], result['resume_offset']) == (206, 30000)
+    assert (result['hash'], result['size_bytes']) == (hashlib.sha256(content).hexdigest(), len(content))
+    with open(urlobj['output_filename'], 'rb') as f:
+        assert f.read() == content
+    assert not os.path.exists(urlobj['output_filename'] + '.json')
+
+
+def test_resume_modified_content(http_validators_server, tmp_path, monkeypatch):
+    urlobj = {'url': http_validators_server + '/file?truncate=30000', 'output_filename': str(tmp_path / 'partial'), 'resumable': True}
+    result, = _download([urlobj])
+    assert result['partial_saved']
+    # the content was modified, the server responds with the full content which is not appended to the partial content
+    monkeypatch.setattr(_ValidatorsHandler, 'default_version', '2')
+    result, = _download([urlobj])
+    assert result['errno'] is not None and not result['partial_saved']
+    assert not os.path.exists(urlobj['output_filename']) and not os.path.exists(urlobj['output_filename'] + '.json')
+
+
+def test_sleeps_until_iterator_is_ready(monkeypatch):
+    # the iterator yields the seconds until it has a url ready, the download waits at most SLEEP_TIME_SECONDS_IF_NONE_RUNNING
+    sleeps = []
+    monkeypatch.setattr(download_lib.time, 'sleep', sleeps.append)
+    download(2, iter([0.2, None, 5]), None)
+    assert sleeps == [0.2, download_lib.SLEEP_TIME_SECONDS_IF_NONE_RUNNING, download_lib.SLEEP_TIME_SECONDS_IF_NONE_RUNNING]
+
+
 if __name__ == '__main__':
     test_download(".output", 2, 2, ["http://www.example.com", "http://www.example.com/foo", "https://www.example.com"])
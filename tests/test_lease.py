@@ -0,0 +1,70 @@
+from downloader import lease
+
+
+def _claim(worker_id, limit=10, **kwargs):
+    return sorted(row['url'] for row in lease.claim(worker_id, limit, 15, **kwargs))
+
+
+def _expire_leases(db):
+    db.execute("update queue set added_at = added_at - make_interval(secs => timeout_seconds + %s + 1)", (lease.LEASE_EXTRA_SECONDS,))
+
+
+def _get_url_ids(db, urls):
+    return [db.only_one('select id from url where url = %s', (url,))['id'] for url in urls]
+
+
+URLS = ['https://example.com/1', 'https://example.com/2', 'https://example.com/3']
+
+
+def test_claim_is_exclusive(db, add_urls):
+    add_urls(URLS)
+    assert len(_claim('worker1', 2)) == 2
+    assert len(_claim('worker2')) == 1
+    assert _claim('worker2') == []
+
+
+def test_expired_leases_are_claimed_again(db, add_urls):
+    add_urls(URLS)
+    assert _claim('worker1') == URLS
+    _expire_leases(db)
+    assert _claim('worker2') == URLS
+
+
+def test_complete_only_own_leases(db, add_urls):
+    add_urls(URLS)
+    url_ids = _get_url_ids(db, URLS)
+    _claim('worker1')
+    _expire_leases(db)
+    _claim('worker2')
+    # late results of worker1 don't complete the leases of worker2
+    lease.complete(url_ids, 'worker1')
+    assert _claim('worker3') == []
+    lease.complete(url_ids[:1], 'worker2')
+    assert [row['status'] for row in db.rows_iterator('select status from queue order by url_id')] == ['done', 'leased', 'leased']
+
+
+def test_release(db, add_urls):
+    add_urls(URLS)
+    url_ids = _get_url_ids(db, URLS)
+    _claim('worker1')
+    lease.release_urls(url_ids[:1], 'worker2')
+    assert _claim('worker2') == []
+    lease.release_urls(url_ids[:1], 'worker1')
+    assert _claim('worker2') == URLS[:1]
+    lease.release('worker1')
+    assert _claim('worker3') == URLS[1:]
+
+
+def test_claim_timeout_filters(db, add_urls, save_result):
+    add_urls(URLS)
+    save_result(URLS[0], error='timed out', error_code=28, timedout_seconds=300)
+    db.execute('update url_schedule set next_due_at = now()')
+    assert _claim('worker1', min_timeout_seconds=15, max_timeout_seconds=300) == URLS[:1]
+    assert _claim('worker2', max_timeout_seconds=15) == URLS[1:]
+
+
+def test_urls_without_collection_are_not_claimed(db, add_urls):
+    add_urls(URLS)
+    # the collection url was removed after the url was scheduled
+    db.execute("delete from collection_url where url_id = (select id from url where url = %s)", (URLS[0],))
+    assert _claim('worker1') == URLS[1:]
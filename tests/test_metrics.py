@@ -0,0 +1,70 @@
+import urllib.request
+import urllib.error
+import pytest
+from downloader import metrics
+
+
+@pytest.fixture(autouse=True)
+def empty_metrics(monkeypatch):
+    monkeypatch.setattr(metrics, '_metrics', {})
+    monkeypatch.setattr(metrics, '_gauge_functions', {})
+    monkeypatch.setattr(metrics, '_domain_labels', set())
+
+
+def test_collect():
+    metrics.inc('downloader_completed_total', result='ok')
+    metrics.inc('downloader_completed_total', 2, result='ok')
+    metrics.inc('downloader_completed_total', result='say "hi"')
+    metrics.add_gauge('downloader_in_flight_transfers', 2)
+    metrics.add_gauge('downloader_in_flight_transfers', -1)
+    metrics.observe('downloader_transfer_seconds', 0.3, buckets=[0.1, 1])
+    metrics.observe('downloader_transfer_seconds', 5, buckets=[0.1, 1])
+    metrics.set_gauge_function('downloader_pending_urls', lambda: 7)
+    metrics.set_gauge_function('downloader_concurrency_limit', lambda: None)
+    assert metrics.collect() == '\n'.join([
+        '# TYPE downloader_completed_total counter',
+        'downloader_completed_total{result="ok"} 3',
+        'downloader_completed_total{result="say \\"hi\\""} 1',
+        '# TYPE downloader_in_flight_transfers gauge',
+        'downloader_in_flight_transfers 1',
+        '# TYPE downloader_transfer_seconds histogram',
+        'downloader_transfer_seconds_bucket{le="0.1"} 0',
+        'downloader_transfer_seconds_bucket{le="1"} 1',
+        'downloader_transfer_seconds_bucket{le="+Inf"} 2',
+        'downloader_transfer_seconds_sum 5.3',
+        'downloader_transfer_seconds_count 2',
+        # gauge functions which return None are not collected
+        '# TYPE downloader_pending_urls gauge',
+        'downloader_pending_urls 7',
+    ]) + '\n'
+
+
+def test_totals():
+    metrics.inc('downloader_completed_total', result='ok')
+    metrics.inc('downloader_completed_total', result='error')
+    with metrics.timer('downloader_db_write_seconds'):
+        pass
+    metrics.set_gauge_function('downloader_pending_urls', lambda: 7)
+    totals = metrics.get_totals()
+    assert totals['downloader_completed_total'] == 2
+    assert totals['downloader_db_write_seconds_count'] == 1
+    assert totals['downloader_pending_urls'] == 7
+
+
+def test_domain_labels(monkeypatch):
+    monkeypatch.setattr(metrics, 'MAX_DOMAIN_LABELS', 2)
+    assert [metrics.get_domain_label(domain) for domain in ['a', 'b', 'c', 'a']] == ['a', 'b', 'other', 'a']
+
+
+def test_server():
+    metrics.inc('downloader_started_total')
+    server = metrics.start_server(0)
+    try:
+        base_url = 'http://127.0.0.1:%s' % server.server_address[1]
+        with urllib.request.urlopen(base_url + '/metrics') as response:
+            assert response.read().decode() == metrics.collect()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(base_url + '/')
+    finally:
+        server.shutdown()
+        server.server_close()
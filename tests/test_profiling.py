@@ -0,0 +1,59 @@
+import os
+import json
+import time
+import threading
+from downloader import profiling
+
+
+def _read_trace(directory):
+    filename, = [filename for filename in os.listdir(directory) if filename.endswith('.trace.json')]
+    with open(os.path.join(directory, filename)) as f:
+        return json.load(f)
+
+
+def test_disabled(tmp_path, monkeypatch):
+    monkeypatch.setitem(profiling._config, 'directory', None)
+    with profiling.trace_cycle('cycle'):
+        assert profiling.span('phase') is profiling.span('other')
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_trace_cycle(tmp_path, monkeypatch):
+    monkeypatch.setitem(profiling._config, 'directory', str(tmp_path))
+    monkeypatch.setitem(profiling._config, 'cprofile', False)
+    with profiling.trace_cycle('cycle'):
+        with profiling.span('phase', num_urls=2):
+            time.sleep(0.01)
+
+        def _worker():
+            with profiling.span('thread_phase'):
+                pass
+
+        thread = threading.Thread(target=_worker, name='worker')
+        thread.start()
+        thread.join()
+        # short hot spans are only added to the totals
+        for i in range(3):
+            with profiling.span('hot', min_seconds=1):
+                pass
+    # spans outside of a cycle are not traced
+    with profiling.span('after'):
+        pass
+    trace = _read_trace(str(tmp_path))
+    events = {event['name']: event for event in trace['traceEvents'] if event['ph'] == 'X'}
+    assert sorted(events) == ['cycle', 'phase', 'thread_phase']
+    assert events['phase']['args'] == {'num_urls': 2}
+    assert events['phase']['dur'] >= 10000
+    assert events['cycle']['dur'] >= events['phase']['dur']
+    assert sorted(trace['otherData']['totals_seconds']) == ['cycle', 'hot', 'phase', 'thread_phase']
+    # spans of other threads are traced with their thread name
+    assert events['thread_phase']['tid'] == thread.ident
+    assert sorted(event['args']['name'] for event in trace['traceEvents'] if event['ph'] == 'M') == sorted([threading.current_thread().name, 'worker'])
+
+
+def test_cprofile(tmp_path, monkeypatch):
+    monkeypatch.setitem(profiling._config, 'directory', str(tmp_path))
+    monkeypatch.setitem(profiling._config, 'cprofile', True)
+    with profiling.trace_cycle('cycle'):
+        pass
+    assert sorted(filename.split('-cycle')[1] for filename in os.listdir(str(tmp_path))) == ['.prof', '.trace.json']
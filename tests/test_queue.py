@@ -0,0 +1,155 @@
+import os
+import pytest
+import pycurl
+from collections import defaultdict
+from downloader import queue
+from downloader import queuefile
+from downloader import throttle
+from downloader import results
+
+
+def _read_queue(queue_directory):
+    queue_file = queuefile.open_queue(queue_directory)
+    try:
+        return [queuefile.queue_get(queue_file, position) for position in range(queuefile.queue_len(queue_file))]
+    finally:
+        queuefile.close_queue(queue_file)
+
+
+@pytest.mark.parametrize('columnar_snapshot', [False, True])
+def test_fetch(monkeypatch, columnar_snapshot, add_urls, tmp_path):
+    monkeypatch.setattr(queue, 'FETCH_COLUMNAR_SNAPSHOT', columnar_snapshot)
+    add_urls(['https://example.com/%s' % i for i in range(3)])
+    queue_directory = os.path.join(str(tmp_path), 'queue')
+    app_stats, num_urls = queue.fetch('regular', queue_directory)
+    assert num_urls == 3
+    assert app_stats == {'app1': {'default': 3}}
+    assert sorted(url for url_id, url in _read_queue(queue_directory)) == ['https://example.com/%s' % i for i in range(3)]
+
+
+def test_row_bucket_type():
+    assert queue.get_row_bucket_type({'url_id': None}) is None
+    assert queue.get_row_bucket_type({'url_id': 1, 'updated_at': None, 'last_update_hash_id': None}) == 'new'
+    assert queue.get_row_bucket_type({'url_id': 1, 'updated_at': '2020-01-01', 'last_update_hash_id': None}) == 'failed'
+    assert queue.get_row_bucket_type({'url_id': 1, 'updated_at': '2020-01-01', 'last_update_hash_id': 2}) == 'update'
+
+
+@pytest.mark.parametrize('columnar_snapshot', [False, True])
+def test_fetch_queue_order(monkeypatch, columnar_snapshot, db, add_urls, save_result, tmp_path):
+    monkeypatch.setattr(queue, 'FETCH_COLUMNAR_SNAPSHOT', columnar_snapshot)
+    add_urls(['https://example.com/new1', 'https://example.com/new2', 'https://example.org/failed', 'https://example.net/update'])
+    add_urls(['https://example.com/new3', 'https://example.net/update'], collection='c2')
+    save_result('https://example.org/failed')
+    save_result('https://example.net/update', str(tmp_path), content='update', etag='"e1"')
+    db.execute('update url_schedule set next_due_at = now()')
+    queue_directory = os.path.join(str(tmp_path), 'queue')
+    app_stats, num_urls = queue.fetch('regular', queue_directory)
+    assert app_stats == {'app1': {'default': 4, 'c2': 2}}
+    # round-robin between the buckets of each bucket type and collection, each url is added once
+    urls = [url for url_id, url in _read_queue(queue_directory)]
+    assert num_urls == 5
+    assert urls[1:4] == ['https://example.com/new3', 'https://example.net/update', 'https://example.org/failed']
+    assert {urls[0], urls[4]} == {'https://example.com/new1', 'https://example.com/new2'}
+    update_url_id = db.only_one("select id from url where url = 'https://example.net/update'")['id']
+    assert queue.load_validators(queue_directory) == {update_url_id: ('"e1"', None)}
+
+
+@pytest.mark.parametrize('columnar_snapshot', [False, True])
+@pytest.mark.parametrize('queue_type, expected_urls', [
+    ('regular', ['https://example.net/new']),
+    ('timedout', ['https://example.org/timedout']),
+    ('samedomain', ['https://example.com/1', 'https://example.com/2', 'https://example.com/3']),
+])
+def test_fetch_queue_types(monkeypatch, columnar_snapshot, db, add_urls, save_result, tmp_path, queue_type, expected_urls):
+    monkeypatch.setattr(queue, 'FETCH_COLUMNAR_SNAPSHOT', columnar_snapshot)
+    monkeypatch.setattr(queue, 'MAX_SAMEDOMAINS', 2)
+    add_urls(['https://example.com/1', 'https://example.com/2', 'https://example.com/3', 'https://example.org/timedout', 'https://example.net/new'])
+    save_result('https://example.org/timedout', error='timed out', error_code=28, timedout_seconds=300)
+    db.execute('update url_schedule set next_due_at = now()')
+    queue_directory = os.path.join(str(tmp_path), 'queue')
+    queue.fetch(queue_type, queue_directory)
+    assert sorted(url for url_id, url in _read_queue(queue_directory)) == expected_urls
+
+
+@pytest.mark.parametrize('queue_type', queue.WORKER_QUEUE_TYPES)
+def test_download_iterator(db, add_urls, save_result, tmp_path, queue_type):
+    add_urls(['https://example.com/new', 'https://example.org/timedout'])
+    save_result('https://example.org/timedout', error='timed out', error_code=28, timedout_seconds=300)
+    db.execute('update url_schedule set next_due_at = now()')
+    stats = defaultdict(int)
+    iterator = queue.get_download_iterator(queue_type, str(tmp_path), 'worker1', stats, batch_size=10)
+    urlobj = next(iterator)
+    assert stats['num_claimed_urls'] == 1
+    if queue_type == 'timedout':
+        assert (urlobj['url'], urlobj['timeout_seconds']) == ('https://example.org/timedout', queue.MAX_TIMEOUT_SECONDS)
+    else:
+        assert (urlobj['url'], urlobj['timeout_seconds']) == ('https://example.com/new', queue.MIN_TIMEOUT_SECONDS)
+    assert urlobj['worker_id'] == 'worker1'
+    assert db.only_one("select worker, status from queue where url_id = %s", (urlobj['url_id'],)) == ['worker1', 'leased']
+
+
+def test_download_iterator_claims_in_batches(db, add_urls, tmp_path, monkeypatch):
+    monkeypatch.setattr(queue, 'DOWNLOAD_ITERATOR_CLAIM_IDLE_SECONDS', 0)
+    add_urls(['https://example%s.com/' % i for i in range(5)])
+    stats = defaultdict(int)
+    iterator = queue.get_download_iterator('regular', str(tmp_path), 'worker1', stats, batch_size=2)
+    urls = [next(iterator)['url']]
+    assert stats['num_claimed_urls'] == 2
+    # more urls are claimed only when the pending urls drop below the batch size
+    urls.append(next(iterator)['url'])
+    assert stats['num_claimed_urls'] == 4
+    urls += [next(iterator)['url'] for _ in range(3)]
+    assert sorted(urls) == ['https://example%s.com/' % i for i in range(5)]
+    # the iterator is endless, it yields None while there are no due urls to claim
+    assert next(iterator) is None
+    assert stats['num_claimed_urls'] == 5
+
+
+def test_iterate_throttled_yields_wait_seconds():
+    domain_throttle = throttle.create_throttle(queue.DOWNLOAD_DOMAIN_THROTTLE_SECONDS)
+    for url in ['https://example.com/1', 'https://example.com/2']:
+        queue.push_throttled(domain_throttle, {'url': url})
+    stats = defaultdict(int)
+    iterator = queue.iterate_throttled(domain_throttle, lambda: False, stats)
+    assert next(iterator)['url'] == 'https://example.com/1'
+    # the second url of the domain is ready after the domain throttle interval
+    assert queue.DOWNLOAD_DOMAIN_THROTTLE_SECONDS - 1 < next(iterator) <= queue.DOWNLOAD_DOMAIN_THROTTLE_SECONDS
+    assert stats['skipped_due_to_domain_start_time'] == 1
+    throttle.throttle_pop(domain_throttle, float('inf'))
+    assert list(iterator) == []
+
+
+@pytest.mark.parametrize('max_deferred_urls, num_read_lines', [(2, 3), (10, 5)])
+def test_queue_iterator_max_deferred_urls(monkeypatch, tmp_path, max_deferred_urls, num_read_lines):
+    monkeypatch.setattr(queue, 'DOWNLOAD_MAX_PENDING_URLS_PER_DOMAIN', 1)
+    monkeypatch.setattr(queue, 'DOWNLOAD_MAX_DEFERRED_URLS', max_deferred_urls)
+    queue_directory = str(tmp_path)
+    writer = queuefile.open_queue_writer(queue_directory)
+    for url_id, url in enumerate(['https://example.com/1', 'https://example.com/2', 'https://example.com/3', 'https://example.com/4',
+                                  'https://example.org/1'], 1):
+        queuefile.queue_writer_append(writer, url_id, url)
+    queuefile.close_queue_writer(writer)
+    queue_file = queuefile.open_queue(queue_directory)
+    try:
+        stats = defaultdict(int)
+        iterator = queue.get_queue_iterator(queue_directory, queue_file, bytearray(), queue_directory, 15, stats)
+        assert next(iterator)['url'] == 'https://example.com/1'
+        # reading ahead stops when the max number of urls are deferred
+        assert stats['total_read_lines'] == num_read_lines
+    finally:
+        queuefile.close_queue(queue_file)
+
+
+def test_save_resumed_result(monkeypatch, tmp_path):
+    saved_results = []
+    monkeypatch.setattr(results, 'writer_put', lambda writer, result: saved_results.append(result))
+    stats = defaultdict(int)
+    save_result = queue.get_save_result(None, stats)
+    urlobj = queue.get_urlobj(str(tmp_path), 1, 'https://example.com/', 300, partial_directory=str(tmp_path / 'partial'))
+    assert urlobj['resumable'] and urlobj['output_filename'] == str(tmp_path / 'partial' / '1.output')
+    save_result(dict(urlobj, hash='a' * 64, size_bytes=100, resume_offset=50), response_code=206)
+    save_result(dict(urlobj, hash='a' * 64, size_bytes=50, partial_saved=True), errno=pycurl.E_PARTIAL_FILE, errmsg='partial')
+    # the hash of a resumed download is of the full content
+    assert (saved_results[0]['hash'], saved_results[0]['size_bytes']) == ('a' * 64, 100)
+    # the saved partial download is kept for the next attempt
+    assert saved_results[1]['hash'] is None and saved_results[1]['output_filename'] is None
@@ -0,0 +1,60 @@
+from downloader import queuefile
+
+
+URLS = [(10, 'https://example.com/'), (3, 'http://example.org/ünicode'), (7, 'https://example.net/a?b=c')]
+
+
+def _write_queue(queue_directory, urls):
+    writer = queuefile.open_queue_writer(queue_directory)
+    try:
+        for url_id, url in urls:
+            queuefile.queue_writer_append(writer, url_id, url)
+    finally:
+        queuefile.close_queue_writer(writer)
+    return writer['len']
+
+
+def test_queue_round_trip(tmp_path):
+    assert _write_queue(str(tmp_path), URLS) == 3
+    queue = queuefile.open_queue(str(tmp_path))
+    try:
+        assert queuefile.queue_len(queue) == 3
+        assert [queuefile.queue_get(queue, position) for position in range(3)] == URLS
+    finally:
+        queuefile.close_queue(queue)
+
+
+def test_empty_queue(tmp_path):
+    assert _write_queue(str(tmp_path), []) == 0
+    queue = queuefile.open_queue(str(tmp_path))
+    assert queuefile.queue_len(queue) == 0
+    queuefile.close_queue(queue)
+
+
+def test_bytearray_bitmap():
+    bitmap = bytearray()
+    assert not queuefile.bitmap_get(bitmap, 0)
+    assert queuefile.bitmap_set(bitmap, 0)
+    assert queuefile.bitmap_set(bitmap, 17)
+    assert not queuefile.bitmap_set(bitmap, 17)
+    assert len(bitmap) == 3
+    assert queuefile.bitmap_get(bitmap, 0) and queuefile.bitmap_get(bitmap, 17)
+    assert not queuefile.bitmap_get(bitmap, 16) and not queuefile.bitmap_get(bitmap, 1000)
+    assert queuefile.bitmap_count(bitmap) == 2
+
+
+def test_progress_is_kept(tmp_path):
+    progress = queuefile.open_progress(str(tmp_path), 20)
+    assert queuefile.bitmap_count(progress) == 0
+    queuefile.bitmap_set(progress, 3)
+    queuefile.bitmap_set(progress, 19)
+    queuefile.close_progress(progress)
+    # reopened with more positions, the existing progress is kept
+    progress = queuefile.open_progress(str(tmp_path), 100)
+    try:
+        assert len(progress) == 13
+        assert queuefile.bitmap_get(progress, 3) and queuefile.bitmap_get(progress, 19)
+        assert not queuefile.bitmap_get(progress, 4)
+        assert queuefile.bitmap_count(progress) == 2
+    finally:
+        queuefile.close_progress(progress)
@@ -0,0 +1,81 @@
+import pytest
+from downloader import resolve
+from downloader.download import download
+
+
+@pytest.fixture
+def addresses(monkeypatch):
+    # hosts are resolved from the returned dict, hosts which are not in the dict fail to resolve
+    addresses = {}
+
+    def _resolve_host(host):
+        if host not in addresses:
+            raise Exception('failed to resolve ' + host)
+        return addresses[host]
+
+    monkeypatch.setattr(resolve, '_resolve_host', _resolve_host)
+    return addresses
+
+
+@pytest.fixture
+def resolver(addresses):
+    resolver = resolve.create_resolver(1)
+    yield resolver
+    resolve.close_resolver(resolver)
+
+
+def _prefetch(resolver, domains):
+    resolve.resolver_prefetch(resolver, domains)
+    for domain in domains:
+        resolver['hosts'][domain.split(':')[0]]['future'].exception()
+
+
+def test_resolve_entries(resolver, addresses):
+    addresses.update({'example.com': ['1.2.3.4', '::1'], 'example.org': ['5.6.7.8']})
+    assert resolve.get_resolve_entries(resolver, 'https://example.com/') == []
+    _prefetch(resolver, ['example.com', 'example.org:8080'])
+    assert resolve.get_resolve_entries(resolver, 'https://example.com/a') == ['example.com:443:1.2.3.4,[::1]']
+    assert resolve.get_resolve_entries(resolver, 'http://example.com/b') == ['example.com:80:1.2.3.4,[::1]']
+    assert resolve.get_resolve_entries(resolver, 'http://example.org:8080/') == ['example.org:8080:5.6.7.8']
+    # the host is resolved again only after the ttl
+    addresses['example.com'] = ['4.3.2.1']
+    _prefetch(resolver, ['example.com'])
+    assert resolve.get_resolve_entries(resolver, 'https://example.com/') == ['example.com:443:1.2.3.4,[::1]']
+    resolver['hosts']['example.com']['time'] -= resolve.RESOLVE_TTL_SECONDS + 1
+    _prefetch(resolver, ['example.com'])
+    # the previous entry is removed from the curl DNS cache
+    assert resolve.get_resolve_entries(resolver, 'https://example.com/') == ['-example.com:443', 'example.com:443:4.3.2.1']
+    assert resolve.get_resolve_entries(resolver, 'https://example.com/') == ['example.com:443:4.3.2.1']
+
+
+def test_failed_resolve(resolver, addresses):
+    addresses['example.com'] = ['1.2.3.4']
+    _prefetch(resolver, ['example.com'])
+    assert resolve.get_resolve_entries(resolver, 'https://example.com/') == ['example.com:443:1.2.3.4']
+    del addresses['example.com']
+    resolver['hosts']['example.com']['time'] -= resolve.RESOLVE_TTL_SECONDS + 1
+    _prefetch(resolver, ['example.com'])
+    # curl resolves the host itself
+    assert resolve.get_resolve_entries(resolver, 'https://example.com/') == ['-example.com:443']
+    assert resolve.get_resolve_entries(resolver, 'https://example.com/') == []
+
+
+def test_prefetch_due_domains(db, add_urls, resolver):
+    add_urls(['https://example.com/1', 'https://example.com/2', 'https://example.org/1', 'https://example.net/1'])
+    db.execute("update url_schedule set next_due_at = null where url_id = (select id from url where url = 'https://example.net/1')")
+    resolve.resolver_prefetch_due_domains(resolver, max_domains=1)
+    assert list(resolver['hosts']) == ['example.com']
+    resolve.resolver_prefetch_due_domains(resolver)
+    assert sorted(resolver['hosts']) == ['example.com', 'example.org']
+
+
+def test_download_with_resolve_entries(http_server, tmp_path):
+    # the host name is resolved only by the RESOLVE entry of the url object
+    port = http_server.split(':')[-1]
+    results = []
+    download(1, iter([{
+        'url': 'http://downloader.invalid:%s/1?size=10' % port,
+        'output_filename': str(tmp_path / 'output'),
+        'resolve': ['downloader.invalid:%s:127.0.0.1' % port],
+    }]), lambda urlobj, response_code=None, errno=None, errmsg=None: results.append((response_code, errno)))
+    assert results == [(200, None)]
@@ -0,0 +1,128 @@
+import os
+import datetime
+import pytest
+from downloader import results
+from downloader import storage
+from downloader import timing
+
+
+URL = 'https://example.com/1'
+
+
+def _get_last_update(db, url=URL):
+    return db.only_one("""
+        select url_last_update.consecutive_failures, url_last_update.next_retry_at, url_update_history.updated_at
+        from url_last_update
+        join url on url.id = url_last_update.url_id
+        join url_update_history on url_update_history.id = url_last_update.url_update_history_id
+        where url.url = %s
+    """, (url,))
+
+
+def _save_successful_result(save_result, output_directory, content, url=URL):
+    filename = os.path.join(output_directory, 'download.output')
+    with open(filename, 'w') as f:
+        f.write(content)
+    hash = content * 64
+    return save_result(url, output_directory, hash=hash, size_bytes=len(content), output_filename=filename,
+                       download_path=storage.get_download_path(hash, len(content)), error=None, error_code=None)
+
+
+def test_failure_streak_and_backoff(db, add_urls, save_result, tmp_path):
+    add_urls([URL])
+    for i in range(3):
+        save_result(URL)
+        last_update = _get_last_update(db)
+        assert last_update['consecutive_failures'] == i + 1
+        # the retry delay is doubled on each consecutive failure
+        assert last_update['next_retry_at'] == last_update['updated_at'] + datetime.timedelta(seconds=results.RETRY_FAILED_MIN_SECONDS * 2 ** i)
+    # a successful download resets the streak
+    _save_successful_result(save_result, str(tmp_path), 'a')
+    last_update = _get_last_update(db)
+    assert last_update['consecutive_failures'] == 0 and last_update['next_retry_at'] is None
+    save_result(URL)
+    last_update = _get_last_update(db)
+    assert last_update['consecutive_failures'] == 1
+    assert last_update['next_retry_at'] == last_update['updated_at'] + datetime.timedelta(seconds=results.RETRY_FAILED_MIN_SECONDS)
+
+
+def test_backoff_is_limited(db, add_urls, save_result):
+    add_urls([URL])
+    save_result(URL)
+    db.execute('update url_last_update set consecutive_failures = 1000')
+    save_result(URL)
+    last_update = _get_last_update(db)
+    assert last_update['next_retry_at'] == last_update['updated_at'] + datetime.timedelta(seconds=results.RETRY_FAILED_MAX_SECONDS)
+
+
+def test_new_hash_files_are_stored(db, add_urls, save_result, tmp_path):
+    add_urls([URL, 'https://example.com/2'])
+    result = _save_successful_result(save_result, str(tmp_path), 'a')
+    output_filename = os.path.join(str(tmp_path), result['download_path'])
+    with open(output_filename) as f:
+        assert f.read() == 'a'
+    assert not os.path.exists(os.path.join(str(tmp_path), 'download.output'))
+    # the same content of another url is not stored again, its downloaded file is deleted
+    _save_successful_result(save_result, str(tmp_path), 'a', url='https://example.com/2')
+    assert not os.path.exists(os.path.join(str(tmp_path), 'download.output'))
+    assert db.only_one('select count(1) from hash')['count'] == 1
+
+
+def test_files_are_not_stored_on_rollback(db, add_urls, save_result, tmp_path, monkeypatch):
+
+    def _save_timings(results):
+        raise Exception('failed to save timings')
+
+    monkeypatch.setattr(timing, 'save_timings', _save_timings)
+    add_urls([URL])
+    with pytest.raises(Exception, match='failed to save timings'):
+        _save_successful_result(save_result, str(tmp_path), 'a')
+    assert db.only_one('select count(1) from hash')['count'] == 0
+    assert os.listdir(str(tmp_path)) == ['download.output']
+
+
+def test_writer_saves_in_batches(db, add_urls, create_result, monkeypatch):
+    monkeypatch.setattr(results, 'FLUSH_MAX_RESULTS', 2)
+    add_urls([URL, 'https://example.com/2'])
+    saved_batches = []
+    writer = results.start_writer(None, on_saved=saved_batches.append)
+    for i in range(5):
+        results.writer_put(writer, create_result(URL if i % 2 == 0 else 'https://example.com/2'))
+    results.stop_writer(writer)
+    assert [len(batch) for batch in saved_batches] == [2, 2, 1]
+    assert db.only_one('select count(1) from url_update_history')['count'] == 5
+    # the last result of each url in a batch is its last update
+    assert _get_last_update(db)['consecutive_failures'] == 3
+
+
+def test_writer_error(db, add_urls, create_result):
+    add_urls([URL])
+    writer = results.start_writer(None)
+    results.writer_put(writer, dict(create_result(URL), url_id=-1))
+    with pytest.raises(Exception, match='failed to save results'):
+        results.stop_writer(writer)
+
+
+def test_results_of_the_same_url(db, add_urls, create_result, tmp_path):
+    add_urls([URL])
+    first_result, last_result = create_result(URL), create_result(URL, str(tmp_path), content='a')
+    results.save_results([first_result, last_result], str(tmp_path))
+    assert db.only_one('select count(1) from url_update_history')['count'] == 2
+    # only the last result of the url is used as its last update
+    last_update = _get_last_update(db)
+    assert last_update['consecutive_failures'] == 0 and last_update['updated_at'] == last_result['updated_at']
+
+
+def test_not_modified_reuses_the_last_successful_update(db, add_urls, save_result, tmp_path):
+    add_urls([URL])
+    result = save_result(URL, str(tmp_path), content='a', etag='"1"', last_modified='Mon, 01 Jan 2024 00:00:01 GMT')
+    save_result(URL)
+    save_result(URL, not_modified=True, error=None, error_code=304)
+    last_update = _get_last_update(db)
+    assert last_update['consecutive_failures'] == 0 and last_update['next_retry_at'] is None
+    assert db.only_one("""
+        select hash.hash, url_last_successful_update.etag, url_last_successful_update.last_modified
+        from url_last_successful_update
+        join url_update_history on url_update_history.id = url_last_successful_update.url_update_history_id
+        join hash on hash.id = url_update_history.hash_id
+    """) == [result['hash'], '"1"', 'Mon, 01 Jan 2024 00:00:01 GMT']
@@ -0,0 +1,64 @@
+import datetime
+from downloader import schedule
+from downloader import results
+
+
+def _get_next_due_at(db, url):
+    return db.only_one("""
+        select url_schedule.next_due_at from url_schedule join url on url.id = url_schedule.url_id where url.url = %s
+    """, (url,))['next_due_at']
+
+
+def _add_orphan_url(db, url):
+    # a url row without a collection url, e.g. left by a rejected import row
+    db.execute("insert into domain (domain) values ('example.com') on conflict do nothing")
+    db.execute("insert into url (url, domain_id) select %s, id from domain where domain = 'example.com'", (url,))
+    return db.only_one('select id from url where url = %s', (url,))['id']
+
+
+def test_new_urls_are_due_now(db, add_urls):
+    add_urls(['https://example.com/1'])
+    assert _get_next_due_at(db, 'https://example.com/1') <= datetime.datetime.now().astimezone()
+
+
+def test_failed_urls_are_due_on_retry(db, add_urls, save_result):
+    add_urls(['https://example.com/1'])
+    result = save_result('https://example.com/1')
+    assert _get_next_due_at(db, 'https://example.com/1') == result['updated_at'] + datetime.timedelta(seconds=results.RETRY_FAILED_MIN_SECONDS)
+
+
+def test_successful_urls_are_due_after_update_freq(db, add_urls, save_result, tmp_path):
+    add_urls(['https://example.com/1'], update_freq_minutes=60)
+    add_urls(['https://example.com/1'], collection='frequent', update_freq_minutes=30)
+    add_urls(['https://example.com/2'])
+    for i, url in enumerate(['https://example.com/1', 'https://example.com/2']):
+        filename = str(tmp_path / str(i))
+        with open(filename, 'w') as f:
+            f.write(url)
+        save_result(url, str(tmp_path), hash=str(i) * 64, size_bytes=len(url), output_filename=filename,
+                    download_path='file%s' % i, error=None, error_code=None)
+    next_due_at = _get_next_due_at(db, 'https://example.com/1')
+    updated_at = db.only_one("""
+        select max(updated_at) updated_at from url_update_history join url on url.id = url_update_history.url_id where url.url = %s
+    """, ('https://example.com/1',))['updated_at']
+    # the minimal update frequency of the url's collections
+    assert next_due_at == updated_at + datetime.timedelta(minutes=30)
+    # urls without an update frequency are not updated
+    assert _get_next_due_at(db, 'https://example.com/2') is None
+
+
+def test_urls_without_collection_are_not_due(db, add_urls):
+    url_id = _add_orphan_url(db, 'https://example.com/orphan')
+    schedule.refresh([url_id])
+    assert _get_next_due_at(db, 'https://example.com/orphan') is None
+
+
+def test_refresh_unscheduled(db, add_urls):
+    add_urls(['https://example.com/1'])
+    url_id = _add_orphan_url(db, 'https://example.com/orphan')
+    db.execute('insert into url_schedule (url_id, next_due_at) values (%s, now())', (url_id,))
+    db.execute('delete from url_schedule where url_id != %s', (url_id,))
+    schedule.refresh_unscheduled()
+    assert _get_next_due_at(db, 'https://example.com/1') is not None
+    # orphan urls which were scheduled before are no longer due
+    assert _get_next_due_at(db, 'https://example.com/orphan') is None
@@ -0,0 +1,86 @@
+import os
+import gzip
+import pytest
+from downloader import storage
+
+
+CONTENT_ENCODINGS = [None, 'gzip', pytest.param('zstd', marks=pytest.mark.skipif(storage.zstandard is None, reason='zstandard is not installed'))]
+
+
+@pytest.mark.parametrize('content_encoding', CONTENT_ENCODINGS)
+def test_compression_round_trip(tmp_path, content_encoding):
+    filename = str(tmp_path / ('output' + storage.get_extension(content_encoding)))
+    content = b'0123456789' * 100000
+    with storage.open_writer(filename, content_encoding) as f:
+        f.write(content)
+    if content_encoding:
+        assert os.path.getsize(filename) < len(content)
+    assert b''.join(storage.iterate_chunks(storage.open_reader(filename, content_encoding), 1000)) == content
+
+
+def test_unsupported_content_encoding(tmp_path):
+    with pytest.raises(Exception, match='unsupported content encoding: br'):
+        storage.open_writer(str(tmp_path / 'output'), 'br')
+
+
+def test_download_url(monkeypatch):
+    from downloader import url as url_lib
+    monkeypatch.setenv('OUTPUT_URL_PREFIX', 'https://output.example.com/')
+    assert url_lib._get_download_url(1, 'sha256/ab/cd/abcd-10.gz', 'gzip') == 'https://output.example.com/sha256/ab/cd/abcd-10.gz'
+    monkeypatch.setenv('OUTPUT_API_URL_PREFIX', 'https://api.example.com/')
+    # compressed files are decoded by the API
+    assert url_lib._get_download_url(1, 'sha256/ab/cd/abcd-10.gz', 'gzip') == 'https://api.example.com/url/download?id=1'
+    assert url_lib._get_download_url(1, 'sha256/ab/cd/abcd-10', None) == 'https://output.example.com/sha256/ab/cd/abcd-10'
+
+
+def test_api_download(add_urls, save_result, api_client, tmp_path, monkeypatch):
+    from downloader import api
+    monkeypatch.setattr(api, 'OUTPUT_DIRECTORY', str(tmp_path))
+    collection_url_id, = add_urls(['https://example.com/1'])
+    filename = str(tmp_path / 'download.output')
+    with storage.open_writer(filename, 'gzip') as f:
+        f.write(b'content')
+    save_result('https://example.com/1', str(tmp_path), hash='a' * 64, size_bytes=7, output_filename=filename,
+                download_path=storage.get_download_path('a' * 64, 7, 'gzip'), content_encoding='gzip', error=None, error_code=None)
+    response = api_client.get('/url/download?id=%s' % collection_url_id)
+    assert response.status_code == 200 and response.data == b'content'
+    # the compressed file is sent as is to clients which accept its encoding
+    response = api_client.get('/url/download?id=%s' % collection_url_id, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.data) == b'content'
+
+
+def test_download_path():
+    hash = 'abcdef' + '0' * 58
+    assert storage.get_download_path(hash, 10) == 'sha256/ab/cd/%s-10' % hash
+    assert storage.get_download_path(hash, 10, 'zstd') == 'sha256/ab/cd/%s-10.zst' % hash
+
+
+def test_store_file(tmp_path):
+    filename = str(tmp_path / 'download.output')
+    with open(filename, 'w') as f:
+        f.write('content')
+    storage.store_file(str(tmp_path), filename, 'sha256/ab/cd/abcd-7')
+    assert not os.path.exists(filename)
+    with open(str(tmp_path / 'sha256' / 'ab' / 'cd' / 'abcd-7')) as f:
+        assert f.read() == 'content'
+
+
+def test_migrate(db, tmp_path):
+    output_directory = str(tmp_path)
+    hashes = {'old': 'a' * 64, 'b': 'b' * 64, 'c': 'c' * 64}
+    download_paths = {'old': '2020/01/01/00/00/1.output', 'b': storage.get_download_path(hashes['b'], 1), 'c': '2020/01/01/00/01/2.output'}
+    for name in ['old', 'b']:
+        os.makedirs(os.path.join(output_directory, os.path.dirname(download_paths[name])), exist_ok=True)
+        with open(os.path.join(output_directory, download_paths[name]), 'w') as f:
+            f.write(name)
+    for name in ['old', 'b', 'c']:
+        db.execute('insert into hash (hash, size_bytes, download_path, downloaded_at) values (%s, 1, %s, now())', (hashes[name], download_paths[name]))
+    assert storage.migrate(output_directory, batch_size=2) == {'num_migrated': 1, 'num_already_migrated': 1, 'num_missing_files': 1}
+    new_download_path = storage.get_download_path(hashes['old'], 1)
+    with open(os.path.join(output_directory, new_download_path)) as f:
+        assert f.read() == 'old'
+    assert db.only_one('select download_path from hash where hash = %s', (hashes['old'],))['download_path'] == new_download_path
+    # the empty directories of the old layout are removed
+    assert sorted(os.listdir(output_directory)) == ['sha256']
+    assert storage.migrate(output_directory) == {'num_migrated': 0, 'num_already_migrated': 2, 'num_missing_files': 1}
@@ -0,0 +1,53 @@
+from downloader import throttle
+
+
+def _create_throttle(*domain_items):
+    domain_throttle = throttle.create_throttle(5)
+    for domain, item in domain_items:
+        throttle.throttle_push(domain_throttle, domain, item)
+    return domain_throttle
+
+
+def test_pop_order():
+    # domains are ready in the order of their first item, each domain yields its items in FIFO order
+    domain_throttle = _create_throttle(('a', 'a1'), ('b', 'b1'), ('a', 'a2'), ('c', 'c1'))
+    assert throttle.throttle_len(domain_throttle) == 4
+    assert throttle.throttle_domain_len(domain_throttle, 'a') == 2
+    assert [throttle.throttle_pop(domain_throttle, 100) for _ in range(4)] == ['a1', 'b1', 'c1', None]
+    assert throttle.throttle_pop(domain_throttle, 104.9) is None
+    assert throttle.throttle_pop(domain_throttle, 105) == 'a2'
+    assert throttle.throttle_len(domain_throttle) == 0
+    assert throttle.throttle_domain_len(domain_throttle, 'a') == 0
+    assert throttle.throttle_domain_len(domain_throttle, 'd') == 0
+
+
+def test_wait_seconds():
+    domain_throttle = _create_throttle()
+    assert throttle.throttle_wait_seconds(domain_throttle, 100) is None
+    throttle.throttle_push(domain_throttle, 'a', 'a1')
+    throttle.throttle_push(domain_throttle, 'a', 'a2')
+    assert throttle.throttle_wait_seconds(domain_throttle, 100) == 0
+    assert throttle.throttle_pop(domain_throttle, 100) == 'a1'
+    assert throttle.throttle_wait_seconds(domain_throttle, 101) == 4
+
+
+def test_push_after_interval():
+    # a domain which was emptied keeps its ready time, so a new item waits for the interval
+    domain_throttle = _create_throttle(('a', 'a1'))
+    assert throttle.throttle_pop(domain_throttle, 100) == 'a1'
+    throttle.throttle_push(domain_throttle, 'a', 'a2')
+    assert throttle.throttle_pop(domain_throttle, 101) is None
+    assert throttle.throttle_pop(domain_throttle, 105) == 'a2'
+
+
+def test_domain_callbacks():
+    domain_throttle = _create_throttle(('a', 'a1'), ('a', 'a2'), ('b', 'b1'))
+    ready_domains = {'b'}
+    domain_interval = {'a': 1, 'b': 10}.get
+    # a is not ready so it's postponed by its interval and b is returned
+    assert throttle.throttle_pop(domain_throttle, 100, ready_domains.__contains__, domain_interval) == 'b1'
+    assert throttle.throttle_pop(domain_throttle, 100, ready_domains.__contains__, domain_interval) is None
+    ready_domains.add('a')
+    assert throttle.throttle_pop(domain_throttle, 101, ready_domains.__contains__, domain_interval) == 'a1'
+    assert throttle.throttle_pop(domain_throttle, 101.5, ready_domains.__contains__, domain_interval) is None
+    assert throttle.throttle_pop(domain_throttle, 102, ready_domains.__contains__, domain_interval) == 'a2'
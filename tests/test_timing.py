@@ -0,0 +1,47 @@
+from downloader import timing
+
+
+def _create_timings(**estimate):
+    timings = timing.create_timings()
+    timings['domains']['example.com'] = dict({column: None for column in timing.ESTIMATE_COLUMNS}, num_samples=10, **estimate)
+    return timings
+
+
+def test_defaults_without_estimates():
+    assert timing.get_timeouts(timing.create_timings(), 'example.com', 30, 15, 300) == (30, None, 15)
+
+
+def test_connect_timeout_is_lowered():
+    timings = _create_timings(connect_seconds=2, connect_seconds_deviation=0.5)
+    assert timing.get_timeouts(timings, 'example.com', 30, 15, 300) == (4, None, 15)
+    timings = _create_timings(connect_seconds=0.01, connect_seconds_deviation=0.01)
+    assert timing.get_timeouts(timings, 'example.com', 30, 15, 300)[0] == timing.MIN_CONNECT_TIMEOUT_SECONDS
+    # never raised above the default
+    timings = _create_timings(connect_seconds=20, connect_seconds_deviation=10)
+    assert timing.get_timeouts(timings, 'example.com', 30, 15, 300)[0] == 30
+
+
+def test_stall_timeout():
+    timings = _create_timings(first_byte_seconds=4, first_byte_seconds_deviation=0.5)
+    assert timing.get_timeouts(timings, 'example.com', 30, 15, 300)[1:] == (6, 15)
+    timings = _create_timings(first_byte_seconds=0.1, first_byte_seconds_deviation=0.1)
+    assert timing.get_timeouts(timings, 'example.com', 30, 15, 300)[1] == timing.MIN_STALL_TIMEOUT_SECONDS
+    timings = _create_timings(first_byte_seconds=10, first_byte_seconds_deviation=5)
+    assert timing.get_timeouts(timings, 'example.com', 30, 15, 300)[1] == 15
+
+
+def test_total_timeout_is_raised_for_the_expected_size():
+    timings = _create_timings(first_byte_seconds=4, first_byte_seconds_deviation=0.5, bytes_per_second=1000, size_bytes=10000)
+    # first byte timeout 6 + 2 * 10 seconds to transfer the average domain size
+    assert timing.get_timeouts(timings, 'example.com', 30, 15, 300)[2] == 26
+    # expected size of the url
+    assert timing.get_timeouts(timings, 'example.com', 30, 15, 300, expected_size_bytes=50000)[2] == 106
+    # expected total time of the url, if it's longer than the time to transfer the expected size
+    assert timing.get_timeouts(timings, 'example.com', 30, 15, 300, expected_total_seconds=30)[2] == 66
+    # clamped to the max timeout
+    assert timing.get_timeouts(timings, 'example.com', 30, 15, 300, expected_size_bytes=10**7)[2] == 300
+
+
+def test_total_timeout_is_never_lowered():
+    timings = _create_timings(first_byte_seconds=0.1, first_byte_seconds_deviation=0.05, bytes_per_second=10**6, size_bytes=1000)
+    assert timing.get_timeouts(timings, 'example.com', 30, 15, 300)[2] == 15
@@ -0,0 +1,125 @@
+import json
+import pytest
+from downloader import app
+from downloader import url as url_lib
+
+
+def _import_urls(rows, app_name='app1'):
+    return [dict(result) for result in url_lib.import_urls(app_name, [row if isinstance(row, str) else json.dumps(row) for row in rows])]
+
+
+def _get_collection_urls(db):
+    return [(row['name'], row['url'], row['title']) for row in db.rows_iterator("""
+        select collection.name, url.url, collection_url.title
+        from collection_url join collection on collection.id = collection_url.collection_id join url on url.id = collection_url.url_id
+        order by collection_url.id
+    """)]
+
+
+def test_import_urls(db):
+    app.create('app1')
+    results = _import_urls([
+        {'url': 'https://example.com/1', 'title': 'one', 'tags': {'a': 'b', 'c': ''}, 'update_freq_minutes': 60},
+        '',
+        {'url': 'https://example.com/2', 'title': '', 'collection': 'other'},
+        {'url': 'https://example.com/3'},
+    ])
+    assert [result['row'] for result in results] == [1, 3, 4]
+    assert all('id' in result for result in results)
+    assert _get_collection_urls(db) == [
+        ('default', 'https://example.com/1', 'one'),
+        ('other', 'https://example.com/2', ''),
+        ('default', 'https://example.com/3', 'https://example.com/3'),
+    ]
+    url = list(url_lib.get_urls(collection_url_id=results[0]['id'], with_tags=True))[0]
+    assert dict(url['tags']) == {'a': 'b'}
+
+
+def test_import_results_are_in_row_order(db, add_urls):
+    add_urls(['https://example.com/existing'])
+    results = _import_urls([
+        {'url': 'https://example.com/1'},
+        'invalid json',
+        {'url': 'https://example.com/existing'},
+        {'url': 'short'},
+        {'url': 'https://example.com/2'},
+    ])
+    assert [result['row'] for result in results] == [1, 2, 3, 4, 5]
+    assert [('id' in result) for result in results] == [True, False, False, False, True]
+    assert results[2]['error'] == 'URL or URL title already exists in the collection'
+    assert results[3]['error'] == 'url length must be at least 10 characters'
+
+
+def test_import_conflicts(db, add_urls):
+    add_urls(['https://example.com/existing'], title='existing')
+    results = _import_urls([
+        {'url': 'https://example.com/1', 'title': 'existing'},
+        {'url': 'https://example.com/2', 'title': 'duplicate'},
+        {'url': 'https://example.com/3', 'title': 'duplicate'},
+        {'url': 'https://example.com/2', 'title': 'other'},
+        # a previous row with the same title was rejected
+        {'url': 'https://example.com/4', 'title': 'existing2'},
+        {'url': 'https://example.com/5', 'title': 'existing2', 'collection': 'other'},
+    ])
+    assert [('id' in result) for result in results] == [False, True, False, False, True, True]
+    assert _get_collection_urls(db) == [
+        ('default', 'https://example.com/existing', 'existing'),
+        ('default', 'https://example.com/2', 'duplicate'),
+        ('default', 'https://example.com/4', 'existing2'),
+        ('other', 'https://example.com/5', 'existing2'),
+    ]
+
+
+def test_rejected_rows_dont_add_urls(db, add_urls):
+    add_urls(['https://example.com/existing'], title='existing')
+    results = _import_urls([{'url': 'https://other.example.com/1', 'title': 'existing'}])
+    assert 'error' in results[0]
+    assert db.only_one("select id from url where url = 'https://other.example.com/1'") is None
+    assert db.only_one("select id from domain where domain = 'other.example.com'") is None
+
+
+def test_import_batches(db, monkeypatch):
+    monkeypatch.setattr(url_lib, 'IMPORT_BATCH_SIZE', 2)
+    app.create('app1')
+    results = _import_urls(['{}'] + [{'url': 'https://example.com/%s' % i} for i in range(5)] + ['[]'])
+    assert [result['row'] for result in results] == list(range(1, 8))
+    assert [('id' in result) for result in results] == [False, True, True, True, True, True, False]
+
+
+def test_get_urls_pages(db, add_urls):
+    collection_url_ids = add_urls(['https://example.com/%s' % i for i in range(5)])
+    pages, after_id = [], None
+    while True:
+        page = list(url_lib.get_urls(app_name='app1', collection_name='default', after_id=after_id, limit=2))
+        if not page:
+            break
+        pages.append([url['id'] for url in page])
+        after_id = page[-1]['id']
+    assert pages == [collection_url_ids[0:2], collection_url_ids[2:4], collection_url_ids[4:5]]
+    page = list(url_lib.get_urls(app_name='app1', collection_name='default', title_startswith='https://example.com/', after_id=collection_url_ids[3]))
+    assert [url['url'] for url in page] == ['https://example.com/4']
+
+
+def test_get_urls_limit(db, add_urls):
+    add_urls(['https://example.com/1'])
+    for limit in [0, url_lib.SEARCH_URL_MAX_LIMIT + 1]:
+        with pytest.raises(Exception, match='limit must be between 1 and'):
+            list(url_lib.get_urls(app_name='app1', collection_name='default', limit=limit))
+
+
+def test_api_url_list(add_urls, api_client):
+    collection_url_ids = add_urls(['https://example.com/%s' % i for i in range(3)])
+    response = api_client.get('/url/list?app_name=app1&collection_name=default&limit=2')
+    assert response.status_code == 200
+    assert [url['id'] for url in response.json['urls']] == collection_url_ids[:2]
+    assert response.json['next_after_id'] == collection_url_ids[1]
+    response = api_client.get('/url/list?app_name=app1&collection_name=default&limit=2&after_id=%s' % response.json['next_after_id'])
+    assert [url['id'] for url in response.json['urls']] == collection_url_ids[2:]
+    # the last page has no next page
+    assert response.json['next_after_id'] is None
+    response = api_client.get('/url/list?app_name=app1&collection_name=default&format=ndjson')
+    assert response.mimetype == 'application/x-ndjson'
+    assert [json.loads(line)['id'] for line in response.data.decode().splitlines()] == collection_url_ids
+    # invalid arguments return an error response
+    response = api_client.get('/url/list?app_name=app1&collection_name=default&limit=0')
+    assert response.status_code == 500 and not response.json['ok']